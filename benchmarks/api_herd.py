@@ -0,0 +1,66 @@
+"""
+Thundering herd against the API stub: many threads call get_tunnels at once, as tunnels restarting together do.
+Compares requests reaching the server with and without request coalescing and the rate limiter,
+and checks that retries ride out a burst of 503 responses.
+"""
+import argparse
+import threading
+import time
+
+from boringproxy_api import WebAPI
+from stubs import APIStubServer, APIStubState
+
+
+def herd(web_api: WebAPI, threads: int) -> float:
+    barrier = threading.Barrier(threads)
+    errors = []
+
+    def call():
+        barrier.wait()
+        try:
+            web_api.get_tunnels("bench")
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=call) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated server time of a request")
+    args = parser.parse_args()
+
+    state = APIStubState(latency=args.latency)
+    stub = APIStubServer(state, tls=True).start()
+    token = next(iter(state.tokens))
+    for name, options in (("plain", {"coalesce_requests": False}),
+                          ("coalesced", {}),
+                          ("rate limited 50/s", {"coalesce_requests": False, "rate_limit": 50, "rate_burst": 10})):
+        web_api = WebAPI(stub.admin_domain, token=token, verify=stub.cert_path, pool_size=args.threads, **options)
+        web_api.get_tunnels("bench")  # Warm up the TLS connection
+        before = state.requests_count
+        elapsed = herd(web_api, args.threads)
+        print("%-18s %4d calls -> %4d server requests in %6.3f s" % (
+            name, args.threads, state.requests_count - before, elapsed))
+        web_api.close()
+
+    web_api = WebAPI(stub.admin_domain, token=token, verify=stub.cert_path, max_retries=3)
+    state.failures = [503, 502, 429]
+    started = time.perf_counter()
+    web_api.get_tunnels("bench")
+    print("get_tunnels after 503, 502, 429: succeeded in %.3f s" % (time.perf_counter() - started))
+    web_api.close()
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
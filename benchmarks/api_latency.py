@@ -0,0 +1,51 @@
+"""Compares API call latency without and with the pooled keep-alive session against a local TLS stub"""
+import argparse
+import statistics
+import time
+
+import requests
+
+from boringproxy_api import WebAPI
+from stubs import APIStubServer
+
+
+def measure(call, calls: int) -> list:
+    """Runs call() several times and returns latencies in milliseconds"""
+    latencies = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def report(name: str, latencies: list):
+    latencies = sorted(latencies)
+    print("%-22s mean %7.2f ms  p50 %7.2f ms  p99 %7.2f ms" % (
+        name, statistics.mean(latencies), latencies[len(latencies) // 2],
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    stub = APIStubServer(tls=True).start()
+    token = next(iter(stub.state.tokens))
+    url = "https://" + stub.admin_domain + "/api/tunnels"
+    headers = {"Authorization": "bearer " + token}
+
+    # Before: a new TCP connection and TLS handshake for every call
+    report("requests.request", measure(
+        lambda: requests.request("GET", url, headers=headers, params={}, verify=stub.cert_path), args.calls))
+
+    # After: WebAPI keeps connections alive in its session pool
+    web_api = WebAPI(stub.admin_domain, token=token, verify=stub.cert_path)
+    report("WebAPI pooled session", measure(web_api.get_tunnels, args.calls))
+    web_api.close()
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Checks AsyncWebAPI and AsyncClient against the local API and ssh stubs:
+every API method, error statuses, retries, request coalescing, streamed lookups
+and a tunnel carrying data end to end. Exits with 1 if a check fails.
+"""
+import argparse
+import asyncio
+import socket
+import sys
+import time
+import traceback
+
+from boringproxy_api import AsyncClient, AsyncWebAPI, ClientConfig
+from boringproxy_api.exceptions import NotFound, ServiceUnavailable, TokenError
+from relay_throughput import start_echo_server
+from stubs import APIStubServer, APIStubState, SSHStubServer, generate_private_key
+
+
+class Stubs:
+    def __init__(self):
+        self.ssh = SSHStubServer().start()
+        self.state = APIStubState(ssh_port=self.ssh.port, tunnel_private_key=generate_private_key())
+        self.api = APIStubServer(self.state, tls=True).start()
+        self.token = next(iter(self.state.tokens))
+        self.echo_port = start_echo_server()
+
+    def web_api(self, **options) -> AsyncWebAPI:
+        return AsyncWebAPI(self.api.admin_domain, token=self.token, verify=self.api.cert_path, **options)
+
+    def requests_count(self) -> int:
+        with self.state.lock:
+            return self.state.requests_count
+
+    def stop(self):
+        self.api.stop()
+        self.ssh.stop()
+
+
+def expect(condition, message: str):
+    if not condition:
+        raise AssertionError(message)
+
+
+async def check_methods(stubs: Stubs):
+    async with stubs.web_api() as web_api:
+        domain = "check-methods." + stubs.api.admin_domain
+        expect(await web_api.add_client(client_name="check") == "", "add_client")
+        await web_api.add_tunnel("check-methods", client_name="check", client_port=8080)
+        tunnels = await web_api.get_tunnels("check")
+        expect(domain in tunnels and tunnels[domain]["client_port"] == 8080, "get_tunnels: %r" % tunnels)
+        expect((await web_api.get_tunnel("check-methods", "check"))["domain"] == domain, "get_tunnel")
+        expect(await web_api.get_tunnel("check-methods", "other") is None, "get_tunnel of another client")
+        expect(list(await web_api.find_tunnels(["check-methods", "missing"], "check")) == [domain], "find_tunnels")
+        records = [record async for record in web_api.iter_tunnels("check")]
+        expect([record.domain for record in records] == [domain], "iter_tunnels: %r" % records)
+        await web_api.delete_tunnel("check-methods")
+        expect(await web_api.get_tunnel("check-methods", "check") is None, "delete_tunnel")
+        expect(await web_api.delete_client(client_name="check") == "", "delete_client")
+        await web_api.add_user("check-user")
+        expect(await web_api.delete_user("check-user") is True, "delete_user")
+        token = await web_api.add_token()
+        expect(isinstance(token, str) and token in stubs.state.tokens, "add_token: %r" % token)
+        expect(await web_api.delete_token(token) is True and token not in stubs.state.tokens, "delete_token")
+
+
+async def check_errors(stubs: Stubs):
+    async with AsyncWebAPI(stubs.api.admin_domain, token="invalid", verify=stubs.api.cert_path) as web_api:
+        try:
+            await web_api.get_tunnels()
+            expect(False, "no exception for an invalid token")
+        except TokenError:
+            pass
+    async with stubs.web_api(max_retries=0) as web_api:
+        stubs.state.failures.append(404)
+        try:
+            await web_api.get_tunnels()
+            expect(False, "no exception for 404")
+        except NotFound:
+            pass
+    async with AsyncWebAPI(stubs.api.admin_domain, token=stubs.token, verify=True) as web_api:
+        try:
+            await web_api.get_tunnels()
+            expect(False, "the self-signed certificate of the stub was trusted")
+        except Exception as e:
+            expect("Certificate" in type(e).__name__, "unexpected error %r" % e)
+
+
+async def check_retries(stubs: Stubs):
+    async with stubs.web_api(max_retries=2, retry_backoff=0.01) as web_api:
+        stubs.state.failures.extend([503, 429])
+        started = stubs.requests_count()
+        expect(await web_api.get_tunnels() == {}, "get_tunnels after retries")
+        expect(stubs.requests_count() - started == 3, "3 attempts expected")
+        stubs.state.failures.append(503)
+        started = stubs.requests_count()
+        try:
+            await web_api.add_tunnel("check-retries")
+            expect(False, "POST was retried or the 503 was lost")
+        except ServiceUnavailable:
+            pass
+        expect(stubs.requests_count() - started == 1, "POST must not be retried")
+
+
+async def check_coalescing(stubs: Stubs):
+    stubs.state.latency = 0.05
+    try:
+        async with stubs.web_api() as web_api:
+            for name, call in (("get_tunnels", lambda index: web_api.get_tunnels("check")),
+                               ("get_tunnel", lambda index: web_api.get_tunnel("missing-%d" % index, "check"))):
+                started = stubs.requests_count()
+                await asyncio.gather(*[call(index) for index in range(20)])
+                sent = stubs.requests_count() - started
+                expect(sent < 5, "20 concurrent %s calls sent %d requests" % (name, sent))
+            first = asyncio.ensure_future(web_api.get_tunnels("check"))
+            others = [asyncio.ensure_future(web_api.get_tunnels("check")) for _ in range(3)]
+            await asyncio.sleep(0.01)
+            first.cancel()
+            results = await asyncio.gather(first, *others, return_exceptions=True)
+            expect(isinstance(results[0], asyncio.CancelledError) and results[1:] == [{}] * 3,
+                   "cancelling one coalesced caller affected the others: %r" % results)
+    finally:
+        stubs.state.latency = 0.0
+
+
+async def check_client(stubs: Stubs):
+    config = ClientConfig()
+    config.admin_domain = stubs.api.admin_domain
+    config.token = stubs.token
+    config.verify = stubs.api.cert_path
+    config.client_name = "check-client"
+    async with AsyncClient(config) as client:
+        expect("check-client" in stubs.state.users["admin"]["clients"], "client registered")
+        tunnel = await client.open_tunnel("check-client", client_port=stubs.echo_port)
+        started = stubs.requests_count()
+        await tunnel.start()
+        sent = stubs.requests_count() - started
+        expect(sent == 0, "start() after open_tunnel sent %d API requests instead of reusing tunnel_info" % sent)
+        info = stubs.state.tunnels[tunnel.__subdomain__]
+        deadline = time.monotonic() + 5
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                reply = await loop.run_in_executor(None, echo, info["tunnel_port"], b"ping")
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+        expect(reply == b"ping", "echo through the tunnel: %r" % reply)
+        await tunnel.stop()
+        expect(tunnel.tunnel_info is None, "tunnel_info kept after stop()")
+        await tunnel.start()
+        expect(tunnel.tunnel_info is not None and tunnel.__subdomain__ in stubs.state.tunnels, "restart")
+        expect(client.get_all_opened_tunnels() == [tunnel], "opened tunnels")
+    expect(not stubs.state.tunnels, "tunnels left on the server: %r" % list(stubs.state.tunnels))
+    expect("check-client" not in stubs.state.users["admin"]["clients"], "client unregistered")
+
+
+def echo(port: int, payload: bytes) -> bytes:
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(payload)
+        reply = b""
+        while len(reply) < len(payload):
+            data = sock.recv(len(payload) - len(reply))
+            if not data:
+                break
+            reply += data
+        return reply
+
+
+CHECKS = {
+    "methods": check_methods,
+    "errors": check_errors,
+    "retries": check_retries,
+    "coalescing": check_coalescing,
+    "client": check_client,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", action="append", choices=list(CHECKS), help="Check to run, all by default")
+    args = parser.parse_args()
+
+    stubs = Stubs()
+    failed = False
+    try:
+        for name in args.only or CHECKS:
+            try:
+                asyncio.run(CHECKS[name](stubs))
+                print("%-12s ok" % name)
+            except Exception:
+                print("%-12s FAILED" % name)
+                traceback.print_exc()
+                failed = True
+    finally:
+        stubs.stop()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Measures relay throughput over an UpstreamGroup of 1..N CPU-bound local echo backends"""
+import argparse
+import multiprocessing
+import socket
+import threading
+
+from boringproxy_api.upstream import HASH, UpstreamGroup
+from relay_throughput import run
+
+
+def echo_backend(port_queue, work: int):
+    """Echo server process which burns CPU for every received chunk like a real application would"""
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", 0))
+    server.listen(128)
+    port_queue.put(server.getsockname()[1])
+
+    def echo(conn):
+        with conn:
+            while True:
+                data = conn.recv(64 * 1024)
+                if not data:
+                    return
+                sum(range(work))
+                conn.sendall(data)
+
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backends", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--connections", type=int, default=8)
+    parser.add_argument("--megabytes", type=int, default=16, help="Data sent through each connection")
+    parser.add_argument("--work", type=int, default=20000, help="Backend CPU work per received chunk")
+    parser.add_argument("--balance", default="least_connections", choices=("round_robin", "least_connections", HASH))
+    args = parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=echo_backend, args=(port_queue, args.work), daemon=True)
+                 for _ in range(max(args.backends))]
+    for process in processes:
+        process.start()
+    ports = [port_queue.get() for _ in processes]
+    baseline = None
+    for count in args.backends:
+        # The benchmark channels have no origin, so the hash strategy falls back to round robin for them
+        group = UpstreamGroup([("127.0.0.1", port) for port in ports[:count]], balance=args.balance,
+                              hash_key=(lambda origin: "%s:%d" % origin) if args.balance == HASH else None)
+        throughput = run(64 * 1024, args.connections, args.megabytes, group)
+        baseline = baseline or throughput
+        print("%d backend(s): %8.1f MB/s  x%.2f  per backend: %s" % (
+            count, throughput, throughput / baseline, [backend["total"] for backend in group.stats()["backends"]]))
+    for process in processes:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    main()
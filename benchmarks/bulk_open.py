@@ -0,0 +1,45 @@
+"""Compares one-by-one Client.open_tunnel with bulk Client.open_tunnels against a local TLS API stub"""
+import argparse
+import time
+
+from boringproxy_api import Client, ClientConfig
+from stubs import APIStubServer, APIStubState, generate_private_key
+
+
+def make_client(stub: APIStubServer, workers: int) -> Client:
+    config = ClientConfig()
+    config.admin_domain = stub.admin_domain
+    config.token = next(iter(stub.state.tokens))
+    config.verify = stub.cert_path
+    config.max_workers = workers
+    config.pool_size = workers
+    return Client(config)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tunnels", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Simulated API server processing time")
+    args = parser.parse_args()
+
+    state = APIStubState(tunnel_private_key=generate_private_key(), latency=args.latency_ms / 1000)
+    stub = APIStubServer(state, tls=True).start()
+
+    client = make_client(stub, args.workers)
+    started = time.perf_counter()
+    for i in range(args.tunnels):
+        client.open_tunnel("seq%d" % i, client_port=8000 + i)
+    print("open_tunnel x %d:  %7.2f s" % (args.tunnels, time.perf_counter() - started))
+
+    state.tunnels.clear()
+    started = time.perf_counter()
+    results = client.open_tunnels([{"subdomain": "bulk%d" % i, "client_port": 8000 + i}
+                                   for i in range(args.tunnels)])
+    elapsed = time.perf_counter() - started
+    print("open_tunnels(%d):  %7.2f s, %d failed" % (args.tunnels, elapsed, sum(not r.ok for r in results)))
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Counts requests cut off when a loaded tunnel is closed, with and without connection draining.
+Clients keep sending requests to a backend which answers after --service-ms through a tunnel over the ssh stub.
+Keep the request rate below about 50/s: the stub opens forwarded channels one by one, and connections waiting
+in its backlog are reset when the forward is cancelled, which says nothing about the client.
+Exits with 1 if closing with draining cuts off a request or takes longer than the drain timeout.
+"""
+import argparse
+import socket
+import sys
+import threading
+import time
+
+from boringproxy_api import Client, ClientConfig
+from stubs import APIStubServer, APIStubState, SSHStubServer, generate_private_key
+
+
+def start_slow_server(delay: float) -> int:
+    """Starts a server which answers every request after the delay and closes the connection"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1024)
+
+    def serve(conn):
+        with conn:
+            data = conn.recv(1024)
+            time.sleep(delay)
+            conn.sendall(b"ok:" + data)
+
+    def accept_loop():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def run(config: ClientConfig, backend_port: int, state: APIStubState, clients: int, drain_timeout: float) -> tuple:
+    """
+    :return: (completed requests, requests cut off mid-response, connections reset by the server, seconds in close)
+    """
+    client = Client(config)
+    tunnel = client.open_tunnel("drain", client_port=backend_port)
+    tunnel.start()
+    port = state.tunnels[tunnel.subdomain]["tunnel_port"]
+    counters = {"ok": 0, "cut": 0, "reset": 0}
+    lock = threading.Lock()
+    accepting = threading.Event()
+    accepting.set()
+
+    def load():
+        while accepting.is_set():
+            try:
+                conn = socket.create_connection(("127.0.0.1", port), timeout=5)
+            except OSError:
+                return  # The forward is gone, a new instance would take over from here
+            with conn:
+                try:
+                    conn.sendall(b"ping")
+                    reply = conn.recv(1024)
+                    result = "ok" if reply.startswith(b"ok:") else "cut"
+                except OSError:
+                    # Reset by the server while the connection waited in the backlog of the cancelled forward
+                    result = "reset"
+            with lock:
+                counters[result] += 1
+
+    workers = [threading.Thread(target=load) for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    time.sleep(1)
+    started = time.perf_counter()
+    client.close(drain_timeout)
+    elapsed = time.perf_counter() - started
+    accepting.clear()
+    for worker in workers:
+        worker.join()
+    return counters["ok"], counters["cut"], counters["reset"], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--service-ms", type=float, default=500)
+    parser.add_argument("--drain-timeout", type=float, default=5, help="Drain timeout of the checked close")
+    args = parser.parse_args()
+
+    ssh = SSHStubServer().start()
+    state = APIStubState(ssh_port=ssh.port, tunnel_private_key=generate_private_key())
+    stub = APIStubServer(state, tls=True).start()
+    backend_port = start_slow_server(args.service_ms / 1000)
+    config = ClientConfig()
+    config.admin_domain = stub.admin_domain
+    config.token = next(iter(state.tokens))
+    config.verify = stub.cert_path
+    failed = False
+    for drain_timeout in (0, args.drain_timeout):  # Without draining requests are expected to be cut off
+        completed, cut, reset, elapsed = run(config, backend_port, state, args.clients, drain_timeout)
+        print("drain_timeout=%g: %5d requests completed, %4d cut off mid-response, %4d reset in the server backlog,"
+              " close took %.2f s" % (drain_timeout, completed, cut, reset, elapsed))
+        if not drain_timeout:
+            continue
+        for problem, condition in (("%d requests cut off while draining" % cut, cut > 0),
+                                   ("no request completed", completed == 0),
+                                   ("close took longer than the drain timeout", elapsed > drain_timeout + 1)):
+            if condition:
+                print("  FAILED: %s" % problem, file=sys.stderr)
+                failed = True
+    stub.stop()
+    ssh.stop()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Measures import time of the package with `python -X importtime` in fresh interpreters.
+Exits with 1 if a lightweight import pulls in paramiko or requests.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("paramiko", "requests", "cryptography", "aiohttp")
+# Name -> (import statement, heavy modules the statement may load)
+STATEMENTS = {
+    "package": ("import boringproxy_api", ()),
+    "web_api": ("from boringproxy_api import WebAPI, ClientConfig\n"
+                "from boringproxy_api.exceptions import APIError", ()),
+    "sharded_client": ("from boringproxy_api import ShardedClient", ()),
+    "client": ("from boringproxy_api import Client", ("paramiko", "cryptography")),
+}
+
+
+def importtime(statement: str) -> tuple:
+    """
+    Runs the statement in a new interpreter
+    :return: (microseconds spent in imports done by the statement, set of imported top-level packages)
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+
+    def run(code: str) -> list:
+        stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, check=True,
+                                capture_output=True, text=True).stderr
+        entries = []
+        for line in stderr.splitlines():
+            if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+                _, cumulative, name = line[len("import time:"):].split("|")
+                entries.append((int(cumulative), name[1:].rstrip()))  # Nested imports stay indented
+        return entries
+
+    startup = {name.strip() for _, name in run("pass")}
+    entries = [(cumulative, name) for cumulative, name in run(statement) if name.strip() not in startup]
+    total = sum(cumulative for cumulative, name in entries if not name.startswith(" "))  # Top-level imports only
+    return total, {name.strip().split(".")[0] for _, name in entries}
+
+
+def measure(repeat: int = 5) -> dict:
+    """
+    :return: dict name -> {"ms": median import time, "heavy": heavy packages loaded, "unexpected": ...}
+    """
+    results = {}
+    for name, (statement, allowed) in STATEMENTS.items():
+        samples, packages = [], set()
+        for _ in range(repeat):
+            total, packages = importtime(statement)
+            samples.append(total)
+        heavy = sorted(package for package in packages if package in HEAVY_MODULES)
+        results[name] = {"ms": round(statistics.median(samples) / 1000, 2), "heavy": heavy,
+                         "unexpected": [package for package in heavy if package not in allowed]}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    for name, result in measure(args.repeat).items():
+        print("%-15s %8.2f ms  heavy modules: %s" % (name, result["ms"], ", ".join(result["heavy"]) or "-"))
+        if result["unexpected"]:
+            print("  UNEXPECTED %s" % ", ".join(result["unexpected"]), file=sys.stderr)
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""Compares relay throughput with and without traffic metrics"""
+import argparse
+import statistics
+
+from boringproxy_api.metrics import TunnelMetrics
+from relay_throughput import run, start_echo_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--megabytes", type=int, default=32, help="Data sent through each connection")
+    parser.add_argument("--buffer-size", type=int, default=16 * 1024)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    port = start_echo_server()
+    results = {"uninstrumented": [], "with metrics": []}
+    metrics = TunnelMetrics("benchmark")
+    for _ in range(args.repeats):  # Interleave runs so that noise hits both variants alike
+        results["uninstrumented"].append(run(args.buffer_size, args.connections, args.megabytes, port))
+        results["with metrics"].append(run(args.buffer_size, args.connections, args.megabytes, port, metrics))
+    for name, values in results.items():
+        print("%-15s median %8.1f MB/s" % (name, statistics.median(values)))
+    overhead = 1 - statistics.median(results["with metrics"]) / statistics.median(results["uninstrumented"])
+    print("overhead: %.2f%%" % (overhead * 100))
+    print("recorded: %s" % {k: v for k, v in metrics.snapshot().items() if not k.endswith("_buckets")})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Checks the decisions of Reconciler.plan against the local API and ssh stubs, one tunnel per decision:
+add, adopt, restart, start, delete, delete_remote and unchanged. Then applies the plan and checks
+that the client and the server hold exactly the desired tunnels. Exits with 1 if a check fails.
+"""
+import sys
+import traceback
+
+from boringproxy_api import Client, ClientConfig
+from boringproxy_api.reconciler import Reconciler
+from relay_throughput import start_echo_server
+from stubs import APIStubServer, APIStubState, SSHStubServer, generate_private_key
+
+
+def expect(condition, message: str):
+    if not condition:
+        raise AssertionError(message)
+
+
+def check_plan(client: Client, state: APIStubState, port: int):
+    api = client.web_api
+    name = client.config.client_name
+    full = lambda subdomain: subdomain + "." + api.admin_domain
+    for subdomain in ("unchanged", "changed", "vanished", "undesired"):
+        client.open_tunnel(subdomain, client_port=port).start()
+    client.open_tunnel("stopped", client_port=port)
+    api.add_tunnel("adopted", client_name=name, client_port=port)
+    api.add_tunnel("mismatched", client_name=name, client_port=port + 1)
+    api.add_tunnel("leftover", client_name=name, client_port=port)
+    with state.lock:
+        del state.tunnels[full("vanished")]  # Removed from the server behind the client's back
+    desired = {subdomain: {"client_port": port} for subdomain in
+               ("unchanged", "vanished", "stopped", "adopted", "mismatched", "new")}
+    desired["changed"] = {"client_port": port + 2}
+
+    reconciler = Reconciler(client)
+    plan = reconciler.plan(desired, api.get_tunnels(name))
+    expected = {"add": {full("mismatched"), full("new")}, "adopt": {full("adopted")},
+                "restart": {full("changed"), full("vanished")}, "start": {full("stopped")},
+                "delete": {full("undesired")}, "delete_remote": {full("leftover")}, "unchanged": {full("unchanged")}}
+    decisions = {"add": set(plan.add), "adopt": set(plan.adopt), "restart": set(plan.restart),
+                 "start": {tunnel.subdomain for tunnel in plan.start},
+                 "delete": {tunnel.subdomain for tunnel in plan.delete},
+                 "delete_remote": set(plan.delete_remote), "unchanged": set(plan.unchanged)}
+    for decision, domains in expected.items():
+        expect(decisions[decision] == domains, "%s: %r, expected %r" % (decision, decisions[decision], domains))
+    expect(not Reconciler(client, prune=False).plan(desired, api.get_tunnels(name)).delete_remote,
+           "delete_remote without prune")
+
+    results = reconciler.apply(desired)
+    expect(all(result.ok for result in results), "apply: %r" % results)
+    wanted = {full(subdomain) for subdomain in desired}
+    expect({tunnel.subdomain for tunnel in client.get_all_opened_tunnels()} == wanted, "opened tunnels")
+    expect(all(tunnel.is_alive for tunnel in client.get_all_opened_tunnels()), "tunnels left stopped")
+    expect(set(api.get_tunnels(name)) == wanted, "server tunnels: %r" % sorted(api.get_tunnels(name)))
+    expect(client.get_tunnel(full("changed")).options["client_port"] == port + 2, "changed port not applied")
+    plan = reconciler.plan(desired)
+    expect(plan.is_empty and len(plan.unchanged) == len(desired), "not converged: %r" % plan)
+
+
+def main():
+    ssh = SSHStubServer().start()
+    state = APIStubState(ssh_port=ssh.port, tunnel_private_key=generate_private_key())
+    stub = APIStubServer(state, tls=True).start()
+    config = ClientConfig()
+    config.admin_domain = stub.admin_domain
+    config.token = next(iter(state.tokens))
+    config.verify = stub.cert_path
+    config.auto_reconnect = False
+    config.client_name = "reconcile-check"
+    failed = False
+    try:
+        with Client(config) as client:
+            check_plan(client, state, start_echo_server())
+        print("plan         ok")
+    except Exception:
+        print("plan         FAILED")
+        traceback.print_exc()
+        failed = True
+    finally:
+        stub.stop()
+        ssh.stop()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Measures reloading a desired tunnel set with a few changes: close and reopen everything vs Reconciler.apply"""
+import argparse
+import time
+
+from boringproxy_api import Client, ClientConfig
+from boringproxy_api.reconciler import Reconciler
+from relay_throughput import start_echo_server
+from stubs import APIStubServer, APIStubState, SSHStubServer, generate_private_key
+
+
+def desired_set(count: int, port: int, changed: int, generation: int) -> dict:
+    """Tunnels t0..tN, the first `changed` of them get a different client port in every generation"""
+    return {"t%d" % i: {"client_port": port + (generation if i < changed else 0)} for i in range(count)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tunnels", type=int, default=100)
+    parser.add_argument("--changed", type=int, default=5)
+    parser.add_argument("--reloads", type=int, default=3)
+    args = parser.parse_args()
+
+    ssh = SSHStubServer().start()
+    state = APIStubState(ssh_port=ssh.port, tunnel_private_key=generate_private_key())
+    stub = APIStubServer(state, tls=True).start()
+    config = ClientConfig()
+    config.admin_domain = stub.admin_domain
+    config.token = next(iter(state.tokens))
+    config.verify = stub.cert_path
+    config.auto_reconnect = False
+    port = start_echo_server()
+    client = Client(config)
+
+    client.open_tunnels([dict(spec, subdomain=subdomain)
+                         for subdomain, spec in desired_set(args.tunnels, port, args.changed, 0).items()])
+    client.start_all()
+    handshakes = ssh.handshakes
+    started = time.perf_counter()
+    for generation in range(1, args.reloads + 1):
+        client.close_all_tunnels()
+        client.open_tunnels([dict(spec, subdomain=subdomain)
+                             for subdomain, spec in desired_set(args.tunnels, port, args.changed, generation).items()])
+        client.start_all()
+    print("close+reopen all: %7.3f s per reload, %d ssh handshakes" % (
+        (time.perf_counter() - started) / args.reloads, ssh.handshakes - handshakes))
+
+    reconciler = Reconciler(client)
+    handshakes = ssh.handshakes
+    started = time.perf_counter()
+    for generation in range(args.reloads + 1, 2 * args.reloads + 1):
+        reconciler.apply(desired_set(args.tunnels, port, args.changed, generation))
+    print("Reconciler.apply: %7.3f s per reload, %d ssh handshakes, last plan %r" % (
+        (time.perf_counter() - started) / args.reloads, ssh.handshakes - handshakes, reconciler.last_plan))
+
+    started = time.perf_counter()
+    reconciler.apply(desired_set(args.tunnels, port, args.changed, 2 * args.reloads))
+    print("unchanged reload: %7.3f ms" % ((time.perf_counter() - started) * 1000))
+
+    client.close_all_tunnels()
+    stub.stop()
+    ssh.stop()
+
+
+if __name__ == "__main__":
+    main()
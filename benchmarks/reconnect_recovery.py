@@ -0,0 +1,99 @@
+"""
+Kills the local ssh server under running tunnels and measures how fast the supervisor recovers them.
+Exits with 1 if the drop is not detected within --max-detect-s, the tunnels are not all up again
+within --max-recovery-s after the restart, data is not relayed afterwards
+or the supervisor thread keeps running after TunnelSupervisor.stop().
+"""
+import argparse
+import socket
+import sys
+import threading
+import time
+
+import paramiko
+
+from boringproxy_api.ssh_tunnel import SSHReverseTunnelForwarder
+from boringproxy_api.supervisor import TunnelState, TunnelSupervisor
+from boringproxy_api.transport import TransportManager
+from relay_throughput import start_echo_server
+from stubs import SSHStubServer, free_ports
+
+
+def wait_for(predicate, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tunnels", type=int, default=20)
+    parser.add_argument("--shared", action="store_true", help="Carry all tunnels over one shared transport")
+    parser.add_argument("--downtime", type=float, default=1.0, help="Seconds the ssh server stays down")
+    parser.add_argument("--max-detect-s", type=float, default=5, help="Deadline to notice the drop")
+    parser.add_argument("--max-recovery-s", type=float, default=10, help="Deadline to recover after the restart")
+    args = parser.parse_args()
+
+    echo_port = start_echo_server()
+    ssh = SSHStubServer().start()
+    transitions = []
+    lock = threading.Lock()
+
+    def on_state_change(forwarder, old_state, new_state):
+        with lock:
+            transitions.append((time.monotonic(), forwarder.server_port, old_state, new_state))
+
+    supervisor = TunnelSupervisor(check_interval=0.05, keepalive_interval=1, backoff_base=0.1, backoff_max=1.0,
+                                  on_state_change=on_state_change)
+    manager = TransportManager() if args.shared else None
+    pkey = paramiko.ECDSAKey.generate()
+    forwarders = [SSHReverseTunnelForwarder("127.0.0.1", ssh.port, "admin", pkey, port, "127.0.0.1",
+                                            echo_port, transport_manager=manager, supervisor=supervisor)
+                  for port in free_ports(args.tunnels)]
+    for forwarder in forwarders:
+        forwarder.start()
+
+    killed = time.monotonic()
+    ssh.stop()
+    all_down = wait_for(lambda: all(f.state != TunnelState.UP for f in forwarders), args.max_detect_s)
+    detected = time.monotonic()
+    time.sleep(args.downtime)
+    ssh = SSHStubServer(ssh.port, ssh.host_key).start()
+    restarted = time.monotonic()
+    recovered = wait_for(lambda: all(f.state == TunnelState.UP for f in forwarders), args.max_recovery_s)
+    finished = time.monotonic()
+
+    try:
+        with socket.create_connection(("127.0.0.1", forwarders[-1].server_port), timeout=5) as conn:
+            conn.sendall(b"ping")
+            relayed = conn.recv(4) == b"ping"
+    except OSError:
+        relayed = False
+
+    print("tunnels: %d (%s transport)" % (args.tunnels, "shared" if args.shared else "dedicated"))
+    print("drop detected by all tunnels: %s after %.3f s" % (all_down, detected - killed))
+    print("recovered after server restart: %s in %.3f s" % (recovered, finished - restarted))
+    print("reconnects %d, failed attempts %d, state transitions %d, data relayed after recovery: %s" % (
+        supervisor.reconnects, supervisor.failed_attempts, len(transitions), relayed))
+    for forwarder in forwarders:
+        forwarder.stop()
+    supervisor.stop(timeout=2)
+    supervisor_running = any(thread.name == "bp-tunnel-supervisor" for thread in threading.enumerate())
+    ssh.stop()
+
+    failed = False
+    for problem, condition in (("drop not detected within %g s" % args.max_detect_s, not all_down),
+                               ("not recovered within %g s" % args.max_recovery_s, not recovered),
+                               ("no data relayed after recovery", not relayed),
+                               ("supervisor thread still running after stop()", supervisor_running)):
+        if condition:
+            print("FAILED: %s" % problem, file=sys.stderr)
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Per-tunnel relay limits: a noisy tunnel pushing data as fast as it can next to a quiet tunnel doing
+small request/response exchanges on the same relay engine, with and without a bandwidth limit on the noisy one.
+Also checks the accuracy of the byte rate, the CPU used while connections are paused
+and the connections rejected by the connection limits.
+A socketpair end plays the role of the ssh channel, the local service is an echo server.
+"""
+import argparse
+import socket
+import statistics
+import threading
+import time
+
+from boringproxy_api.metrics import TunnelMetrics
+from boringproxy_api.ratelimit import RelayLimits
+from boringproxy_api.relay import RelayEngine
+from boringproxy_api.upstream import Upstream
+from relay_throughput import start_echo_server
+
+
+def noisy_connection(engine: RelayEngine, upstream: Upstream, metrics: TunnelMetrics, limits: RelayLimits,
+                     stop: threading.Event, received: list):
+    chan, peer = socket.socketpair()
+    engine.add_connection(chan, upstream, metrics, limits=limits)
+    payload = b"x" * (64 * 1024)
+
+    def reader():
+        try:
+            while True:
+                data = peer.recv(256 * 1024)
+                if not data:
+                    return
+                received.append(len(data))
+        except OSError:
+            pass  # Closed by the sender
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    peer.settimeout(0.2)
+    while not stop.is_set():
+        try:
+            peer.sendall(payload)
+        except socket.timeout:
+            continue  # Paused by the limit, check the stop flag again
+        except OSError:
+            break
+    peer.close()
+
+
+def quiet_latencies(engine: RelayEngine, upstream: Upstream, seconds: float) -> list:
+    """Sends 1 KiB requests through a separate tunnel and returns the round trip times in ms"""
+    chan, peer = socket.socketpair()
+    engine.add_connection(chan, upstream, TunnelMetrics("quiet"))
+    message = b"q" * 1024
+    latencies = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        peer.sendall(message)
+        left = len(message)
+        while left:
+            left -= len(peer.recv(left))
+        latencies.append((time.perf_counter() - started) * 1000)
+    peer.close()
+    return latencies
+
+
+def run_noisy(port: int, connections: int, seconds: float, limits: RelayLimits, quiet: bool = True) -> dict:
+    """
+    :param quiet: Measure the latency of the quiet tunnel meanwhile. Without it, the process CPU time
+    is spent only by the noisy tunnel and its load generator
+    """
+    engine = RelayEngine(workers=2)
+    engine.start()
+    upstream = Upstream(("127.0.0.1", port))
+    metrics = TunnelMetrics("noisy")
+    stop, received = threading.Event(), []
+    threads = [threading.Thread(target=noisy_connection, args=(engine, upstream, metrics, limits, stop, received))
+               for _ in range(connections)]
+    cpu_started, started = time.process_time(), time.perf_counter()
+    for thread in threads:
+        thread.start()
+    if quiet:
+        latencies = sorted(quiet_latencies(engine, upstream, seconds))
+    else:
+        latencies = [0.0]
+        stop.wait(seconds)
+    snapshot = metrics.snapshot()
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+    stop.set()
+    for thread in threads:
+        thread.join()
+    engine.stop()
+    return {"noisy_mbps": (snapshot["bytes_in"] + snapshot["bytes_out"]) / elapsed / 2 ** 20,
+            "quiet_p50_ms": statistics.median(latencies),
+            "quiet_p99_ms": latencies[int(len(latencies) * 0.99)],
+            "quiet_requests": len(latencies), "cpu_s": cpu, "elapsed_s": elapsed,
+            "throttled": snapshot["throttled_connections"]}
+
+
+def run_connection_limits(port: int, attempts: int, limits: RelayLimits) -> dict:
+    """Opens attempts connections at once and counts the rejected ones"""
+    engine = RelayEngine(workers=2)
+    engine.start()
+    metrics = TunnelMetrics("limited")
+    peers = []
+    for _ in range(attempts):
+        chan, peer = socket.socketpair()
+        engine.add_connection(chan, Upstream(("127.0.0.1", port)), metrics, limits=limits)
+        peers.append(peer)
+    time.sleep(0.5)
+    snapshot = metrics.snapshot()
+    for peer in peers:
+        peer.close()
+    engine.stop()
+    return {"accepted": snapshot["connections"], "rejected": snapshot["rejected_connections"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=4, help="Connections of the noisy tunnel")
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--limit-mbps", type=float, default=8, help="Bandwidth limit of the noisy tunnel")
+    args = parser.parse_args()
+    port = start_echo_server()
+
+    limited = "limited %g MB/s" % args.limit_mbps
+    for name, limits in (("unlimited", None),
+                         (limited, RelayLimits(bytes_per_second=args.limit_mbps * 2 ** 20, burst_bytes=256 * 1024))):
+        result = run_noisy(port, args.connections, args.seconds, limits)
+        print("%-18s noisy %7.1f MB/s   quiet p50 %6.2f ms  p99 %6.2f ms  %6d requests   throttled connections %d"
+              % (name, result["noisy_mbps"], result["quiet_p50_ms"], result["quiet_p99_ms"],
+                 result["quiet_requests"], result["throttled"]))
+    result = run_noisy(port, args.connections, args.seconds,
+                       RelayLimits(bytes_per_second=args.limit_mbps * 2 ** 20, burst_bytes=256 * 1024), quiet=False)
+    print("%-18s noisy %7.1f MB/s alone: cpu %.2f s of %.2f s" % (limited, result["noisy_mbps"], result["cpu_s"],
+                                                                  result["elapsed_s"]))
+
+    for name, limits in (("max_connections=10", RelayLimits(max_connections=10)),
+                         ("20/s, burst 5", RelayLimits(connections_per_second=20, connection_burst=5))):
+        result = run_connection_limits(port, 30, limits)
+        print("%-18s 30 connections at once: %d accepted, %d rejected" % (name, result["accepted"],
+                                                                          result["rejected"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Measures relay throughput (MB/s) against a local echo server"""
+import argparse
+import socket
+import threading
+import time
+
+from boringproxy_api.relay import RelayEngine
+from boringproxy_api.upstream import Upstream
+
+
+def start_echo_server() -> int:
+    """Starts a threaded echo server on a random local port and returns the port"""
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", 0))
+    server.listen(128)
+
+    def echo(conn):
+        with conn:
+            try:
+                while True:
+                    data = conn.recv(256 * 1024)
+                    if not data:
+                        return
+                    conn.sendall(data)
+            except OSError:
+                pass  # Reset by a relay which closed the connection with echoed data in flight
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def run(buffer_size: int, connections: int, megabytes: int, port, metrics=None) -> float:
+    """
+    Pushes megabytes of data through each relayed connection and reads them back.
+    A socketpair end plays the role of the ssh channel.
+    :param port: Local echo server port, or an Upstream/UpstreamGroup
+    :param metrics: Optional TunnelMetrics updated by the relay
+    :return: Throughput in MB/s (both directions are counted)
+    """
+    engine = RelayEngine(buffer_size=buffer_size)
+    engine.start()
+    upstream = Upstream(("127.0.0.1", port)) if isinstance(port, int) else port
+    payload = b"x" * (256 * 1024)
+    total = megabytes * 1024 * 1024
+
+    def client():
+        chan, peer = socket.socketpair()
+        engine.add_connection(chan, upstream, metrics)
+
+        def reader():
+            left = total
+            while left > 0:
+                left -= len(peer.recv(256 * 1024))
+
+        thr = threading.Thread(target=reader)
+        thr.start()
+        sent = 0
+        while sent < total:
+            peer.sendall(payload)
+            sent += len(payload)
+        thr.join()
+        peer.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(connections)]
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+    elapsed = time.perf_counter() - started
+    engine.stop()
+    return 2 * megabytes * connections / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--megabytes", type=int, default=64, help="Data sent through each connection")
+    parser.add_argument("--buffer-sizes", type=int, nargs="+", default=[1024, 16 * 1024, 64 * 1024, 256 * 1024])
+    args = parser.parse_args()
+    port = start_echo_server()
+    for buffer_size in args.buffer_sizes:
+        throughput = run(buffer_size, args.connections, args.megabytes, port)
+        print("buffer %7d B: %8.1f MB/s" % (buffer_size, throughput))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Measures aggregate tunnel throughput of ShardedClient with 1, 2, 4 and 8 worker processes"""
+import argparse
+import multiprocessing
+import socket
+import threading
+import time
+
+from boringproxy_api import ClientConfig
+from boringproxy_api.sharding import ShardedClient
+from relay_throughput import start_echo_server
+from stubs import APIStubServer, APIStubState, SSHStubServer, generate_private_key
+
+
+def ssh_stub_process(port_queue):
+    """Runs the ssh stub in its own process, so its encryption does not compete with the benchmark client"""
+    ssh = SSHStubServer().start()
+    port_queue.put(ssh.port)
+    threading.Event().wait()
+
+
+def push(port: int, megabytes: int):
+    """Sends megabytes through the forwarded port and reads the echo back"""
+    payload = b"x" * (64 * 1024)
+    total = megabytes * 1024 * 1024
+    with socket.create_connection(("127.0.0.1", port)) as conn:
+        def reader():
+            left = total
+            while left > 0:
+                left -= len(conn.recv(256 * 1024))
+
+        thr = threading.Thread(target=reader)
+        thr.start()
+        sent = 0
+        while sent < total:
+            conn.sendall(payload)
+            sent += len(payload)
+        thr.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--tunnels", type=int, default=8)
+    parser.add_argument("--megabytes", type=int, default=8, help="Data sent through each tunnel")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    ssh_process = context.Process(target=ssh_stub_process, args=(port_queue,), daemon=True)
+    ssh_process.start()
+    state = APIStubState(ssh_port=port_queue.get(), tunnel_private_key=generate_private_key())
+    stub = APIStubServer(state, tls=True).start()
+    echo_port = start_echo_server()
+    config = ClientConfig()
+    config.admin_domain = stub.admin_domain
+    config.token = next(iter(state.tokens))
+    config.verify = stub.cert_path
+    config.auto_reconnect = False
+
+    for workers in args.workers:
+        with ShardedClient(config, workers=workers) as client:
+            results = client.open_tunnels([{"subdomain": "shard%d" % i, "client_port": echo_port}
+                                           for i in range(args.tunnels)])
+            failed = [result for result in results if not result.ok]
+            ports = [state.tunnels[result.subdomain]["tunnel_port"] for result in results if result.ok]
+            started = time.perf_counter()
+            threads = [threading.Thread(target=push, args=(port, args.megabytes)) for port in ports]
+            for thr in threads:
+                thr.start()
+            for thr in threads:
+                thr.join()
+            elapsed = time.perf_counter() - started
+            per_worker = [len(worker["tunnels"]) for worker in client.stats()["workers"]]
+        print("%d worker(s): %7.1f MB/s  tunnels per worker %s  failed %d" % (
+            workers, 2 * args.megabytes * len(ports) / elapsed, per_worker, len(failed)))
+    stub.stop()
+    ssh_process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Checks ShardedClient against the local API and ssh stubs when a worker dies:
+the replies of the other workers stay paired with their commands, new tunnels avoid the dead worker,
+and a client collected without close() only warns and terminates its workers.
+Exits with 1 if a check fails.
+"""
+import gc
+import multiprocessing
+import sys
+import traceback
+import warnings
+
+from boringproxy_api import ClientConfig
+from boringproxy_api.sharding import ShardedClient
+from relay_throughput import start_echo_server
+from stubs import APIStubServer, APIStubState, SSHStubServer, generate_private_key
+
+
+def expect(condition, message: str):
+    if not condition:
+        raise AssertionError(message)
+
+
+def check_dead_worker(config: ClientConfig, echo_port: int):
+    with ShardedClient(config, workers=3) as client:
+        specs = [{"subdomain": "dead-%d" % index, "client_port": echo_port} for index in range(6)]
+        expect(all(result.ok for result in client.open_tunnels(specs)), "tunnels opened")
+        victim = client.__workers__[1]  # Commands go to the workers in index order, so worker 0 is sent one first
+        victim_tunnels = set(victim.tunnels)
+        victim.process.kill()
+        victim.process.join()
+        try:
+            client.stats()
+            expect(False, "stats() of a dead worker succeeded")
+        except RuntimeError:
+            pass
+        expect(victim.dead, "the worker is not marked as dead")
+        # Worker 0 must answer this command, not the stats command sent before
+        stats = client.__call_workers__({client.__workers__[0]: ("stats", None)})[client.__workers__[0]]
+        expect(isinstance(stats, dict) and "tunnels" in stats, "reply out of step: %r" % (stats,))
+        results = client.open_tunnels([{"subdomain": "after-%d" % index, "client_port": echo_port}
+                                       for index in range(4)])
+        expect(all(result.ok for result in results), "open after the death: %r" % results)
+        expect(victim.tunnels == victim_tunnels, "new tunnels placed on the dead worker: %r" % victim.tunnels)
+
+
+def check_finalizer(config: ClientConfig, state: APIStubState):
+    client = ShardedClient(config, workers=2)
+    processes = [worker.process for worker in client.__workers__]
+    requests_count = state.requests_count
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        del client
+        gc.collect()
+    expect(any(issubclass(warning.category, ResourceWarning) for warning in caught), "no ResourceWarning")
+    for process in processes:
+        process.join(5)
+    expect(not any(process.is_alive() for process in processes), "workers left running")
+    expect(state.requests_count == requests_count, "the finalizer called the API server")
+
+
+def main():
+    multiprocessing.set_start_method("spawn")
+    ssh = SSHStubServer().start()
+    state = APIStubState(ssh_port=ssh.port, tunnel_private_key=generate_private_key())
+    stub = APIStubServer(state, tls=True).start()
+    config = ClientConfig()
+    config.admin_domain = stub.admin_domain
+    config.token = next(iter(state.tokens))
+    config.verify = stub.cert_path
+    config.auto_reconnect = False
+    config.client_name = "sharding-check"
+    echo_port = start_echo_server()
+    failed = False
+    try:
+        for name, check in (("dead worker", lambda: check_dead_worker(config, echo_port)),
+                            ("finalizer", lambda: check_finalizer(config, state))):
+            try:
+                check()
+                print("%-12s ok" % name)
+            except Exception:
+                print("%-12s FAILED" % name)
+                traceback.print_exc()
+                failed = True
+    finally:
+        stub.stop()
+        ssh.stop()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Measures how long stopping many tunnels takes against a local ssh server.
+Exits with 1 if a tunnel takes longer than --max-stop-ms to stop, all of them take longer than --max-total-s
+or threads of stopped tunnels are left running.
+"""
+import argparse
+import statistics
+import sys
+import threading
+import time
+
+import paramiko
+
+from boringproxy_api.ssh_tunnel import SSHReverseTunnelForwarder
+from boringproxy_api.transport import TransportManager
+from stubs import SSHStubServer, free_ports
+
+
+def run(ssh: SSHStubServer, tunnels: int, shared: bool):
+    """
+    Starts forwarders, then stops them all and reports per-tunnel and total stop time
+    :return: (list of per-tunnel stop latencies in ms, total time in seconds, number of threads released,
+    number of threads left running after the stop)
+    """
+    threads_before_start = threading.active_count()
+    pkey = paramiko.ECDSAKey.generate()
+    manager = TransportManager() if shared else None
+    forwarders = [SSHReverseTunnelForwarder("127.0.0.1", ssh.port, "admin", pkey, port, "127.0.0.1", 1,
+                                            transport_manager=manager) for port in free_ports(tunnels)]
+    for forwarder in forwarders:
+        forwarder.start()
+    threads_before_stop = threading.active_count()
+    latencies = []
+    started = time.perf_counter()
+    for forwarder in forwarders:
+        stop_started = time.perf_counter()
+        forwarder.stop()
+        latencies.append((time.perf_counter() - stop_started) * 1000)
+    total = time.perf_counter() - started
+    deadline = time.monotonic() + 2
+    while threading.active_count() > threads_before_start and time.monotonic() < deadline:
+        time.sleep(0.01)  # Let paramiko threads of closed transports exit
+    threads_after_stop = threading.active_count()
+    return latencies, total, threads_before_stop - threads_after_stop, threads_after_stop - threads_before_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tunnels", type=int, default=50)
+    parser.add_argument("--max-stop-ms", type=float, default=100, help="Bound of the stop time of one tunnel")
+    parser.add_argument("--max-total-s", type=float, default=2, help="Bound of the time to stop all tunnels")
+    args = parser.parse_args()
+    ssh = SSHStubServer().start()
+    failed = False
+    for shared in (False, True):
+        latencies, total, released, leaked = run(ssh, args.tunnels, shared)
+        print("%-9s %d tunnels: stop mean %6.2f ms  max %6.2f ms  total %6.3f s  threads released %d  left %d" % (
+            "shared" if shared else "dedicated", args.tunnels, statistics.mean(latencies), max(latencies),
+            total, released, leaked))
+        for problem, condition in (("slowest stop above %g ms" % args.max_stop_ms, max(latencies) > args.max_stop_ms),
+                                   ("total above %g s" % args.max_total_s, total > args.max_total_s),
+                                   ("%d threads left running" % leaked, leaked > 0)):
+            if condition:
+                print("  FAILED: %s" % problem, file=sys.stderr)
+                failed = True
+    ssh.stop()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
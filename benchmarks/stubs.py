@@ -0,0 +1,406 @@
+"""Local stand-ins for the boringproxy server used by the benchmarks"""
+import datetime
+import ipaddress
+import json
+import os
+import selectors
+import socket
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from urllib.parse import parse_qs, urlparse
+
+import paramiko
+
+
+def generate_private_key(bits: int = 2048) -> str:
+    """
+    Generates an RSA private key like the ones boringproxy hands out for tunnels
+    :return: PEM encoded key
+    """
+    buffer = StringIO()
+    paramiko.RSAKey.generate(bits).write_private_key(buffer)
+    return buffer.getvalue()
+
+
+def free_port() -> int:
+    """
+    Returns a local port which is currently free. Fixed port ranges may collide
+    with TIME_WAIT sockets of earlier connections, as they overlap the ephemeral range
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def free_ports(count: int) -> list:
+    """Returns count distinct free local ports, repeated free_port() calls may return the same port"""
+    sockets = []
+    try:
+        for _ in range(count):
+            sock = socket.socket()
+            sockets.append(sock)
+            sock.bind(("127.0.0.1", 0))
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def make_self_signed_cert(directory: str = None):
+    """
+    Generates a self-signed certificate for 127.0.0.1 and localhost
+    :param directory: Where to write the files. A temporary directory by default
+    :return: (cert file path, key file path)
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    directory = directory or tempfile.mkdtemp(prefix="bp-stub-")
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost"),
+                                                        x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+                           critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .sign(key, hashes.SHA256()))
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+class APIStubState:
+    """In-memory state of the stub boringproxy server"""
+
+    def __init__(self, token: str = "stub-token", ssh_address: str = "127.0.0.1", ssh_port: int = 22,
+                 tunnel_private_key: str = "", latency: float = 0.0, tunnel_keys: list = None):
+        """
+        :param tunnel_private_key: Key handed out to every new tunnel if tunnel_keys is empty
+        :param tunnel_keys: Pregenerated keys handed out in turn, one per new tunnel, like boringproxy
+        mints a key for every tunnel. Keys repeat only after all of them were used
+        """
+        self.tokens = {token: "admin"}
+        self.users = {"admin": {"is_admin": True, "clients": {}}}
+        self.tunnels = {}
+        self.ssh_address = ssh_address
+        self.ssh_port = ssh_port
+        self.tunnel_private_key = tunnel_private_key
+        self.tunnel_keys = list(tunnel_keys or ())
+        self.keys_handed_out = 0
+        self.latency = latency  # Simulated server processing time of every request in seconds
+        self.requests_count = 0
+        self.failures = []  # Status codes returned to the next requests instead of handling them
+        self.lock = threading.Lock()
+
+    def next_tunnel_key(self) -> str:
+        """Returns the private key of a new tunnel, called with the lock held"""
+        if not self.tunnel_keys:
+            return self.tunnel_private_key
+        key = self.tunnel_keys[self.keys_handed_out % len(self.tunnel_keys)]
+        self.keys_handed_out += 1
+        return key
+
+
+class APIStubHandler(BaseHTTPRequestHandler):
+    """Implements the boringproxy API endpoints used by WebAPI"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    state: APIStubState = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.__dispatch__("GET")
+
+    def do_POST(self):
+        self.__dispatch__("POST")
+
+    def do_PUT(self):
+        self.__dispatch__("PUT")
+
+    def do_DELETE(self):
+        self.__dispatch__("DELETE")
+
+    def __reply__(self, code: int, body=None):
+        payload = b"" if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+        self.send_response(code)
+        if code == 303:
+            self.send_header("Location", "/")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def __dispatch__(self, method: str):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        state = self.state
+        token = (self.headers.get("Authorization") or "").split(" ")[-1]
+        if state.latency:
+            time.sleep(state.latency)
+        with state.lock:
+            state.requests_count += 1
+            if state.failures:
+                return self.__reply__(state.failures.pop(0), b"Injected failure")
+            user = state.tokens.get(token)
+            if user is None:
+                return self.__reply__(401, b"Invalid token")
+            path = url.path
+            if path == "/api/tunnels":
+                return self.__tunnels__(method, params, user)
+            if path == "/api/users/" and method == "POST":
+                state.users.setdefault(params["username"], {"is_admin": params.get("is-admin") == "on",
+                                                            "clients": {}})
+                return self.__reply__(200)
+            if path.startswith("/api/users/") and "/clients/" in path and method in ("PUT", "DELETE"):
+                owner, client_name = path[len("/api/users/"):].split("/clients/")
+                clients = state.users.setdefault(owner, {"is_admin": False, "clients": {}})["clients"]
+                if method == "PUT":
+                    clients[client_name] = {}
+                else:
+                    clients.pop(client_name, None)
+                return self.__reply__(200)
+            if path == "/api/tokens/" and method == "POST":
+                new_token = "token-%d" % len(state.tokens)
+                state.tokens[new_token] = params.get("owner", user)
+                return self.__reply__(200, new_token.encode())
+            if path == "/delete-user" and method == "POST":
+                state.users.pop(params.get("username"), None)
+                return self.__reply__(303)
+            if path == "/delete-token" and method == "GET":
+                state.tokens.pop(params.get("token"), None)
+                return self.__reply__(303)
+            return self.__reply__(405, b"Invalid method")
+
+    def __tunnels__(self, method: str, params: dict, user: str):
+        state = self.state
+        if method == "GET":
+            client_name = params.get("client-name", "")
+            return self.__reply__(200, {domain: info for domain, info in state.tunnels.items()
+                                        if client_name in ("", info["client_name"])})
+        if method == "POST":
+            domain = params.get("domain", "")
+            if not domain:
+                return self.__reply__(400, b"Invalid domain parameter")
+            state.tunnels[domain] = {
+                "domain": domain,
+                "owner": params.get("owner") or user,
+                "server_address": state.ssh_address,
+                "server_port": state.ssh_port,
+                "server_public_key": "",
+                "username": params.get("owner") or user,
+                "tunnel_port": free_port(),
+                "tunnel_private_key": state.next_tunnel_key(),
+                "client_name": params.get("client-name", "any"),
+                "client_address": params.get("client-addr", "127.0.0.1"),
+                "client_port": int(params.get("client-port", "0") or 0),
+                "allow_external_tcp": params.get("allow-external-tcp") == "on",
+                "tls_termination": params.get("tls-termination", "server"),
+            }
+            return self.__reply__(200)
+        if method == "DELETE":
+            state.tunnels.pop(params.get("domain", ""), None)
+            return self.__reply__(200)
+        return self.__reply__(405, b"Invalid method")
+
+
+class APIStubServer:
+    """Threaded boringproxy API stub, optionally served over TLS"""
+
+    def __init__(self, state: APIStubState = None, tls: bool = False):
+        self.state = state or APIStubState()
+        handler = type("BoundAPIStubHandler", (APIStubHandler,), {"state": self.state})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.cert_path = None
+        if tls:
+            self.cert_path, key_path = make_self_signed_cert()
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(self.cert_path, key_path)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def admin_domain(self) -> str:
+        """Value to pass to WebAPI as admin_domain"""
+        return "127.0.0.1:%d" % self.httpd.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class SSHStubInterface(paramiko.ServerInterface):
+    """Accepts any public key and tcpip-forward requests"""
+
+    def __init__(self, server, transport):
+        self.server = server
+        self.transport = transport
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_port_forward_request(self, address, port):
+        return self.server.open_listener(self.transport, address, port)
+
+    def cancel_port_forward_request(self, address, port):
+        self.server.close_listener(self.transport, port)
+
+
+class SSHStubServer:
+    """
+    Local paramiko ssh server supporting reverse port forwarding (tcpip-forward).
+    Forwarded ports are opened on 127.0.0.1 and every connection to them is sent
+    to the client as a forwarded-tcpip channel.
+    """
+
+    def __init__(self, port: int = 0, host_key: paramiko.PKey = None):
+        self.host_key = host_key or paramiko.ECDSAKey.generate()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        self.listeners = {}  # (transport, port) -> listening socket
+        self.handshakes = 0
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.__serve__, daemon=True).start()
+        return self
+
+    def __serve__(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            interface = SSHStubInterface(self, transport)
+            with self.lock:
+                self.transports.append(transport)
+                self.handshakes += 1
+            try:
+                transport.start_server(server=interface)
+            except Exception:
+                transport.close()
+                continue
+            threading.Thread(target=self.__reap__, args=(transport,), daemon=True).start()
+
+    def __reap__(self, transport):
+        """Closes forwarded ports of a transport once the client disconnects, like sshd does"""
+        transport.join()
+        with self.lock:
+            ports = [port for (owner, port) in self.listeners if owner is transport]
+        for port in ports:
+            self.close_listener(transport, port)
+
+    def open_listener(self, transport, address: str, port: int):
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listener.bind(("127.0.0.1", port))
+        except OSError:
+            listener.close()
+            return False
+        listener.listen(1024)
+        port = listener.getsockname()[1]
+        with self.lock:
+            self.listeners[(transport, port)] = listener
+        threading.Thread(target=self.__accept_forwarded__, args=(transport, listener, address, port),
+                         daemon=True).start()
+        return port
+
+    def close_listener(self, transport, port: int):
+        with self.lock:
+            listener = self.listeners.pop((transport, port), None)
+        if listener is not None:
+            _close_listener(listener)
+
+    def __accept_forwarded__(self, transport, listener, address: str, port: int):
+        while True:
+            try:
+                conn, origin = listener.accept()
+            except OSError:
+                return
+            try:
+                chan = transport.open_forwarded_tcpip_channel(origin, (address, port))
+            except Exception:
+                conn.close()
+                continue
+            threading.Thread(target=_pump, args=(conn, chan), daemon=True).start()
+
+    def stop(self):
+        """Kills the server: closes the listening socket, all forwarded ports and all ssh connections"""
+        self.running = False
+        _close_listener(self.sock)
+        with self.lock:
+            listeners, self.listeners = list(self.listeners.values()), {}
+            transports, self.transports = self.transports, []
+        for listener in listeners:
+            _close_listener(listener)
+        for transport in transports:
+            transport.close()
+
+
+def _close_listener(sock):
+    """Closes a listening socket and wakes up the thread blocked in accept()"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+def _pump(sock, chan):
+    """Copies data between a socket and a channel until one side closes"""
+    # selectors instead of select.select, which fails on descriptors above FD_SETSIZE (1024)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ, (sock, chan))
+    selector.register(chan, selectors.EVENT_READ, (chan, sock))
+    try:
+        while True:
+            for key, _ in selector.select():
+                source, target = key.data
+                data = source.recv(65536)
+                if not data:
+                    return
+                target.sendall(data)
+    except Exception:
+        pass
+    finally:
+        selector.close()
+        chan.close()
+        sock.close()
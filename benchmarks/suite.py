@@ -0,0 +1,288 @@
+"""
+Runs all benchmark scenarios against local stand-ins of the boringproxy server and writes JSON results.
+With --compare, the results are checked against a baseline file and the exit code is 1 on regressions.
+
+Metric names follow a convention used by the regression check:
+*_ms, *_s and *_failures are lower-is-better, *_mbps and *_per_s are higher-is-better,
+anything else is informational. Timing changes below NOISE_FLOOR are ignored.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from boringproxy_api import Client, ClientConfig, WebAPI
+from boringproxy_api.metrics import TunnelMetrics
+from import_time import measure as measure_imports
+from relay_throughput import run as run_relay, start_echo_server
+from stubs import APIStubServer, APIStubState, SSHStubServer, generate_private_key
+
+LOWER_IS_BETTER = ("_ms", "_s", "_failures")
+HIGHER_IS_BETTER = ("_mbps", "_per_s")
+# Timing changes below these absolute values are treated as noise
+NOISE_FLOOR = {"_ms": 0.5, "_s": 0.05}
+
+
+class Environment:
+    """Local API stub, ssh stub and echo server shared by the scenarios"""
+
+    def __init__(self):
+        self.ssh = SSHStubServer().start()
+        self.state = APIStubState(ssh_port=self.ssh.port, tunnel_private_key=generate_private_key())
+        self.api = APIStubServer(self.state, tls=True).start()
+        self.token = next(iter(self.state.tokens))
+        self.echo_port = start_echo_server()
+        self.tunnel_keys = []
+
+    def use_tunnel_keys(self, count: int):
+        """
+        Makes the API stub hand out a distinct key to each of the next count tunnels, like boringproxy does.
+        count 0 hands the shared key out to all tunnels
+        """
+        while len(self.tunnel_keys) < count:
+            self.tunnel_keys.append(generate_private_key())
+        with self.state.lock:
+            self.state.tunnel_keys = self.tunnel_keys[:count]
+            self.state.keys_handed_out = 0
+
+    def config(self, **options) -> ClientConfig:
+        config = ClientConfig()
+        config.admin_domain = self.api.admin_domain
+        config.token = self.token
+        config.verify = self.api.cert_path
+        for name, value in options.items():
+            setattr(config, name, value)
+        return config
+
+    def stop(self):
+        self.api.stop()
+        self.ssh.stop()
+
+
+def percentiles(latencies: list, prefix: str) -> dict:
+    latencies = sorted(latencies)
+    return {prefix + "_mean_ms": round(statistics.mean(latencies), 3),
+            prefix + "_p50_ms": round(latencies[len(latencies) // 2], 3),
+            prefix + "_p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 3)}
+
+
+def timed(call) -> float:
+    started = time.perf_counter()
+    call()
+    return (time.perf_counter() - started) * 1000
+
+
+def scenario_api_latency(env: Environment, args) -> dict:
+    """Latency of every WebAPI method, including the web UI delete-user and delete-token paths"""
+    web_api = WebAPI(env.api.admin_domain, token=env.token, verify=env.api.cert_path)
+    samples = {name: [] for name in ("get_tunnels", "add_tunnel", "delete_tunnel", "add_user", "delete_user",
+                                     "add_client", "delete_client", "add_token", "delete_token")}
+    for i in range(args.calls):
+        samples["get_tunnels"].append(timed(web_api.get_tunnels))
+        samples["add_tunnel"].append(timed(lambda: web_api.add_tunnel("lat%d" % i, client_name="bench")))
+        samples["delete_tunnel"].append(timed(lambda: web_api.delete_tunnel("lat%d" % i)))
+        samples["add_user"].append(timed(lambda: web_api.add_user("bench-user%d" % i)))
+        samples["delete_user"].append(timed(lambda: web_api.delete_user("bench-user%d" % i)))
+        samples["add_client"].append(timed(lambda: web_api.add_client(client_name="client%d" % i)))
+        samples["delete_client"].append(timed(lambda: web_api.delete_client(client_name="client%d" % i)))
+        token = []
+        samples["add_token"].append(timed(lambda: token.append(web_api.add_token())))
+        samples["delete_token"].append(timed(lambda: web_api.delete_token(token[0])))
+    web_api.close()
+    result = {"calls": args.calls}
+    for name, latencies in samples.items():
+        result.update(percentiles(latencies, name))
+    return result
+
+
+def bringup(env: Environment, args) -> dict:
+    """Time to register and start N tunnels with Client.open_tunnels and Client.start_all"""
+    env.state.tunnels.clear()
+    handshakes = env.ssh.handshakes
+    client = Client(env.config(auto_reconnect=False))
+    started = time.perf_counter()
+    opened = client.open_tunnels([{"subdomain": "up%d" % i, "client_port": env.echo_port}
+                                  for i in range(args.tunnels)])
+    registered = time.perf_counter()
+    started_results = client.start_all()
+    finished = time.perf_counter()
+    failures = sum(not result.ok for result in opened) + sum(not result.ok for result in started_results)
+    client.close_all_tunnels()
+    return {"tunnels": args.tunnels,
+            "register_s": round(registered - started, 3),
+            "start_s": round(finished - registered, 3),
+            "total_s": round(finished - started, 3),
+            "tunnels_per_s": round(args.tunnels / (finished - started), 1),
+            "ssh_handshakes": env.ssh.handshakes - handshakes,
+            "bringup_failures": failures}
+
+
+def scenario_tunnel_bringup(env: Environment, args) -> dict:
+    """Bring-up of N tunnels with a key per tunnel, as boringproxy hands them out: one ssh connection per tunnel"""
+    env.use_tunnel_keys(args.tunnels)
+    try:
+        return bringup(env, args)
+    finally:
+        env.use_tunnel_keys(0)
+
+
+def scenario_tunnel_bringup_shared_key(env: Environment, args) -> dict:
+    """Bring-up of N tunnels which all got the same key, so they share one ssh connection"""
+    return bringup(env, args)
+
+
+def scenario_relay_throughput(env: Environment, args) -> dict:
+    """Relay engine throughput between socketpair channels and the local echo server"""
+    metrics = TunnelMetrics("bench")
+    throughput = run_relay(64 * 1024, args.connections, args.megabytes, env.echo_port, metrics)
+    snapshot = metrics.snapshot()
+    return {"connections": args.connections, "megabytes_per_connection": args.megabytes,
+            "throughput_mbps": round(throughput, 1),
+            "connect_mean_ms": round(snapshot["connect_duration_sum"] * 1000
+                                     / max(1, snapshot["connect_duration_count"]), 3)}
+
+
+def scenario_connection_capacity(env: Environment, args) -> dict:
+    """Opens many concurrent connections through one tunnel over the ssh stub and keeps them open"""
+    env.state.tunnels.clear()
+    client = Client(env.config(auto_reconnect=False))
+    tunnel = client.open_tunnel("capacity", client_port=env.echo_port)
+    tunnel.start()
+    port = env.state.tunnels[tunnel.subdomain]["tunnel_port"]
+    conns, failures = [], 0
+    lock = threading.Lock()
+
+    def connect():
+        nonlocal failures
+        try:
+            conn = socket.create_connection(("127.0.0.1", port), timeout=30)
+            conn.sendall(b"ping")
+            if conn.recv(4) != b"ping":
+                raise OSError("Bad echo")
+            with lock:
+                conns.append(conn)
+        except OSError:
+            with lock:
+                failures += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=connect) for _ in range(args.concurrent)]
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+    elapsed = time.perf_counter() - started
+    active = tunnel.stats()["active_connections"]
+    for conn in conns:
+        conn.close()
+    client.close_all_tunnels()
+    return {"requested": args.concurrent, "established": len(conns), "active_in_relay": active,
+            "setup_s": round(elapsed, 3), "connections_per_s": round(len(conns) / elapsed, 1),
+            "connection_failures": failures}
+
+
+def scenario_import_time(env: Environment, args) -> dict:
+    """Import time of the package entry points in fresh interpreters, see import_time.py"""
+    result = {}
+    failures = 0
+    for name, measured in measure_imports(args.import_repeat).items():
+        result[name + "_import_ms"] = measured["ms"]
+        failures += len(measured["unexpected"])
+    result["heavy_import_failures"] = failures
+    return result
+
+
+SCENARIOS = {
+    "api_latency": scenario_api_latency,
+    "tunnel_bringup": scenario_tunnel_bringup,
+    "tunnel_bringup_shared_key": scenario_tunnel_bringup_shared_key,
+    "relay_throughput": scenario_relay_throughput,
+    "connection_capacity": scenario_connection_capacity,
+    "import_time": scenario_import_time,
+}
+
+
+def environment_info() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count()}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares directional metrics with the baseline
+    :return: list of regression descriptions
+    """
+    regressions = []
+    for scenario, metrics in results["scenarios"].items():
+        for name, value in metrics.items():
+            old = baseline.get("scenarios", {}).get(scenario, {}).get(name)
+            if not isinstance(old, (int, float)) or not isinstance(value, (int, float)):
+                continue
+            if name.endswith(HIGHER_IS_BETTER):  # Checked first, as *_per_s also ends with _s
+                if value < old * (1 - tolerance):
+                    regressions.append("%s.%s: %s -> %s" % (scenario, name, old, value))
+            elif name.endswith(LOWER_IS_BETTER):
+                # Failure counts regress on any increase, timings beyond the tolerance and the noise floor
+                if name.endswith("_failures"):
+                    limit = old
+                else:
+                    floor = next(floor for suffix, floor in NOISE_FLOOR.items() if name.endswith(suffix))
+                    limit = max(old * (1 + tolerance), old + floor)
+                if value > limit:
+                    regressions.append("%s.%s: %s -> %s" % (scenario, name, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="Baseline JSON results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown")
+    parser.add_argument("--calls", type=int, default=100, help="api_latency: calls of every method")
+    parser.add_argument("--tunnels", type=int, default=50, help="tunnel_bringup: number of tunnels")
+    parser.add_argument("--connections", type=int, default=4, help="relay_throughput: parallel connections")
+    parser.add_argument("--megabytes", type=int, default=32, help="relay_throughput: data per connection")
+    parser.add_argument("--concurrent", type=int, default=200, help="connection_capacity: connections")
+    parser.add_argument("--import-repeat", type=int, default=5, help="import_time: runs of every import")
+    args = parser.parse_args()
+
+    env = Environment()
+    results = {"environment": environment_info(), "scenarios": {}}
+    try:
+        for name in args.scenarios:
+            print("running %s..." % name, file=sys.stderr)
+            results["scenarios"][name] = SCENARIOS[name](env, args)
+    finally:
+        env.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION %s" % regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Memory used by listing a large number of tunnels: get_tunnels, which parses the whole response into dicts,
+vs the streamed iter_tunnels and get_tunnel.
+The API stub runs in a child process, so tracemalloc sees only the allocations of the client.
+"""
+import argparse
+import gc
+import multiprocessing
+import secrets
+import time
+import tracemalloc
+
+from boringproxy_api import WebAPI
+from stubs import APIStubServer, APIStubState
+
+
+def serve(tunnels: int, key_size: int, ready: multiprocessing.Queue, stop):
+    state = APIStubState()
+    stub = APIStubServer(state, tls=True)
+    for index in range(tunnels):
+        domain = "tunnel-%d.%s" % (index, stub.admin_domain)
+        state.tunnels[domain] = {
+            "domain": domain, "owner": "admin", "server_address": "127.0.0.1", "server_port": 22,
+            "server_public_key": "ssh-ed25519 " + "A" * 68, "username": "admin", "tunnel_port": 20000 + index,
+            "tunnel_private_key": secrets.token_urlsafe(key_size),  # Every tunnel has its own key
+            "client_name": "bench", "client_address": "127.0.0.1", "client_port": 8080 + index % 100,
+            "allow_external_tcp": False, "tls_termination": "server",
+        }
+    stub.httpd.handle_error = lambda request, client_address: None  # get_tunnel drops the rest of the list
+    stub.start()
+    ready.put((stub.admin_domain, next(iter(state.tokens)), stub.cert_path))
+    stop.wait()
+    stub.stop()
+
+
+def measure(name: str, func, keep: bool = False):
+    """
+    Prints the time of func, the peak of memory allocated while it runs and the memory still held by its result.
+    tracemalloc slows allocations down, so the time is measured by a separate untraced run
+    """
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    if not keep:
+        result = None
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("%-32s %7.3f s   peak %8.1f MB   retained %8.1f MB" % (name, elapsed, peak / 2 ** 20, retained / 2 ** 20))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tunnels", type=int, default=20000)
+    parser.add_argument("--key-size", type=int, default=1200, help="Random bytes in every tunnel private key")
+    args = parser.parse_args()
+
+    ready, stop = multiprocessing.Queue(), multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(args.tunnels, args.key_size, ready, stop), daemon=True)
+    server.start()
+    admin_domain, token, cert_path = ready.get()
+    web_api = WebAPI(admin_domain, token=token, verify=cert_path)
+    web_api.get_tunnels("bench")  # Warm up the TLS connection and imports
+    first, last = "tunnel-0", "tunnel-%d" % (args.tunnels - 1)
+    print("%d tunnels" % args.tunnels)
+    try:
+        measure("get_tunnels()[last]", lambda: web_api.get_tunnels("bench")[last + "." + admin_domain])
+        measure("get_tunnel(last)", lambda: web_api.get_tunnel(last, "bench"))
+        measure("get_tunnel(first)", lambda: web_api.get_tunnel(first, "bench"))
+        measure("count with iter_tunnels()", lambda: sum(1 for _ in web_api.iter_tunnels("bench")))
+        measure("get_tunnels(), kept", lambda: web_api.get_tunnels("bench"), keep=True)
+        measure("list(iter_tunnels()), kept", lambda: list(web_api.iter_tunnels("bench")), keep=True)
+    finally:
+        web_api.close()
+        stop.set()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Measures stop/start cycles of a Tunnel against local API and ssh stubs with and without the parsed-key cache"""
+import argparse
+import statistics
+import time
+
+from boringproxy_api import Client, ClientConfig
+from boringproxy_api.keys import get_key_cache
+from stubs import APIStubServer, APIStubState, SSHStubServer, generate_private_key
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cycles", type=int, default=20)
+    args = parser.parse_args()
+
+    ssh = SSHStubServer().start()
+    state = APIStubState(ssh_port=ssh.port, tunnel_private_key=generate_private_key())
+    stub = APIStubServer(state, tls=True).start()
+    config = ClientConfig()
+    config.admin_domain = stub.admin_domain
+    config.token = next(iter(state.tokens))
+    config.verify = stub.cert_path
+    config.share_transports = False
+    config.auto_reconnect = False
+    client = Client(config)
+    tunnel = client.open_tunnel("restart", client_port=1)
+    tunnel.start()
+
+    for cached in (False, True):
+        latencies = []
+        for _ in range(args.cycles):
+            if not cached:
+                get_key_cache().clear()
+            started = time.perf_counter()
+            tunnel.stop()
+            tunnel.start()
+            latencies.append((time.perf_counter() - started) * 1000)
+        print("%-8s stop+start: mean %7.2f ms  median %7.2f ms" % (
+            "cached" if cached else "uncached", statistics.mean(latencies), statistics.median(latencies)))
+    print("key cache:", get_key_cache().stats())
+    tunnel.stop()
+    stub.stop()
+    ssh.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Checks the incremental parsing of tunnel lists (JSONObjectStream, TunnelListParser)
+and the coalesced streamed lookups of WebAPI.find_tunnels against the local API stub:
+- every split of a document into two chunks, multi-byte UTF-8 and numbers cut at a chunk edge included
+- a null body, malformed and truncated documents
+- early stop with a domains filter
+- a lookup joining a shared request which was sent before its domain was registered
+Exits with 1 if a check fails.
+"""
+import json
+import sys
+import threading
+import time
+import traceback
+
+from boringproxy_api import WebAPI
+from boringproxy_api.tunnels import JSONObjectStream, TunnelListParser
+from stubs import APIStubServer, APIStubState
+
+DOCUMENT = json.dumps({
+    "a.example.com": {"domain": "a.example.com", "tunnel_port": 20001, "client_name": "cé",
+                      "server_public_key": "ключ \U0001f511", "ratio": -1.5e-3,
+                      "allow_external_tcp": False, "tls_termination": None},
+    "ü.example.com": {"domain": "ü.example.com", "tunnel_port": 123456789, "nested": {"x": [1, 2.25]}},
+    "b.example.com": {"domain": "b.example.com", "tunnel_port": -20003, "client_name": "other"},
+}, ensure_ascii=False, indent=1)
+
+
+def expect(condition, message: str):
+    if not condition:
+        raise AssertionError(message)
+
+
+def parse(chunks: list) -> list:
+    stream = JSONObjectStream()
+    members = []
+    for chunk in chunks:
+        members.extend(stream.feed(chunk))
+    return members + stream.close()
+
+
+def expect_error(chunks: list, name: str):
+    try:
+        members = parse(chunks)
+    except ValueError:
+        return
+    expect(False, "%s parsed as %r" % (name, members))
+
+
+def check_splits():
+    body = DOCUMENT.encode("utf-8")
+    expected = list(json.loads(DOCUMENT).items())
+    for cut in range(len(body) + 1):
+        members = parse([body[:cut], body[cut:]])
+        expect(members == expected, "split at byte %d: %r" % (cut, members))
+    members = parse([body[index:index + 1] for index in range(len(body))])
+    expect(members == expected, "byte by byte: %r" % members)
+    for cut in range(len(body) + 1):  # Records of the parser equal the parsed dicts wherever the body is cut
+        parser = TunnelListParser()
+        records = parser.feed(body[:cut]) + parser.feed(body[cut:]) + parser.close()
+        expect([record.to_dict() for record in records]
+               == [{name: value for name, value in info.items() if value is not None} for _, info in expected],
+               "records split at byte %d" % cut)
+
+
+def check_malformed():
+    for body in (b"null", b" null ", b"{}", b" { } "):
+        for cut in range(len(body) + 1):
+            expect(parse([body[:cut], body[cut:]]) == [], "%r split at %d" % (body, cut))
+    for body in (b"", b"nul", b'{"a": 1', b'{"a": ', b'{"a"', b'{"a": 1,', b"[1, 2]", b'{"a" 1}', b'{"a": 1 "b": 2}',
+                 b'{"a": 1}}', b'{"a": tru}', b'{a: 1}', b"{\"a\": \"\xff\"}", b'{"a": 1} null'):
+        expect_error([body], repr(body))
+        expect_error([body[:len(body) // 2], body[len(body) // 2:]], "%r split in half" % body)
+
+
+def check_early_stop():
+    body = DOCUMENT.encode("utf-8")
+    first_end = body.index(b"}") + 1  # End of the first tunnel
+    parser = TunnelListParser(domains={"a.example.com"})
+    records = parser.feed(body[:first_end + 1])
+    expect([record.domain for record in records] == ["a.example.com"], "filtered records: %r" % records)
+    expect(parser.done, "not done after the only wanted domain")
+    parser = TunnelListParser(domains={"a.example.com", "b.example.com"}, client_name="cé")
+    records = parser.feed(body) + parser.close()
+    expect([record.domain for record in records] == ["a.example.com"], "client filter: %r" % records)
+    expect(parser.done, "found domains of other clients must count as searched")
+    parser = TunnelListParser(domains={"missing.example.com"})
+    expect(parser.feed(body) + parser.close() == [] and not parser.done, "missing domain")
+
+
+def check_late_joiner():
+    state = APIStubState()
+    stub = APIStubServer(state, tls=True).start()
+    web_api = WebAPI(stub.admin_domain, token=next(iter(state.tokens)), verify=stub.cert_path)
+    try:
+        for name in ("first", "late"):
+            web_api.add_tunnel(name, client_name="check", client_port=8080)
+        reading, release = threading.Event(), threading.Event()
+        read_tunnels = web_api.__read_tunnels__
+
+        def held_read(data, parser, chunk_size=262144):
+            reading.set()  # The leader took the domains of this lookup
+            release.wait()
+            yield from read_tunnels(data, parser, chunk_size)
+
+        web_api.__read_tunnels__ = held_read
+        results = {}
+
+        def lookup(name):
+            results[name] = web_api.get_tunnel(name, "check")
+
+        started = state.requests_count
+        first = threading.Thread(target=lookup, args=("first",))
+        first.start()
+        expect(reading.wait(5), "the first lookup did not start")
+        shared = web_api.single_flight.shared
+        late = threading.Thread(target=lookup, args=("late",))
+        late.start()
+        deadline = time.monotonic() + 5
+        while web_api.single_flight.shared == shared and time.monotonic() < deadline:
+            time.sleep(0.001)
+        expect(web_api.single_flight.shared > shared, "the late lookup did not join the first one")
+        release.set()
+        first.join(5)
+        late.join(5)
+        for name in ("first", "late"):
+            info = results.get(name)
+            expect(info is not None and info["domain"] == name + "." + stub.admin_domain,
+                   "%s lookup returned %r" % (name, info))
+        sent = state.requests_count - started
+        expect(sent == 2, "%d requests sent, the late lookup needs exactly one more" % sent)
+        expect(not web_api.__lookup_domains__, "domains left registered: %r" % web_api.__lookup_domains__)
+    finally:
+        web_api.close()
+        stub.stop()
+
+
+CHECKS = (("splits", check_splits), ("malformed", check_malformed), ("early stop", check_early_stop),
+          ("late joiner", check_late_joiner))
+
+
+def main():
+    failed = False
+    for name, check in CHECKS:
+        try:
+            check()
+            print("%-12s ok" % name)
+        except Exception:
+            print("%-12s FAILED" % name)
+            traceback.print_exc()
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
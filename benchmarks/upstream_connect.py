@@ -0,0 +1,51 @@
+"""Compares short-lived relayed connections with fresh and pre-warmed upstream connects"""
+import argparse
+import socket
+import statistics
+import time
+
+from boringproxy_api.metrics import TunnelMetrics
+from boringproxy_api.relay import RelayEngine
+from boringproxy_api.upstream import Upstream
+from relay_throughput import start_echo_server
+
+
+def run(engine: RelayEngine, upstream: Upstream, requests: int):
+    """
+    Opens a channel per request, sends a small payload and waits for the echo
+    :return: (list of round trip times in ms, metrics snapshot)
+    """
+    metrics = TunnelMetrics(repr(upstream))
+    upstream.start()
+    time.sleep(0.2)  # Let the pool fill
+    latencies = []
+    for _ in range(requests):
+        chan, peer = socket.socketpair()
+        started = time.perf_counter()
+        engine.add_connection(chan, upstream, metrics)
+        peer.sendall(b"ping")
+        peer.recv(4)
+        latencies.append((time.perf_counter() - started) * 1000)
+        peer.close()
+    upstream.close()
+    return latencies, metrics.snapshot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--pool-size", type=int, default=16)
+    args = parser.parse_args()
+    port = start_echo_server()
+    engine = RelayEngine()
+    engine.start()
+    for pool_size in (0, args.pool_size):
+        latencies, snapshot = run(engine, Upstream(("127.0.0.1", port), pool_size=pool_size), args.requests)
+        print("pool %3d: round trip mean %6.3f ms  p99 %6.3f ms  connect mean %6.3f ms" % (
+            pool_size, statistics.mean(latencies), sorted(latencies)[int(len(latencies) * 0.99)],
+            snapshot["connect_duration_sum"] / max(1, snapshot["connect_duration_count"]) * 1000))
+    engine.stop()
+
+
+if __name__ == "__main__":
+    main()
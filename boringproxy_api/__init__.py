@@ -1,3 +1,62 @@
-from .client import Client, ClientConfig
-from .api import WebAPI
-from .ssh_tunnel import Tunnel
+"""
+Boring Proxy Server client and API wrapper.
+Exports are imported on first access, so `from boringproxy_api import WebAPI` does not load paramiko
+and requests is loaded only when the first API session is created.
+"""
+import importlib
+from typing import TYPE_CHECKING
+
+# Exported name -> module which defines it
+__lazy_exports__ = {
+    "Client": ".client",
+    "ClientConfig": ".config",
+    "TunnelResult": ".config",
+    "WebAPI": ".api",
+    "Tunnel": ".ssh_tunnel",
+    "RelayEngine": ".relay",
+    "RelayLimits": ".ratelimit",
+    "AsyncWebAPI": ".async_api",
+    "AsyncClient": ".async_client",
+    "AsyncTunnel": ".async_client",
+    "TunnelState": ".supervisor",
+    "TunnelSupervisor": ".supervisor",
+    "TransportManager": ".transport",
+    "MetricsRegistry": ".metrics",
+    "Upstream": ".upstream",
+    "UpstreamGroup": ".upstream",
+    "ShardedClient": ".sharding",
+    "Reconciler": ".reconciler",
+    "TunnelInfo": ".tunnels",
+}
+
+__all__ = list(__lazy_exports__)
+
+if TYPE_CHECKING:
+    from .client import Client
+    from .config import ClientConfig, TunnelResult
+    from .api import WebAPI
+    from .ssh_tunnel import Tunnel
+    from .relay import RelayEngine
+    from .ratelimit import RelayLimits
+    from .async_api import AsyncWebAPI
+    from .async_client import AsyncClient, AsyncTunnel
+    from .supervisor import TunnelState, TunnelSupervisor
+    from .transport import TransportManager
+    from .metrics import MetricsRegistry
+    from .upstream import Upstream, UpstreamGroup
+    from .sharding import ShardedClient
+    from .reconciler import Reconciler
+    from .tunnels import TunnelInfo
+
+
+def __getattr__(name: str):
+    module = __lazy_exports__.get(name)
+    if module is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value  # Next accesses don't go through __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,17 +1,175 @@
 """Boring Proxy Server HTTP API Wrapper"""
 import json
-import requests
-from .exceptions import MethodNotAllowed, get_exception
+import random
+import threading
+import time
+from contextlib import closing
+from .cache import SingleFlight, TTLCache
+from .exceptions import MethodNotAllowed, get_exception_by_status
+from .ratelimit import TokenBucket
+from .tunnels import TunnelListParser
+
+# Responses which are retried for idempotent methods, the server is overloaded or restarting
+RETRY_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "PUT", "DELETE")
 
 
 class WebAPI:
     """Boring Proxy Server HTTP API wrapper"""
 
-    def __init__(self, admin_domain, user="admin", token=""):
+    def __init__(self, admin_domain, user="admin", token="", pool_size=10, max_retries=3, timeout=30,
+                 session=None, tunnels_cache_ttl=0, tunnels_cache_size=128, verify=True,
+                 rate_limit=0, rate_burst=0, retry_backoff=0.1, max_backoff=10, coalesce_requests=True):
+        """
+        :param admin_domain: Boring Proxy Server admin domain
+        :param user: User name
+        :param token: Access token
+        :param pool_size: Max number of keep-alive connections kept in the pool
+        :param max_retries: Number of retries for failed connections and idempotent requests
+        :param timeout: Default timeout of every request in seconds (or a (connect, read) tuple)
+        :param session: Optional session to share with other objects
+        :param tunnels_cache_ttl: Lifetime of cached get_tunnels results in seconds. 0 disables the cache
+        :param tunnels_cache_size: Max number of cached get_tunnels results (one per client name)
+        :param verify: TLS certificate verification: True, False or a path to a CA bundle
+        :param rate_limit: Max number of requests per second sent to the server, retries included. 0 disables it
+        :param rate_burst: Number of requests which may be sent at once before the rate limit applies
+        :param retry_backoff: Base delay of retries in seconds. The delay doubles with every attempt
+        and is randomized, so clients which failed together don't retry together
+        :param max_backoff: Max delay of a retry in seconds, also caps the Retry-After header of the server
+        :param coalesce_requests: Concurrent identical GET requests share one request to the server
+        """
         self.__endpoint_url__ = "https://" + admin_domain + "/api/"
         self.__user__ = user
         self.__token__ = token
         self.admin_domain = admin_domain
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.verify = verify
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.session = session if session is not None else self.__create_session__()
+        self.tunnels_cache = TTLCache(tunnels_cache_ttl, tunnels_cache_size) if tunnels_cache_ttl > 0 else None
+        self.rate_limiter = TokenBucket(rate_limit, rate_burst) if rate_limit > 0 else None
+        self.single_flight = SingleFlight() if coalesce_requests else None
+        self.__writes__ = 0  # Completed state changing requests, reads never join a flight older than a write
+        self.__lookup_domains__ = {}  # Lookup key -> domains wanted by the callers of the next streamed lookup
+        self.__lookup_lock__ = threading.Lock()
+
+    def __create_session__(self):
+        """
+        Creates a keep-alive session with a connection pool, so API calls reuse TCP and TLS connections
+        :return: requests.Session
+        """
+        import requests  # Imported on the first use, so importing the package stays cheap
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        session = requests.Session()
+        # urllib3 retries only failed connections and reads. Statuses and Retry-After are retried by __request__,
+        # within max_backoff and the rate limit, stacking both would multiply the attempts and the delays
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                              max_retries=Retry(total=self.max_retries, status=0, respect_retry_after_header=False,
+                                                backoff_factor=0.1, redirect=False, raise_on_status=False))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def __then__(self, result, callback):
+        """
+        Passes the api_request result to the callback and returns the callback result
+        :param result: Value returned by api_request
+        :param callback: Callable which receives the result
+        """
+        return callback(result)
+
+    def __store_tunnels__(self, client_name: str, tunnels: dict) -> dict:
+        self.tunnels_cache.set(client_name, dict(tunnels))
+        return tunnels
+
+    def __on_tunnel_added__(self, client_name: str, result):
+        # The server generates keys and ports of the new tunnel, so the lists containing it are refetched
+        self.tunnels_cache.invalidate("", client_name)
+        return result
+
+    def __on_tunnel_deleted__(self, subdomain: str, result):
+        self.tunnels_cache.update_all(lambda tunnels: tunnels.pop(subdomain, None))
+        return result
+
+    def close(self):
+        """Closes all pooled connections"""
+        if self.session is not None:
+            self.session.close()
+
+    def __should_retry__(self, method: str, status_code: int, attempt: int) -> bool:
+        return attempt < self.max_retries and method in IDEMPOTENT_METHODS and status_code in RETRY_STATUSES
+
+    def __retry_delay__(self, attempt: int, retry_after) -> float:
+        """
+        Returns the delay before the next attempt: exponential backoff with full jitter,
+        but not less than the Retry-After header of the server
+        :param attempt: Number of the failed attempt, starting from 0
+        :param retry_after: Value of the Retry-After header or None
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.retry_backoff * 2 ** attempt))
+        try:
+            return max(delay, min(self.max_backoff, float(retry_after)))
+        except (TypeError, ValueError):  # No header or an HTTP date
+            return delay
+
+    def __request_url__(self, path: str, is_webui_hack: bool) -> str:
+        if is_webui_hack:  # TODO Remove this hack with normal API method when issue #56, #57 will be fixed
+            return "https://" + self.admin_domain + "/" + path
+        return self.__endpoint_url__ + path
+
+    def __coalescing_key__(self, method: str, url: str, params: dict, is_webui_hack: bool, kwargs: dict):
+        """
+        Returns the key under which identical requests are coalesced or None if the request must be sent anyway.
+        Only API reads are coalesced, web UI hacks change state even with GET
+        """
+        if self.single_flight is None or method != "GET" or is_webui_hack:
+            return None
+        return self.__writes__, url, repr(sorted(params.items())), repr(sorted(kwargs.items()))
+
+    def __parse_response__(self, status_code: int, body: bytes):
+        """
+        :param status_code: HTTP status of the response
+        :param body: Raw response body. The server sends UTF-8, decoding the bytes directly
+        skips the charset detection requests runs for Response.text
+        """
+        if status_code == 200:  # All ok
+            try:
+                return json.loads(body)
+            except ValueError:  # Not JSON or not UTF-8
+                return body.decode("utf-8", "replace")
+        elif status_code == 303:  # TODO Remove this hack with normal API method when issue #56, #57 will be fixed
+            return True
+        else:  # Error occurred
+            raise get_exception_by_status(status_code, body.decode("utf-8", "replace"))
+
+    def __request__(self, method: str, url: str, headers: dict, params: dict, kwargs: dict):
+        """
+        Sends the request, retrying idempotent methods on overload statuses
+        :return: requests.Response of the last attempt
+        """
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            data = self.session.request(url=url, headers=headers, params=params, method=method, **kwargs)
+            if not self.__should_retry__(method, data.status_code, attempt):
+                return data
+            data.close()
+            time.sleep(self.__retry_delay__(attempt, data.headers.get("Retry-After")))
+            attempt += 1
+
+    def __send__(self, method: str, url: str, headers: dict, params: dict, kwargs: dict) -> tuple:
+        """
+        Sends the request, see __request__
+        :return: (status code, response body bytes)
+        """
+        data = self.__request__(method, url, headers, params, kwargs)
+        return data.status_code, data.content
 
     def api_request(self, method: str, path: str, params: dict, is_webui_hack=False, **kwargs):
         """
@@ -25,41 +183,149 @@ class WebAPI:
         :return: JSON with server response
         :raises exceptions in .exceptions if something went wrong on the server
         """
+        if method not in ["GET", "POST", "DELETE", "PUT"]:
+            raise MethodNotAllowed("Invalid Method")
         headers = {"Authorization": "bearer " + self.__token__}
-        if method in ["GET", "POST", "DELETE", "PUT"]:
-            if is_webui_hack:  # TODO Remove this hack with normal API method when issue #56, #57 will be fixed
-                data = requests.request(url="https://" + self.admin_domain + "/" + path, headers=headers,
-                                        params=params,
-                                        method=method, allow_redirects=False, **kwargs)
-            else:
-                data = requests.request(url=self.__endpoint_url__ + path, headers=headers, params=params,
-                                        method=method, **kwargs)
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("verify", self.verify)
+        if is_webui_hack:
+            kwargs.setdefault("allow_redirects", False)
+        url = self.__request_url__(path, is_webui_hack)
+        key = self.__coalescing_key__(method, url, params, is_webui_hack, kwargs)
+        if key is None:
+            try:
+                status_code, body = self.__send__(method, url, headers, params, kwargs)
+            finally:
+                self.__writes__ += 1
         else:
-            raise MethodNotAllowed("Invalid Method")
+            # Every caller parses the shared body itself, so results are not shared mutable objects
+            status_code, body = self.single_flight.run(key, lambda: self.__send__(method, url, headers,
+                                                                                  params, kwargs))
+        return self.__parse_response__(status_code, body)
 
-        if data.status_code == 200:  # All ok
-            try:
-                return data.json()
-            except json.JSONDecodeError:
-                return data.text
-        elif data.status_code == 303:  # TODO Remove this hack with normal API method when issue #56, #57 will be fixed
-            return True
-        else:  # Error occurred
-            raise get_exception(data)
+    def __full_domain__(self, subdomain: str) -> str:
+        return subdomain + '.' + self.admin_domain if '.' + self.admin_domain not in subdomain else subdomain
+
+    def __tunnels_params__(self, client_name: str, kwargs: dict) -> dict:
+        if client_name != "":
+            params = {"client-name": client_name}
+        else:
+            params = {}
+        params.update(kwargs)
+        return params
+
+    def __tunnels_parser__(self, client_name: str, domains) -> TunnelListParser:
+        if isinstance(domains, str):
+            domains = [domains]
+        return TunnelListParser(None if domains is None else {self.__full_domain__(domain) for domain in domains},
+                                client_name)
 
     def get_tunnels(self, client_name="", **kwargs) -> dict:
         """
-        Gets a list of all tunnels for this client
+        Gets a list of all tunnels for this client.
+        Served from the tunnels cache if it is enabled and no extra parameters are given.
+        The whole list is kept in memory, see iter_tunnels and find_tunnels for large lists
         :param client_name: Client name
         :param kwargs: Other optional parameters for the method
         :return: JSON with server response
         """
-        if client_name != "":
-            params = {"client-name": client_name}
-        else:
-            params = {}
-        params.update(kwargs)
-        return self.api_request("GET", "tunnels", params)
+        params = self.__tunnels_params__(client_name, kwargs)
+        if self.tunnels_cache is None or kwargs:
+            return self.api_request("GET", "tunnels", params)
+        cached = self.tunnels_cache.get(client_name)
+        if cached is not None:
+            return self.__then__(cached, dict)
+        return self.__then__(self.api_request("GET", "tunnels", params),
+                             lambda tunnels: self.__store_tunnels__(client_name, tunnels))
+
+    def iter_tunnels(self, client_name="", domains=None, chunk_size=262144, **kwargs):
+        """
+        Streams the list of tunnels and yields them one by one as compact TunnelInfo records.
+        The response is parsed while it is received, so only the tunnel being parsed is kept in memory.
+        The request is sent when the iteration starts, it is never cached or coalesced.
+        :param client_name: Client name. Tunnels of other clients are skipped
+        :param domains: Subdomain or iterable of subdomains (or full domains) to yield, all tunnels by default.
+        Other tunnels are skipped without creating records and reading stops once all of them are found
+        :param chunk_size: Size of the chunks the response is read by, in bytes
+        :param kwargs: Other optional parameters for the method
+        :return: iterator of TunnelInfo
+        """
+        parser = self.__tunnels_parser__(client_name, domains)
+        yield from self.__read_tunnels__(self.__stream_tunnels__(client_name, kwargs), parser, chunk_size)
+
+    def __stream_tunnels__(self, client_name: str, kwargs: dict):
+        """
+        Sends the get_tunnels request without reading the body
+        :return: requests.Response
+        """
+        return self.__request__("GET", self.__request_url__("tunnels", False),
+                                {"Authorization": "bearer " + self.__token__},
+                                self.__tunnels_params__(client_name, kwargs),
+                                {"timeout": self.timeout, "verify": self.verify, "stream": True})
+
+    def __read_tunnels__(self, data, parser: TunnelListParser, chunk_size: int = 262144):
+        """Parses the streamed get_tunnels response and yields the selected TunnelInfo records"""
+        with closing(data):  # Dropping the rest of a large response is cheaper than reading it
+            if data.status_code != 200:
+                raise get_exception_by_status(data.status_code, data.content.decode("utf-8", "replace"))
+            for chunk in data.iter_content(chunk_size):
+                yield from parser.feed(chunk)
+                if parser.done:
+                    return
+            yield from parser.close()
+
+    def __lookup_key__(self, client_name: str, kwargs: dict):
+        """Returns the key under which concurrent streamed lookups are coalesced"""
+        return "find_tunnels", self.__writes__, repr(sorted(self.__tunnels_params__(client_name, kwargs).items()))
+
+    def __lookup__(self, key, client_name: str, kwargs: dict) -> tuple:
+        """
+        Streams the tunnel list once for all callers which registered their domains under the key
+        :return: (set of the searched domains, dict full domain -> TunnelInfo of the found ones)
+        """
+        try:
+            data = self.__stream_tunnels__(client_name, kwargs)
+        finally:
+            with self.__lookup_lock__:  # Callers arriving from now on wait for the next lookup
+                searched = self.__lookup_domains__.pop(key, set())
+        parser = self.__tunnels_parser__(client_name, searched)
+        return searched, {record.domain: record for record in self.__read_tunnels__(data, parser)}
+
+    def find_tunnels(self, domains, client_name="", **kwargs) -> dict:
+        """
+        Gets only the given tunnels.
+        Served from the tunnels cache if it is enabled and no extra parameters are given,
+        otherwise the list is streamed as in iter_tunnels. Concurrent lookups with the same client name
+        and parameters share one streamed request, which stops once the tunnels of all of them are found
+        :param domains: Iterable of subdomains or full domains
+        :param client_name: Client name
+        :param kwargs: Other optional parameters for the method
+        :return: dict of the found tunnels, full domain -> tunnel info
+        """
+        domains = [self.__full_domain__(domain) for domain in domains]
+        if self.tunnels_cache is not None and not kwargs:
+            return self.__then__(self.get_tunnels(client_name),
+                                 lambda tunnels: {domain: tunnels[domain] for domain in domains if domain in tunnels})
+        if self.single_flight is None:
+            return {record.domain: record.to_dict() for record in self.iter_tunnels(client_name, domains, **kwargs)}
+        while True:
+            key = self.__lookup_key__(client_name, kwargs)
+            with self.__lookup_lock__:
+                self.__lookup_domains__.setdefault(key, set()).update(domains)
+            searched, records = self.single_flight.run(key, lambda: self.__lookup__(key, client_name, kwargs))
+            if searched.issuperset(domains):  # Otherwise joined a lookup whose request was already sent
+                return {domain: records[domain].to_dict() for domain in domains if domain in records}
+
+    def get_tunnel(self, subdomain: str, client_name="", **kwargs):
+        """
+        Gets one tunnel, see find_tunnels
+        :param subdomain: Subdomain or full domain of the tunnel
+        :param client_name: Client name
+        :param kwargs: Other optional parameters for the method
+        :return: dict with the tunnel info or None if there is no such tunnel
+        """
+        return self.__then__(self.find_tunnels([subdomain], client_name, **kwargs),
+                             lambda tunnels: next(iter(tunnels.values()), None))
 
     def add_tunnel(self, subdomain: str,
                    owner="",
@@ -98,7 +364,10 @@ class WebAPI:
                   "tls-termination": tls_termination}
 
         params.update(kwargs)
-        self.api_request("POST", "tunnels", params)
+        result = self.api_request("POST", "tunnels", params)
+        if self.tunnels_cache is None:
+            return result
+        return self.__then__(result, lambda r: self.__on_tunnel_added__(client_name, r))
 
     def delete_tunnel(self, subdomain: str, **kwargs):
         """
@@ -111,7 +380,10 @@ class WebAPI:
             subdomain = subdomain + '.' + self.admin_domain
         params = {"domain": subdomain}
         params.update(kwargs)
-        self.api_request("DELETE", "tunnels", params)
+        result = self.api_request("DELETE", "tunnels", params)
+        if self.tunnels_cache is None:
+            return result
+        return self.__then__(result, lambda r: self.__on_tunnel_deleted__(subdomain, r))
 
     def add_user(self, username: str, is_admin=False, **kwargs):
         """
@@ -125,7 +397,7 @@ class WebAPI:
             raise ValueError("Username must be at least 6 characters")
         params = {"username": username, "is-admin": "on" if is_admin else "off"}
         params.update(kwargs)
-        self.api_request("POST", "users/", params)
+        return self.api_request("POST", "users/", params)
 
     def delete_user(self, username: str, **kwargs):
         """
@@ -137,7 +409,7 @@ class WebAPI:
         params = {"username": username}
         params.update(kwargs)
         # TODO Replace this hack with normal API method when issue #57 will be fixed
-        self.api_request("POST", "delete-user", params, is_webui_hack=True)
+        return self.api_request("POST", "delete-user", params, is_webui_hack=True)
 
     def add_client(self, owner: str = "", client_name: str = "python_api_client", **kwargs):
         """
@@ -148,8 +420,8 @@ class WebAPI:
         :return: JSON with server response
         """
         params = kwargs
-        self.api_request("PUT", "users/" + (self.__user__ if owner == "" else owner) + "/clients/" + client_name,
-                         params)
+        return self.api_request("PUT", "users/" + (self.__user__ if owner == "" else owner) + "/clients/" + client_name,
+                                params)
 
     def delete_client(self, owner: str = "", client_name: str = "python_api_client", **kwargs):
         """
@@ -160,9 +432,9 @@ class WebAPI:
         :return: JSON with server response
         """
         params = kwargs
-        self.api_request("DELETE",
-                         "users/" + (self.__user__ if owner == "" else owner) + "/clients/" + client_name,
-                         params)
+        return self.api_request("DELETE",
+                                "users/" + (self.__user__ if owner == "" else owner) + "/clients/" + client_name,
+                                params)
 
     def add_token(self, owner: str = "", **kwargs):
         """
@@ -185,4 +457,4 @@ class WebAPI:
         params = {"token": token}
         params.update(kwargs)
         # TODO Replace this hack with normal API method when issue #56 will be fixed
-        self.api_request("GET", "delete-token", params, is_webui_hack=True)
+        return self.api_request("GET", "delete-token", params, is_webui_hack=True)
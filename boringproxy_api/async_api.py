@@ -0,0 +1,227 @@
+"""Boring Proxy Server asyncio HTTP API Wrapper"""
+import asyncio
+import inspect
+import os
+
+from .api import WebAPI
+from .exceptions import MethodNotAllowed, get_exception_by_status
+
+
+class AsyncWebAPI(WebAPI):
+    """
+    Boring Proxy Server asyncio HTTP API wrapper.
+    Has the same methods as WebAPI, but every method returns a coroutine.
+    All requests share one keep-alive connection pool. Requires aiohttp.
+    """
+
+    def __init__(self, admin_domain, user="admin", token="", pool_size=100, timeout=30, session=None,
+                 tunnels_cache_ttl=0, tunnels_cache_size=128, max_retries=3, rate_limit=0, rate_burst=0,
+                 retry_backoff=0.1, max_backoff=10, coalesce_requests=True, verify=True):
+        """
+        :param admin_domain: Boring Proxy Server admin domain
+        :param user: User name
+        :param token: Access token
+        :param pool_size: Max number of simultaneously opened connections in the pool
+        :param timeout: Total timeout of every request in seconds (or a (connect, read) tuple as in WebAPI)
+        :param session: Optional aiohttp.ClientSession to share with other objects
+        :param tunnels_cache_ttl: Lifetime of cached get_tunnels results in seconds. 0 disables the cache
+        :param tunnels_cache_size: Max number of cached get_tunnels results (one per client name)
+        :param max_retries: Number of retries of idempotent requests answered with 429, 502, 503 or 504
+        :param rate_limit: Max number of requests per second sent to the server, retries included. 0 disables it
+        :param rate_burst: Number of requests which may be sent at once before the rate limit applies
+        :param retry_backoff: Base delay of retries in seconds, see WebAPI
+        :param max_backoff: Max delay of a retry in seconds
+        :param coalesce_requests: Concurrent identical GET requests share one request to the server
+        :param verify: TLS certificate verification: True, False or a path to a CA bundle (file or directory).
+        Ignored if a session is given, its connector decides
+        """
+        super().__init__(admin_domain, user, token, pool_size=pool_size, max_retries=max_retries, timeout=timeout,
+                         session=session, tunnels_cache_ttl=tunnels_cache_ttl, verify=verify,
+                         tunnels_cache_size=tunnels_cache_size, rate_limit=rate_limit, rate_burst=rate_burst,
+                         retry_backoff=retry_backoff, max_backoff=max_backoff, coalesce_requests=False)
+        self.__own_session__ = session is None
+        self.__coalesce__ = coalesce_requests
+        self.__in_flight__ = {}  # Coalescing key -> asyncio.Task of the shared request
+
+    def __create_session__(self):
+        return None  # aiohttp session must be created inside a running event loop, see get_session
+
+    def __then__(self, result, callback):
+        async def chain():
+            return callback(await result if inspect.isawaitable(result) else result)
+        return chain()
+
+    def __ssl_context__(self):
+        """
+        Converts verify to the ssl argument of aiohttp
+        :return: True, False or ssl.SSLContext trusting the given CA bundle
+        """
+        if isinstance(self.verify, bool):
+            return self.verify
+        import ssl
+        if os.path.isdir(self.verify):
+            return ssl.create_default_context(capath=self.verify)
+        return ssl.create_default_context(cafile=self.verify)
+
+    def get_session(self):
+        """
+        Returns the aiohttp session, creates it on the first call.
+        Must be called inside a running event loop.
+        :return: aiohttp.ClientSession
+        """
+        if self.session is None or self.session.closed:
+            try:
+                import aiohttp
+            except ImportError as e:
+                raise ImportError("AsyncWebAPI requires aiohttp. Install it with 'pip install aiohttp'") from e
+            if isinstance(self.timeout, tuple):
+                connect, read = self.timeout
+                timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read)
+            else:
+                timeout = aiohttp.ClientTimeout(total=self.timeout)
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size,
+                                                                                ssl=self.__ssl_context__()),
+                                                 timeout=timeout)
+            self.__own_session__ = True
+        return self.session
+
+    async def close(self):
+        """Closes the connection pool if it was created by this object"""
+        if self.__own_session__ and self.session is not None:
+            await self.session.close()
+        self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def __coalescing_key__(self, method: str, url: str, params: dict, is_webui_hack: bool, kwargs: dict):
+        if not self.__coalesce__ or method != "GET" or is_webui_hack:
+            return None
+        return self.__writes__, url, repr(sorted(params.items())), repr(sorted(kwargs.items()))
+
+    async def __request__(self, method: str, url: str, headers: dict, params: dict, kwargs: dict):
+        """
+        Sends the request, retrying idempotent methods on overload statuses
+        :return: aiohttp.ClientResponse of the last attempt, the caller releases it
+        """
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                delay = self.rate_limiter.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            data = await self.get_session().request(method, url, headers=headers, params=params, **kwargs)
+            if not self.__should_retry__(method, data.status, attempt):
+                return data
+            data.release()
+            await asyncio.sleep(self.__retry_delay__(attempt, data.headers.get("Retry-After")))
+            attempt += 1
+
+    async def __send__(self, method: str, url: str, headers: dict, params: dict, kwargs: dict) -> tuple:
+        data = await self.__request__(method, url, headers, params, kwargs)
+        try:
+            return data.status, await data.read()
+        finally:
+            data.release()
+
+    async def __run_coalesced__(self, key, func):
+        """
+        Awaits func() once for all concurrent callers with the same key.
+        func runs in its own task, so a cancelled caller cancels neither the shared request nor the other callers
+        :param func: Coroutine function without arguments
+        """
+        task = self.__in_flight__.get(key)
+        if task is None:
+            task = self.__in_flight__[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: self.__in_flight__.pop(key, None))
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())  # Retrieved if nobody waits
+        return await asyncio.shield(task)
+
+    async def api_request(self, method: str, path: str, params: dict, is_webui_hack=False, **kwargs):
+        """
+        Sends a request to the Boring Proxy Server API methods
+        :param method: Http request method
+        :param path: The path where to send the request
+        :param params: Parameters for sending
+        :param is_webui_hack: Defines the method used to send the request: to the official API
+        or to the web interface API if the method is not yet implemented in the official API
+        :param kwargs: Other parameters for the request function in the aiohttp library.
+        :return: JSON with server response
+        :raises exceptions in .exceptions if something went wrong on the server
+        """
+        headers = {"Authorization": "bearer " + self.__token__}
+        if method not in ["GET", "POST", "DELETE", "PUT"]:
+            raise MethodNotAllowed("Invalid Method")
+        if is_webui_hack:
+            kwargs.setdefault("allow_redirects", False)
+        url = self.__request_url__(path, is_webui_hack)
+        key = self.__coalescing_key__(method, url, params, is_webui_hack, kwargs)
+        if key is None:
+            try:
+                status_code, body = await self.__send__(method, url, headers, params, kwargs)
+            finally:
+                self.__writes__ += 1
+        else:
+            status_code, body = await self.__run_coalesced__(
+                key, lambda: self.__send__(method, url, headers, params, kwargs))
+        return self.__parse_response__(status_code, body)
+
+    async def iter_tunnels(self, client_name="", domains=None, chunk_size=262144, **kwargs):
+        """
+        Streams the list of tunnels, see WebAPI.iter_tunnels
+        :return: async iterator of TunnelInfo
+        """
+        parser = self.__tunnels_parser__(client_name, domains)
+        async for record in self.__read_tunnels__(await self.__stream_tunnels__(client_name, kwargs), parser,
+                                                  chunk_size):
+            yield record
+
+    async def __stream_tunnels__(self, client_name: str, kwargs: dict):
+        return await self.__request__("GET", self.__request_url__("tunnels", False),
+                                      {"Authorization": "bearer " + self.__token__},
+                                      self.__tunnels_params__(client_name, kwargs), {})
+
+    async def __read_tunnels__(self, data, parser, chunk_size: int = 262144):
+        try:
+            if data.status != 200:
+                raise get_exception_by_status(data.status, (await data.read()).decode("utf-8", "replace"))
+            async for chunk in data.content.iter_chunked(chunk_size):
+                for record in parser.feed(chunk):
+                    yield record
+                if parser.done:
+                    return
+            for record in parser.close():
+                yield record
+        finally:
+            data.close()  # Dropping the rest of a large response is cheaper than reading it
+
+    async def find_tunnels(self, domains, client_name="", **kwargs) -> dict:
+        """
+        Gets only the given tunnels, see WebAPI.find_tunnels
+        :return: dict of the found tunnels, full domain -> tunnel info
+        """
+        domains = [self.__full_domain__(domain) for domain in domains]
+        if self.tunnels_cache is not None and not kwargs:
+            tunnels = await self.get_tunnels(client_name)
+            return {domain: tunnels[domain] for domain in domains if domain in tunnels}
+        if not self.__coalesce__:
+            return {record.domain: record.to_dict()
+                    async for record in self.iter_tunnels(client_name, domains, **kwargs)}
+        while True:
+            key = self.__lookup_key__(client_name, kwargs)
+            self.__lookup_domains__.setdefault(key, set()).update(domains)
+            searched, records = await self.__run_coalesced__(key, lambda: self.__lookup__(key, client_name, kwargs))
+            if searched.issuperset(domains):  # Otherwise joined a lookup whose request was already sent
+                return {domain: records[domain].to_dict() for domain in domains if domain in records}
+
+    async def __lookup__(self, key, client_name: str, kwargs: dict) -> tuple:
+        """Streams the tunnel list once for all concurrent find_tunnels calls, see WebAPI.__lookup__"""
+        try:
+            data = await self.__stream_tunnels__(client_name, kwargs)
+        finally:
+            searched = self.__lookup_domains__.pop(key, set())  # Callers from now on wait for the next lookup
+        parser = self.__tunnels_parser__(client_name, searched)
+        return searched, {record.domain: record async for record in self.__read_tunnels__(data, parser)}
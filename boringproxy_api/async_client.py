@@ -0,0 +1,193 @@
+"""asyncio Client for Boring Proxy Server"""
+import asyncio
+
+from .async_api import AsyncWebAPI
+from .config import ClientConfig
+from .keys import load_private_key
+from .ratelimit import RelayLimits
+from .relay import RelayEngine, get_default_relay
+from .ssh_tunnel import SSHReverseTunnelForwarder
+from .upstream import Upstream
+
+
+class AsyncTunnel(SSHReverseTunnelForwarder):
+    """
+    SSHTunnelForwarder Wrapper to communicate with Boring Proxy API server from asyncio code.
+    Blocking ssh handshakes are run in the default executor.
+    """
+
+    def __init__(self, web_api: AsyncWebAPI, subdomain: str, ssh_key_id="", client_name="any",
+                 client_addr="127.0.0.1", client_port=5555, allow_external_tcp=False, password_protect=False,
+                 username="", password="", tls_termination="server", relay: RelayEngine = None,
+                 upstream: Upstream = None, limits: RelayLimits = None, **kwargs):
+        client_port = int(client_port) if isinstance(client_port, str) else client_port
+
+        self.__bp_web_api = web_api
+        self.__subdomain__ = subdomain + '.' + web_api.admin_domain \
+            if '.' + web_api.admin_domain not in subdomain else subdomain
+        self.__ssh_key_id__ = ssh_key_id
+        self.__client_name__ = client_name
+        self.__client_addr__ = client_addr
+        self.__client_port__ = client_port
+        self.__allow_external_tcp__ = allow_external_tcp
+        self.__password_protect__ = password_protect
+        self.__username__ = username
+        self.__password__ = password
+        self.__tls_termination__ = tls_termination
+        self.__relay__ = relay
+        self.__upstream__ = upstream
+        self.__limits__ = RelayLimits.from_value(limits)
+        self.__kwargs__ = kwargs
+        self.is_alive = False
+        self.tunnel_info = None
+        self.__forwarder_info__ = None
+
+    async def register(self):
+        """
+        Registers ssh tunnel in the boring proxy API server and prepares the forwarder
+        :return: Tunnel info returned by the server, kept in tunnel_info until stop()
+        """
+        tunnel_info = await self.__bp_web_api.get_tunnel(self.__subdomain__, self.__client_name__)
+        if tunnel_info is None:
+            await self.__bp_web_api.add_tunnel(self.__subdomain__,
+                                               ssh_key_id=self.__ssh_key_id__, client_name=self.__client_name__,
+                                               client_addr=self.__client_addr__,
+                                               client_port=self.__client_port__,
+                                               allow_external_tcp=self.__allow_external_tcp__,
+                                               password_protect=self.__password_protect__,
+                                               username=self.__username__,
+                                               password=self.__password__,
+                                               tls_termination=self.__tls_termination__, **self.__kwargs__)
+            tunnel_info = await self.__bp_web_api.get_tunnel(self.__subdomain__, self.__client_name__)
+        if tunnel_info is None:
+            raise KeyError("Tunnel %s is not registered on the server" % self.__subdomain__)
+        self.__setup_forwarder__(tunnel_info)
+        return tunnel_info
+
+    def __setup_forwarder__(self, tunnel_info: dict):
+        """
+        Initializes the ssh forwarder from the tunnel info, see Tunnel.__setup_forwarder__.
+        Nothing is done if the forwarder is already set up from the same info.
+        """
+        if tunnel_info == self.__forwarder_info__:
+            self.tunnel_info = tunnel_info
+            return
+        ssh_pkey = load_private_key(tunnel_info["tunnel_private_key"], self.__subdomain__)
+        super().__init__(hostname=tunnel_info["server_address"],
+                         port=tunnel_info["server_port"],
+                         username=tunnel_info["username"],
+                         pkey=ssh_pkey,
+                         server_port=tunnel_info["tunnel_port"],
+                         remote_host=self.__client_addr__,
+                         remote_port=self.__client_port__,
+                         relay=self.__relay__,
+                         upstream=self.__upstream__,
+                         limits=self.__limits__)
+        self.__upstream__ = self.upstream  # Keep pools and backend health across restarts
+        self.tunnel_info = self.__forwarder_info__ = tunnel_info
+
+    def set_limits(self, limits):
+        super().set_limits(limits)
+        self.__limits__ = self.limits  # Kept when the forwarder is set up again on restart
+
+    async def start(self, register=None):
+        """
+        Registers a tunnel with a boring proxy api and starts an ssh tunnel
+        :param register: If True, the tunnel info is always fetched from the server again.
+        By default, the tunnel info of register() is reused and the tunnel is registered
+        only after it was removed from the server by stop()
+        """
+        if register or self.tunnel_info is None:
+            await self.register()
+        else:
+            self.__setup_forwarder__(self.tunnel_info)
+        await asyncio.get_running_loop().run_in_executor(None, super().start)
+
+    async def stop(self):
+        """Stops the ssh tunnel and removes the tunnel from boring proxy api server"""
+        await asyncio.get_running_loop().run_in_executor(None, super().stop)
+        self.tunnel_info = None
+        await self.__bp_web_api.delete_tunnel(self.__subdomain__)
+
+
+class AsyncClient:
+    """
+    asyncio Client for Boring Proxy Server.
+    Use it as an async context manager or call start() and close() explicitly.
+    """
+
+    def __init__(self, config: ClientConfig, pool_size=100):
+        """
+        :param config: Client config
+        :param pool_size: Max number of simultaneously opened connections to the API server
+        """
+        self.__config__ = config
+        self.__bp_server_api__ = AsyncWebAPI(config.admin_domain, config.user, config.token, pool_size=pool_size,
+                                             timeout=config.timeout, max_retries=config.max_retries,
+                                             tunnels_cache_ttl=config.tunnels_cache_ttl,
+                                             tunnels_cache_size=config.tunnels_cache_size,
+                                             rate_limit=config.rate_limit, rate_burst=config.rate_burst,
+                                             verify=config.verify)
+        if config.relay_limits is not None:
+            get_default_relay().set_limits(config.relay_limits)
+        self.__all_opened_tunnels__ = {}  # Full tunnel domain -> AsyncTunnel
+
+    async def start(self):
+        """Registers this client on the server"""
+        await self.__bp_server_api__.add_client(client_name=self.__config__.client_name)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def get_all_opened_tunnels(self):
+        """
+        Returns all opened tunnels by this client
+        :return: list of AsyncTunnel objects
+        """
+        return list(self.__all_opened_tunnels__.values())
+
+    async def open_tunnel(self, subdomain: str, ssh_key_id="", client_addr="127.0.0.1",
+                          client_port=5555, allow_external_tcp=False, password_protect=False, username="",
+                          password="", tls_termination="server", **kwargs) -> AsyncTunnel:
+        """
+        Registers new tunnel and returns AsyncTunnel object
+        :return: AsyncTunnel object
+        """
+        client_port = int(client_port) if isinstance(client_port, str) else client_port
+        kwargs.setdefault("limits", self.__config__.tunnel_limits)
+        tunnel = AsyncTunnel(self.__bp_server_api__, subdomain, ssh_key_id, self.__config__.client_name,
+                             client_addr, client_port,
+                             allow_external_tcp, password_protect, username, password, tls_termination, **kwargs)
+        await tunnel.register()
+        self.__all_opened_tunnels__[tunnel.__subdomain__] = tunnel
+        return tunnel
+
+    async def close_tunnel(self, tunnel: AsyncTunnel):
+        """
+        Closes tunnel
+        :param tunnel: AsyncTunnel object
+        """
+        if tunnel.is_alive:
+            await tunnel.stop()
+        else:
+            await self.__bp_server_api__.delete_tunnel(tunnel.__subdomain__)
+        self.__all_opened_tunnels__.pop(tunnel.__subdomain__, None)
+        return True
+
+    async def close_all_tunnels(self):
+        """
+        Closes all opened tunnels by this client concurrently
+        """
+        await asyncio.gather(*[self.close_tunnel(tunnel) for tunnel in list(self.__all_opened_tunnels__.values())])
+
+    async def close(self):
+        """Closes all tunnels, unregisters the client and closes the connection pool"""
+        try:
+            await self.close_all_tunnels()
+            await self.__bp_server_api__.delete_client(client_name=self.__config__.client_name)
+        finally:
+            await self.__bp_server_api__.close()
@@ -0,0 +1,134 @@
+"""Small thread-safe caches used by the API wrappers"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Size bounded LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, ttl: float, max_size: int = 128):
+        """
+        :param ttl: Lifetime of an entry in seconds
+        :param max_size: Max number of entries, the least recently used entry is evicted first
+        """
+        if ttl <= 0 or max_size <= 0:
+            raise ValueError("TTL and size of the cache must be positive")
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries__ = OrderedDict()  # key -> (expires_at, value)
+        self.__lock__ = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value or default if there is no fresh entry for the key
+        """
+        with self.__lock__:
+            entry = self.__entries__.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.__entries__.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.__entries__[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Stores the value, evicting the least recently used entry if the cache is full"""
+        with self.__lock__:
+            self.__entries__[key] = (time.monotonic() + self.ttl, value)
+            self.__entries__.move_to_end(key)
+            while len(self.__entries__) > self.max_size:
+                self.__entries__.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        """Removes entries for the given keys"""
+        with self.__lock__:
+            for key in keys:
+                self.__entries__.pop(key, None)
+
+    def update_all(self, func):
+        """
+        Updates every cached value in place under the cache lock
+        :param func: Callable which receives a cached value
+        """
+        with self.__lock__:
+            for _, value in self.__entries__.values():
+                func(value)
+
+    def clear(self):
+        """Removes all entries"""
+        with self.__lock__:
+            self.__entries__.clear()
+
+    def __len__(self):
+        return len(self.__entries__)
+
+    def stats(self) -> dict:
+        """
+        Returns cache counters
+        :return: dict with hits, misses, evictions and current size
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": len(self.__entries__), "max_size": self.max_size, "ttl": self.ttl}
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs concurrent calls with the same key once, every caller gets the result of that single call"""
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self.__flights__ = {}  # key -> _Flight
+        self.__lock__ = threading.Lock()
+
+    def run(self, key, func):
+        """
+        Calls func, or waits for the call with the same key which is already in flight
+        :param key: Hashable key of the call
+        :param func: Callable without arguments
+        :return: Result of func. Exceptions of func are raised in every caller
+        """
+        with self.__lock__:
+            flight = self.__flights__.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.__flights__[key] = _Flight()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if leader:
+            try:
+                flight.result = func()
+            except BaseException as e:
+                flight.error = e
+            finally:
+                with self.__lock__:
+                    del self.__flights__[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stats(self) -> dict:
+        """
+        Returns counters
+        :return: dict with the number of executed calls and calls served by another in-flight call
+        """
+        return {"calls": self.calls, "shared": self.shared, "in_flight": len(self.__flights__)}
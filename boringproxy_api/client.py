@@ -1,33 +1,110 @@
 """Client for Boring Proxy Server"""
+import signal
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
 from .api import WebAPI
+from .config import ClientConfig, TunnelResult
+from .metrics import get_default_registry
+from .relay import get_default_relay
 from .ssh_tunnel import Tunnel
+from .supervisor import TunnelSupervisor
+from .transport import get_default_transport_manager
 
 
-class ClientConfig:
-    """Config for Client object"""
-    admin_domain = ""
-    user = "admin"
-    token = ""
-    client_name = "bp-python-client"
+# open_tunnel parameters used only by this process, they are not sent to the API server
+LOCAL_TUNNEL_OPTIONS = ("upstream", "limits")
 
 
 class Client:
     """
-    Client for Boring Proxy Server
+    Client for Boring Proxy Server.
+    Use it as a context manager or call close() explicitly, see also install_signal_handlers()
     """
 
-    def __init__(self, config: ClientConfig):
+    def __init__(self, config: ClientConfig, register_client: bool = True):
+        """
+        :param config: Client config
+        :param register_client: Add the client on the server now and delete it when the client is closed.
+        False if the client is managed by someone else, e.g. by ShardedClient for its workers
+        """
+        self.__closed__ = True  # Nothing to clean up until the client is fully set up
         self.__config__ = config
-        self.__bp_server_api__ = WebAPI(config.admin_domain, config.user, config.token)
-        self.__bp_server_api__.add_client(client_name=config.client_name)
-        self.__all_opened_tunnels__ = []
+        self.__register_client__ = register_client
+        self.__bp_server_api__ = WebAPI(config.admin_domain, config.user, config.token,
+                                        pool_size=config.pool_size, max_retries=config.max_retries,
+                                        timeout=config.timeout, tunnels_cache_ttl=config.tunnels_cache_ttl,
+                                        tunnels_cache_size=config.tunnels_cache_size, verify=config.verify,
+                                        rate_limit=config.rate_limit, rate_burst=config.rate_burst)
+        self.__transport_manager__ = get_default_transport_manager() if config.share_transports else None
+        self.__supervisor__ = TunnelSupervisor(keepalive_interval=config.keepalive_interval,
+                                               on_state_change=config.on_tunnel_state_change) \
+            if config.auto_reconnect else None
+        if config.relay_limits is not None:
+            get_default_relay().set_limits(config.relay_limits)
+        if register_client:
+            self.__bp_server_api__.add_client(client_name=config.client_name)
+        # Started last, nothing would stop the exporter if the client could not be registered
+        try:
+            self.__metrics_exporter__ = get_default_registry().start_exporter(config.metrics_port) \
+                if config.metrics_port else None
+        except Exception:
+            if register_client:
+                self.__bp_server_api__.delete_client(client_name=config.client_name)
+            raise
+        self.__all_opened_tunnels__ = {}  # Full tunnel domain -> Tunnel
+        self.__close_lock__ = threading.Lock()
+        self.__closing__ = False
+        self.__closed_event__ = threading.Event()
+        self.__previous_handlers__ = {}
+        self.__closed__ = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def closed(self) -> bool:
+        return self.__closed__
+
+    @property
+    def config(self) -> ClientConfig:
+        return self.__config__
+
+    @property
+    def web_api(self) -> WebAPI:
+        """WebAPI object (and its pooled session) shared by this client and all its tunnels"""
+        return self.__bp_server_api__
+
+    def stats(self) -> dict:
+        """
+        Returns traffic metrics of all opened tunnels together with relay and ssh transport load
+        :return: dict
+        """
+        return {"tunnels": {subdomain: tunnel.stats() for subdomain, tunnel in self.__all_opened_tunnels__.items()},
+                "relay": get_default_relay().stats(),
+                "transports": self.__transport_manager__.stats() if self.__transport_manager__ else None}
 
     def get_all_opened_tunnels(self):
         """
         Returns all opened tunnels by this client
         :return: list of Tunnels objects
         """
-        return self.__all_opened_tunnels__
+        return list(self.__all_opened_tunnels__.values())
+
+    def get_tunnel(self, subdomain: str):
+        """
+        Returns the opened tunnel with the given subdomain or full domain
+        :return: Tunnel object or None
+        """
+        admin_domain = self.__bp_server_api__.admin_domain
+        if '.' + admin_domain not in subdomain:
+            subdomain = subdomain + '.' + admin_domain
+        return self.__all_opened_tunnels__.get(subdomain)
 
     def open_tunnel(self, subdomain: str, ssh_key_id="", client_addr="127.0.0.1",
                     client_port=5555, allow_external_tcp=False, password_protect=False, username="", password="",
@@ -37,28 +114,201 @@ class Client:
         :return: Tunnel object
         """
         client_port = int(client_port) if isinstance(client_port, str) else client_port
+        kwargs.setdefault("limits", self.__config__.tunnel_limits)
         tunnel = Tunnel(self.__bp_server_api__, subdomain, ssh_key_id, self.__config__.client_name,
                         client_addr, client_port,
-                        allow_external_tcp, password_protect, username, password, tls_termination, **kwargs)
-        self.__all_opened_tunnels__.append(tunnel)
+                        allow_external_tcp, password_protect, username, password, tls_termination,
+                        transport_manager=self.__transport_manager__, supervisor=self.__supervisor__, **kwargs)
+        self.__all_opened_tunnels__[tunnel.subdomain] = tunnel
         return tunnel
 
-    def close_tunnel(self, tunnel: Tunnel):
+    def __run_bulk__(self, func, items: list, subdomains: list) -> list:
+        """
+        Runs func for every item in a bounded thread pool
+        :return: list of TunnelResult objects in the order of items
+        """
+        def call(item):
+            try:
+                return func(item), None
+            except Exception as e:
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.__config__.max_workers, len(items)))) as pool:
+            outcomes = list(pool.map(call, items)) if items else []
+        return [TunnelResult(subdomain, tunnel, error) for subdomain, (tunnel, error) in zip(subdomains, outcomes)]
+
+    def open_tunnels(self, specs: list, snapshot: dict = None) -> list:
         """
-        Closes tunnel
+        Registers many tunnels at once.
+        Looks the tunnels up with one find_tunnels call, adds the missing tunnels in parallel
+        and looks them up once more only if something was added.
+        :param specs: list of dicts with open_tunnel parameters, for example
+        [{"subdomain": "app", "client_port": 8080}, ...]
+        :param snapshot: Result of get_tunnels(client_name) the caller already has. Fetched by default
+        :return: list of TunnelResult objects in the order of specs
+        """
+        api = self.__bp_server_api__
+        client_name = self.__config__.client_name
+        specs = [dict(spec) for spec in specs]
+        subdomains = []
+        for spec in specs:
+            spec.setdefault("limits", self.__config__.tunnel_limits)
+            subdomain = spec["subdomain"]
+            spec["subdomain"] = subdomain + '.' + api.admin_domain \
+                if '.' + api.admin_domain not in subdomain else subdomain
+            subdomains.append(spec["subdomain"])
+
+        all_tunnels = snapshot if snapshot is not None else api.find_tunnels(subdomains, client_name)
+        missing = [spec for spec in specs if spec["subdomain"] not in all_tunnels]
+        add_errors = {}
+        if missing:
+            added = self.__run_bulk__(lambda spec: api.add_tunnel(client_name=client_name,
+                                                                  **{k: v for k, v in spec.items()
+                                                                     if k not in LOCAL_TUNNEL_OPTIONS}),
+                                      missing, [spec["subdomain"] for spec in missing])
+            add_errors = {result.subdomain: result.error for result in added if not result.ok}
+            all_tunnels = api.find_tunnels(subdomains, client_name)
+
+        def create(spec):
+            if spec["subdomain"] in add_errors:
+                raise add_errors[spec["subdomain"]]
+            if spec["subdomain"] not in all_tunnels:
+                raise KeyError("Tunnel %s is not registered on the server" % spec["subdomain"])
+            return Tunnel(api, client_name=client_name, tunnel_info=all_tunnels[spec["subdomain"]],
+                          transport_manager=self.__transport_manager__, supervisor=self.__supervisor__, **spec)
+
+        results = self.__run_bulk__(create, specs, subdomains)
+        self.__all_opened_tunnels__.update((result.subdomain, result.tunnel) for result in results if result.ok)
+        return results
+
+    def start_all(self, tunnels: list = None) -> list:
+        """
+        Starts ssh tunnels in parallel, reusing the tunnel info received on registration
+        :param tunnels: Tunnels to start. All opened and not started tunnels by default
+        :return: list of TunnelResult objects
+        """
+        if tunnels is None:
+            tunnels = [tunnel for tunnel in self.__all_opened_tunnels__.values() if not tunnel.is_alive]
+
+        def start(tunnel):
+            tunnel.start(register=False)
+            return tunnel
+
+        return self.__run_bulk__(start, tunnels, [tunnel.subdomain for tunnel in tunnels])
+
+    def __drain_timeout__(self, drain_timeout) -> float:
+        return self.__config__.drain_timeout if drain_timeout is None else drain_timeout
+
+    def close_tunnel(self, tunnel: Tunnel, drain_timeout: float = None):
+        """
+        Closes tunnel. A tunnel which was opened but not started is only removed from the server
         :param tunnel: Tunnel object
+        :param drain_timeout: Seconds active connections may take to finish, config.drain_timeout by default
         """
-        tunnel.stop()
-        self.__all_opened_tunnels__.remove(tunnel)
+        self.__stop_tunnel__(tunnel, self.__drain_timeout__(drain_timeout))
+        self.__all_opened_tunnels__.pop(tunnel.subdomain, None)
         return True
 
-    def close_all_tunnels(self):
+    def __stop_tunnel__(self, tunnel: Tunnel, drain_timeout: float = 0) -> Tunnel:
+        if tunnel.is_alive:
+            tunnel.stop(drain_timeout)
+        else:
+            self.__bp_server_api__.delete_tunnel(tunnel.subdomain)
+        return tunnel
+
+    def drain_all(self, timeout: float) -> bool:
+        """
+        Stops accepting connections on all tunnels and waits for the active ones to finish.
+        All tunnels share one deadline. The tunnels stay registered until they are closed
+        :param timeout: Max wait in seconds
+        :return: True if all connections finished in time
+        """
+        tunnels = [tunnel for tunnel in self.__all_opened_tunnels__.values() if tunnel.is_alive]
+        self.__run_bulk__(lambda tunnel: tunnel.begin_drain(), tunnels, [tunnel.subdomain for tunnel in tunnels])
+        deadline = time.monotonic() + timeout
+        return all(tunnel.wait_drained(deadline - time.monotonic()) for tunnel in tunnels)
+
+    def close_all_tunnels(self, drain_timeout: float = None) -> list:
+        """
+        Closes all opened tunnels by this client in parallel
+        :param drain_timeout: Seconds active connections may take to finish, config.drain_timeout by default.
+        New connections are refused on all tunnels at once and the deadline is shared by all of them
+        :return: list of TunnelResult objects. Tunnels which failed to close stay in the opened tunnels list
+        """
+        drain_timeout = self.__drain_timeout__(drain_timeout)
+        if drain_timeout > 0:
+            self.drain_all(drain_timeout)
+        tunnels = list(self.__all_opened_tunnels__.values())
+        results = self.__run_bulk__(self.__stop_tunnel__, tunnels, [tunnel.subdomain for tunnel in tunnels])
+        for result in results:
+            if result.ok:
+                self.__all_opened_tunnels__.pop(result.subdomain, None)
+        return results
+
+    def close(self, drain_timeout: float = None) -> list:
+        """
+        Drains and closes all tunnels, deletes the client from the server, stops the reconnect supervisor
+        and releases the API connections.
+        Calling it again does nothing, a concurrent call waits until the first one is done
+        :param drain_timeout: Seconds active connections may take to finish, config.drain_timeout by default
+        :return: list of TunnelResult objects of the closed tunnels
         """
-        Closes all opened tunnels by this client
+        with self.__close_lock__:
+            closing, self.__closing__ = self.__closing__, True
+        if closing:
+            self.__closed_event__.wait()
+            return []
+        try:
+            results = self.close_all_tunnels(drain_timeout)
+            if self.__register_client__:
+                self.__bp_server_api__.delete_client(client_name=self.__config__.client_name)
+        finally:
+            self.__bp_server_api__.close()
+            if self.__supervisor__ is not None:
+                self.__supervisor__.stop()
+            if self.__metrics_exporter__ is not None:
+                self.__metrics_exporter__.stop()
+            self.__closed__ = True
+            self.__closed_event__.set()
+        return results
+
+    def wait_closed(self, timeout: float = None) -> bool:
         """
-        list(map(self.close_tunnel, self.__all_opened_tunnels__))
+        Blocks until the client is closed, e.g. by a signal handler installed with install_signal_handlers()
+        :param timeout: Max wait in seconds, forever by default
+        :return: True if the client is closed
+        """
+        return self.__closed_event__.wait(timeout)
+
+    def install_signal_handlers(self, signals: tuple = (signal.SIGTERM, signal.SIGINT), drain_timeout: float = None):
+        """
+        Closes the client with draining when one of the signals arrives. Must be called from the main thread.
+        The previous handlers are restored on the first signal, so a second one stops the process as usual
+        :param signals: Signals which trigger the shutdown
+        :param drain_timeout: Seconds active connections may take to finish, config.drain_timeout by default
+        """
+        def handle(signum, frame):
+            for restored, handler in self.__previous_handlers__.items():
+                signal.signal(restored, handler)
+            self.__previous_handlers__.clear()
+            # Closing blocks, so it runs outside of the handler. The thread is not a daemon,
+            # the interpreter waits for the shutdown even if the main thread returns
+            threading.Thread(target=self.close, args=(drain_timeout,), name="bp-client-shutdown").start()
+
+        for signum in signals:
+            self.__previous_handlers__[signum] = signal.signal(signum, handle)
 
     def __del__(self):
-        self.close_all_tunnels()
-        self.__bp_server_api__.delete_client(client_name=self.__config__.client_name)
-        del self.__bp_server_api__, self.__all_opened_tunnels__, self
+        # Finalizers run at an unpredictable time, so only local resources are released here.
+        # The tunnels and the client stay registered on the server, unregistering is the job of close()
+        if getattr(self, "__closed__", True):
+            return
+        warnings.warn("Client %r was not closed" % self.__config__.client_name, ResourceWarning, source=self)
+        try:
+            self.__bp_server_api__.close()
+            if self.__supervisor__ is not None:
+                self.__supervisor__.stop(0)
+            if self.__metrics_exporter__ is not None:
+                self.__metrics_exporter__.stop()
+        except Exception:
+            pass
@@ -0,0 +1,49 @@
+"""Client config and results of bulk operations, importable without the ssh and http dependencies"""
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .ssh_tunnel import Tunnel
+
+
+class ClientConfig:
+    """Config for Client object"""
+    admin_domain = ""
+    user = "admin"
+    token = ""
+    client_name = "bp-python-client"
+    pool_size = 10  # Max number of keep-alive connections to the API server
+    max_retries = 3  # Retries for failed connections and idempotent API requests
+    timeout = 30  # Timeout of API requests in seconds
+    rate_limit = 0  # Max number of API requests per second, 0 disables the limit
+    rate_burst = 0  # Number of API requests sent at once before the rate limit applies, defaults to rate_limit
+    tunnels_cache_ttl = 0  # Lifetime of cached tunnel lists in seconds, 0 disables the cache
+    tunnels_cache_size = 128  # Max number of cached tunnel lists
+    verify = True  # TLS certificate verification of API requests: True, False or a path to a CA bundle
+    max_workers = 16  # Max number of threads used by bulk tunnel operations
+    share_transports = True  # Tunnels with the same server and key share one ssh connection
+    auto_reconnect = True  # Reconnect dropped ssh connections with exponential backoff
+    keepalive_interval = 15  # Ssh keepalive interval in seconds used to detect dead connections
+    on_tunnel_state_change = None  # Optional callable(tunnel, old_state, new_state), see TunnelState
+    metrics_port = 0  # Serve Prometheus metrics on http://127.0.0.1:metrics_port/metrics, 0 disables it
+    drain_timeout = 0  # Seconds closed tunnels let active connections finish, 0 cuts them off at once
+    # Limits of every tunnel as a dict of RelayLimits parameters, e.g. {"bytes_per_second": 1e6, "max_connections": 50}.
+    # Every tunnel gets its own limits, open_tunnel(limits=...) overrides them
+    tunnel_limits = None
+    relay_limits = None  # Global limits of all tunnels of the process as a dict of RelayLimits parameters
+
+
+class TunnelResult:
+    """Result of a bulk operation for one tunnel"""
+    __slots__ = ("subdomain", "tunnel", "error")
+
+    def __init__(self, subdomain: str, tunnel: "Tunnel" = None, error: Exception = None):
+        self.subdomain = subdomain
+        self.tunnel = tunnel
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        return "TunnelResult(%r, %s)" % (self.subdomain, "ok" if self.ok else repr(self.error))
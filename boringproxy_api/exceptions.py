@@ -1,48 +1,105 @@
 """Boring Proxy all possible API exceptions"""
-import requests
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    import requests
 
-def get_exception(response: requests.Response):
+
+def get_exception(response: "requests.Response"):
     """
     Initializes the desired error
     :param response: requests response
     :return: Exception
     """
-    return {
-        401: TokenError(response.text),
-        403: AuthError(response.text),
-        405: MethodNotAllowed(response.text),
-        406: MethodNotAllowed(response.text),  # TODO Remove it when issue #54 will be fixed
-        400: BadRequest(response.text),
-        500: ServerError(response.text)
-    }[response.status_code]
+    return get_exception_by_status(response.status_code, response.text)
 
 
-class TokenError(Exception):
-    """Token Error Exception"""
-    def __init__(self, *args):
+def get_exception_by_status(status_code: int, text: str):
+    """
+    Initializes the desired error by the response status code.
+    Unknown 5xx statuses become ServerError, any other unknown status becomes APIError
+    :param status_code: HTTP status code of the response
+    :param text: Response body
+    :return: Exception
+    """
+    exception = {
+        401: TokenError,
+        403: AuthError,
+        404: NotFound,
+        405: MethodNotAllowed,
+        406: MethodNotAllowed,  # TODO Remove it when issue #54 will be fixed
+        400: BadRequest,
+        429: TooManyRequests,
+        500: ServerError,
+        502: BadGateway,
+        503: ServiceUnavailable,
+        504: GatewayTimeout
+    }.get(status_code, ServerError if status_code >= 500 else APIError)
+    return exception(text, status_code=status_code)
+
+
+class APIError(Exception):
+    """Base class of all API errors"""
+    def __init__(self, *args, status_code: int = None):
         super().__init__(*args)
+        self.status_code = status_code
+
+
+class TokenError(APIError):
+    """Token Error Exception"""
+    def __init__(self, *args, status_code: int = 401):
+        super().__init__(*args, status_code=status_code)
 
 
-class AuthError(Exception):
+class AuthError(APIError):
     """Auth Error Exception"""
-    def __init__(self, *args):
-        super().__init__(*args)
+    def __init__(self, *args, status_code: int = 403):
+        super().__init__(*args, status_code=status_code)
+
 
+class NotFound(APIError):
+    """Not Found Exception"""
+    def __init__(self, *args, status_code: int = 404):
+        super().__init__(*args, status_code=status_code)
 
-class MethodNotAllowed(Exception):
+
+class MethodNotAllowed(APIError):
     """Method Not Allowed Exception"""
-    def __init__(self, *args):
-        super().__init__(*args)
+    def __init__(self, *args, status_code: int = 405):
+        super().__init__(*args, status_code=status_code)
 
 
-class BadRequest(Exception):
+class BadRequest(APIError):
     """Bad Request Exception"""
-    def __init__(self, *args):
-        super().__init__(*args)
+    def __init__(self, *args, status_code: int = 400):
+        super().__init__(*args, status_code=status_code)
 
 
-class ServerError(Exception):
+class TooManyRequests(APIError):
+    """Too Many Requests Exception, the server rate limit was hit"""
+    def __init__(self, *args, status_code: int = 429):
+        super().__init__(*args, status_code=status_code)
+
+
+class ServerError(APIError):
     """Server Error Exception"""
-    def __init__(self, *args):
-        super().__init__(*args)
+    def __init__(self, *args, status_code: int = 500):
+        super().__init__(*args, status_code=status_code)
+
+
+class BadGateway(ServerError):
+    """Bad Gateway Exception, usually the server is restarting behind a proxy"""
+    def __init__(self, *args, status_code: int = 502):
+        super().__init__(*args, status_code=status_code)
+
+
+class ServiceUnavailable(ServerError):
+    """Service Unavailable Exception"""
+    def __init__(self, *args, status_code: int = 503):
+        super().__init__(*args, status_code=status_code)
+
+
+class GatewayTimeout(ServerError):
+    """Gateway Timeout Exception"""
+    def __init__(self, *args, status_code: int = 504):
+        super().__init__(*args, status_code=status_code)
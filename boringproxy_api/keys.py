@@ -0,0 +1,72 @@
+"""Parsing and caching of tunnel private keys"""
+import hashlib
+import threading
+from io import StringIO
+
+from paramiko import ECDSAKey, Ed25519Key, PKey, RSAKey, SSHException
+
+from .cache import TTLCache
+
+# Key classes to try for every PEM header, the most likely class first
+KEY_CLASSES = {
+    "RSA": (RSAKey,),
+    "EC": (ECDSAKey,),
+    "OPENSSH": (Ed25519Key, ECDSAKey, RSAKey),
+}
+
+__key_cache__ = TTLCache(ttl=3600, max_size=1024)
+__key_cache_lock__ = threading.Lock()
+__key_parse_locks__ = {}  # Cache key -> lock held while the key is parsed, guarded by __key_cache_lock__
+
+
+def parse_private_key(private_key: str) -> PKey:
+    """
+    Parses a PEM or OpenSSH encoded RSA, ECDSA or Ed25519 private key
+    :param private_key: Key text as returned by the boring proxy API server
+    :return: paramiko PKey
+    :raises paramiko.SSHException if the key is not supported
+    """
+    header = private_key.lstrip().split("\n", 1)[0]
+    classes = next((classes for kind, classes in KEY_CLASSES.items() if "BEGIN %s PRIVATE KEY" % kind in header),
+                   (RSAKey, ECDSAKey, Ed25519Key))
+    error = None
+    for key_class in classes:
+        try:
+            return key_class.from_private_key(StringIO(private_key))
+        except (SSHException, ValueError) as e:
+            error = e
+    raise SSHException("Unsupported private key: %s" % error)
+
+
+def load_private_key(private_key: str, tunnel: str = "") -> PKey:
+    """
+    Returns the parsed key from the cache, parsing it only on the first use.
+    Restarts and reconnects of a tunnel therefore skip the expensive key parsing.
+    :param private_key: Key text as returned by the boring proxy API server
+    :param tunnel: Tunnel name, part of the cache key
+    :return: paramiko PKey
+    """
+    cache_key = (tunnel, hashlib.sha256(private_key.encode()).digest())
+    pkey = __key_cache__.get(cache_key)
+    if pkey is None:
+        # Parallel starts of one tunnel parse its key once, different keys are parsed in parallel
+        with __key_cache_lock__:
+            parse_lock = __key_parse_locks__.setdefault(cache_key, threading.Lock())
+        with parse_lock:
+            pkey = __key_cache__.get(cache_key)
+            if pkey is None:
+                try:
+                    pkey = parse_private_key(private_key)
+                    __key_cache__.set(cache_key, pkey)
+                finally:
+                    with __key_cache_lock__:
+                        __key_parse_locks__.pop(cache_key, None)
+    return pkey
+
+
+def get_key_cache() -> TTLCache:
+    """
+    Returns the process-wide cache of parsed keys, e.g. to read its hit/miss counters
+    :return: TTLCache object
+    """
+    return __key_cache__
@@ -0,0 +1,240 @@
+"""Traffic metrics of tunnels and an optional Prometheus text exporter"""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of connection duration histogram buckets in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+# Upper bounds of connect latency histogram buckets in seconds
+CONNECT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    """Fixed buckets histogram. Must be written by one thread only"""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple = DURATION_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsShard:
+    """
+    Counters of one tunnel written by a single relay worker thread.
+    Every worker owns its shard, so the relay loop updates counters without locking.
+    """
+    __slots__ = ("bytes_in", "bytes_out", "connections", "closed_connections", "connect_failures",
+                 "connect_timeouts", "rejected_connections", "throttled_connections", "durations",
+                 "connect_durations")
+
+    def __init__(self):
+        self.bytes_in = 0  # Bytes received from the ssh channel and sent to the local service
+        self.bytes_out = 0  # Bytes received from the local service and sent to the ssh channel
+        self.connections = 0
+        self.closed_connections = 0
+        self.connect_failures = 0  # Including timeouts
+        self.connect_timeouts = 0
+        self.rejected_connections = 0  # Closed at once, over the connection limits
+        self.throttled_connections = 0  # Paused at least once by a byte rate limit
+        self.durations = Histogram()  # Relay time of connections, from the established connect to close
+        self.connect_durations = Histogram(CONNECT_BUCKETS)  # Connect latency to the local service
+
+
+class TunnelMetrics:
+    """Traffic metrics of one tunnel, aggregated from the shards of all relay workers"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.__shards__ = {}
+        self.__lock__ = threading.Lock()
+
+    def shard(self, index: int) -> MetricsShard:
+        """
+        Returns the shard of the relay worker with the given index, creating it on first use
+        :param index: Relay worker index
+        """
+        shard = self.__shards__.get(index)
+        if shard is None:
+            with self.__lock__:
+                shard = self.__shards__.setdefault(index, MetricsShard())
+        return shard
+
+    def snapshot(self) -> dict:
+        """
+        Sums counters of all shards
+        :return: dict with traffic counters, the relay time and the connect latency histograms
+        """
+        with self.__lock__:
+            shards = list(self.__shards__.values())
+        result = {"bytes_in": 0, "bytes_out": 0, "connections": 0, "closed_connections": 0,
+                  "connect_failures": 0, "connect_timeouts": 0, "rejected_connections": 0,
+                  "throttled_connections": 0}
+        for shard in shards:
+            result["bytes_in"] += shard.bytes_in
+            result["bytes_out"] += shard.bytes_out
+            result["connections"] += shard.connections
+            result["closed_connections"] += shard.closed_connections
+            result["connect_failures"] += shard.connect_failures
+            result["connect_timeouts"] += shard.connect_timeouts
+            result["rejected_connections"] += shard.rejected_connections
+            result["throttled_connections"] += shard.throttled_connections
+        result["active_connections"] = result["connections"] - result["closed_connections"]
+        for prefix, bounds, histograms in (("duration", DURATION_BUCKETS, [s.durations for s in shards]),
+                                           ("connect_duration", CONNECT_BUCKETS,
+                                            [s.connect_durations for s in shards])):
+            counts = [0] * (len(bounds) + 1)
+            for histogram in histograms:
+                for i, count in enumerate(histogram.counts):
+                    counts[i] += count
+            result[prefix + "_sum"] = sum(histogram.sum for histogram in histograms)
+            result[prefix + "_count"] = sum(counts)
+            result[prefix + "_buckets"] = dict(zip(bounds + (float("inf"),), counts))
+        return result
+
+
+class MetricsRegistry:
+    """Collection of metrics of all tunnels"""
+
+    def __init__(self):
+        self.__tunnels__ = {}
+        self.__lock__ = threading.Lock()
+
+    def tunnel(self, name: str) -> TunnelMetrics:
+        """
+        Returns metrics of the tunnel, creating them on first use
+        :param name: Tunnel name (full domain)
+        """
+        metrics = self.__tunnels__.get(name)
+        if metrics is None:
+            with self.__lock__:
+                metrics = self.__tunnels__.setdefault(name, TunnelMetrics(name))
+        return metrics
+
+    def remove(self, name: str):
+        """Forgets metrics of the tunnel"""
+        with self.__lock__:
+            self.__tunnels__.pop(name, None)
+
+    def snapshot(self) -> dict:
+        """
+        Returns metrics of all tunnels
+        :return: dict tunnel name -> TunnelMetrics.snapshot()
+        """
+        with self.__lock__:
+            tunnels = list(self.__tunnels__.values())
+        return {metrics.name: metrics.snapshot() for metrics in tunnels}
+
+    def to_prometheus(self) -> str:
+        """
+        Renders metrics of all tunnels in the Prometheus text exposition format
+        :return: str
+        """
+        snapshot = self.snapshot()
+        lines = []
+        counters = (("bytes_in", "boringproxy_tunnel_bytes_in_total", "counter",
+                     "Bytes relayed from the ssh channel to the local service"),
+                    ("bytes_out", "boringproxy_tunnel_bytes_out_total", "counter",
+                     "Bytes relayed from the local service to the ssh channel"),
+                    ("connections", "boringproxy_tunnel_connections_total", "counter",
+                     "Accepted connections"),
+                    ("active_connections", "boringproxy_tunnel_active_connections", "gauge",
+                     "Currently relayed connections"),
+                    ("connect_failures", "boringproxy_tunnel_connect_failures_total", "counter",
+                     "Failed connects to the local service"),
+                    ("connect_timeouts", "boringproxy_tunnel_connect_timeouts_total", "counter",
+                     "Connects to the local service which timed out"),
+                    ("rejected_connections", "boringproxy_tunnel_rejected_connections_total", "counter",
+                     "Connections closed at once because they were over the connection limits"),
+                    ("throttled_connections", "boringproxy_tunnel_throttled_connections_total", "counter",
+                     "Connections paused by the bytes per second limit"))
+        for key, metric, kind, help_text in counters:
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for name, values in snapshot.items():
+                lines.append('%s{tunnel="%s"} %s' % (metric, _escape(name), values[key]))
+        histograms = (("duration", "boringproxy_tunnel_connection_duration_seconds",
+                       "Relay time of connections from the established connect to close"),
+                      ("connect_duration", "boringproxy_tunnel_connect_duration_seconds",
+                       "Connect latency to the local service"))
+        for key, metric, help_text in histograms:
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s histogram" % metric)
+            for name, values in snapshot.items():
+                cumulative = 0
+                for bound, count in values[key + "_buckets"].items():
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('%s_bucket{tunnel="%s",le="%s"} %d' % (metric, _escape(name), le, cumulative))
+                lines.append('%s_sum{tunnel="%s"} %s' % (metric, _escape(name), values[key + "_sum"]))
+                lines.append('%s_count{tunnel="%s"} %d' % (metric, _escape(name), values[key + "_count"]))
+        return "\n".join(lines) + "\n"
+
+    def start_exporter(self, port: int, host: str = "127.0.0.1") -> "PrometheusExporter":
+        """
+        Serves metrics in the Prometheus text format on http://host:port/metrics
+        :return: PrometheusExporter object, call its stop() to shut it down
+        """
+        return PrometheusExporter(self, host, port).start()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class PrometheusExporter:
+    """Small HTTP server exposing a MetricsRegistry for Prometheus scraping"""
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="bp-metrics-exporter", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+__default_registry__ = None
+__default_registry_lock__ = threading.Lock()
+
+
+def get_default_registry() -> MetricsRegistry:
+    """
+    Returns the process-wide metrics registry used by tunnels
+    :return: MetricsRegistry object
+    """
+    global __default_registry__
+    with __default_registry_lock__:
+        if __default_registry__ is None:
+            __default_registry__ = MetricsRegistry()
+        return __default_registry__
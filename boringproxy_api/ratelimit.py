@@ -0,0 +1,146 @@
+"""Token bucket rate limiter and limits of relayed traffic"""
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Tokens are refilled at `rate` per second up to `burst`.
+    A reservation may take the bucket below zero, the caller then waits for the returned delay,
+    so waiters are served in reservation order without polling.
+    """
+
+    def __init__(self, rate: float, burst: float = 0):
+        """
+        :param rate: Tokens added per second
+        :param burst: Bucket capacity. Defaults to one second worth of tokens, at least 1
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.rate = rate
+        self.burst = burst if burst > 0 else max(1.0, rate)
+        self.__tokens__ = self.burst
+        self.__updated__ = time.monotonic()
+        self.__lock__ = threading.Lock()
+
+    def __refill__(self, now: float):
+        self.__tokens__ = min(self.burst, self.__tokens__ + (now - self.__updated__) * self.rate)
+        self.__updated__ = now
+
+    def reserve(self, tokens: float = 1) -> float:
+        """
+        Takes tokens from the bucket
+        :param tokens: Number of tokens
+        :return: Seconds to wait before the tokens may be used, 0 if they are available now
+        """
+        with self.__lock__:
+            self.__refill__(time.monotonic())
+            self.__tokens__ -= tokens
+            return -self.__tokens__ / self.rate if self.__tokens__ < 0 else 0.0
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """
+        Takes tokens only if they are available now
+        :return: True if the tokens were taken
+        """
+        with self.__lock__:
+            self.__refill__(time.monotonic())
+            if self.__tokens__ < tokens:
+                return False
+            self.__tokens__ -= tokens
+            return True
+
+    def acquire(self, tokens: float = 1):
+        """Takes tokens, sleeping until they are available"""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def available(self) -> float:
+        """Tokens available now, negative if there are pending reservations"""
+        with self.__lock__:
+            self.__refill__(time.monotonic())
+            return self.__tokens__
+
+
+class RelayLimits:
+    """
+    Limits of relayed traffic: bytes per second in both directions together, concurrent connections
+    and new connections per second. 0 disables a limit.
+    One object is shared by all relay workers and all connections it is given to,
+    so every tunnel needs its own object for per-tunnel limits, see RelayEngine for global limits.
+    Connections over the connection limits are rejected, traffic over the byte rate is delayed.
+    """
+
+    def __init__(self, bytes_per_second: float = 0, max_connections: int = 0, connections_per_second: float = 0,
+                 burst_bytes: float = 0, connection_burst: float = 0):
+        """
+        :param bytes_per_second: Max relayed bytes per second
+        :param max_connections: Max number of connections relayed at once
+        :param connections_per_second: Max number of new connections per second
+        :param burst_bytes: Bytes which may be relayed at once before the byte rate applies.
+        Defaults to one second worth of bytes
+        :param connection_burst: New connections accepted at once before the connection rate applies
+        """
+        self.__lock__ = threading.Lock()
+        self.__active__ = 0
+        self.configure(bytes_per_second, max_connections, connections_per_second, burst_bytes, connection_burst)
+
+    @classmethod
+    def from_value(cls, value) -> "RelayLimits":
+        """
+        :param value: RelayLimits object, dict of its parameters (as found in config and tunnel files) or None
+        :return: RelayLimits object or None
+        """
+        if value is None or isinstance(value, RelayLimits):
+            return value
+        return cls(**value)
+
+    def configure(self, bytes_per_second: float = 0, max_connections: int = 0, connections_per_second: float = 0,
+                  burst_bytes: float = 0, connection_burst: float = 0):
+        """Changes the limits in place. Active connections stay counted against max_connections"""
+        self.bytes_per_second = bytes_per_second
+        self.max_connections = max_connections
+        self.connections_per_second = connections_per_second
+        self.bandwidth = TokenBucket(bytes_per_second, burst_bytes) if bytes_per_second > 0 else None
+        self.connection_rate = TokenBucket(connections_per_second, connection_burst) \
+            if connections_per_second > 0 else None
+
+    def admit(self) -> bool:
+        """
+        Counts a new connection if it is within the limits. Every admitted connection must be released
+        :return: False if the connection must be rejected
+        """
+        with self.__lock__:
+            if self.max_connections and self.__active__ >= self.max_connections:
+                return False
+            if self.connection_rate is not None and not self.connection_rate.try_acquire():
+                return False
+            self.__active__ += 1
+            return True
+
+    def release(self):
+        """Forgets a connection counted by admit()"""
+        with self.__lock__:
+            self.__active__ -= 1
+
+    def reserve(self, size: int) -> float:
+        """
+        Charges relayed bytes
+        :param size: Number of bytes
+        :return: Seconds the connection must pause before relaying more, 0 if it may go on
+        """
+        bandwidth = self.bandwidth
+        return bandwidth.reserve(size) if bandwidth is not None else 0.0
+
+    @property
+    def active_connections(self) -> int:
+        return self.__active__
+
+    def stats(self) -> dict:
+        """
+        :return: dict with the configured limits and the number of admitted connections
+        """
+        return {"bytes_per_second": self.bytes_per_second, "max_connections": self.max_connections,
+                "connections_per_second": self.connections_per_second, "active_connections": self.__active__}
@@ -0,0 +1,246 @@
+"""Declarative management of the tunnel set of a Client"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .client import LOCAL_TUNNEL_OPTIONS, Client, TunnelResult
+from .upstream import upstream_spec
+
+# Defaults of Client.open_tunnel, used to compare desired specs with opened tunnels
+DEFAULT_TUNNEL_OPTIONS = {"ssh_key_id": "", "client_addr": "127.0.0.1", "client_port": 5555,
+                          "allow_external_tcp": False, "password_protect": False, "username": "", "password": "",
+                          "tls_termination": "server"}
+# Tunnel options as they appear in get_tunnels results
+SERVER_INFO_KEYS = {"client_addr": "client_address", "client_port": "client_port",
+                    "allow_external_tcp": "allow_external_tcp", "tls_termination": "tls_termination"}
+
+
+def load_desired_tunnels(source) -> dict:
+    """
+    Reads a desired tunnel set
+    :param source: dict, list or a path to a JSON or YAML file (YAML requires PyYAML). Accepted shapes:
+    {"app": {"client_port": 8080}, ...}, [{"subdomain": "app", "client_port": 8080}, ...]
+    or either of them under a top-level "tunnels" key
+    :return: dict subdomain -> dict of open_tunnel parameters
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source) as f:
+            text = f.read()
+        if str(source).endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError as e:
+                raise ImportError("YAML tunnel files require PyYAML. Install it with 'pip install pyyaml'") from e
+            source = yaml.safe_load(text) or {}
+        else:
+            source = json.loads(text)
+    if isinstance(source, dict) and isinstance(source.get("tunnels"), (dict, list)):
+        source = source["tunnels"]
+    if isinstance(source, list):
+        return {spec["subdomain"]: {k: v for k, v in spec.items() if k != "subdomain"} for spec in source}
+    return {subdomain: dict(spec or {}) for subdomain, spec in source.items()}
+
+
+class ReconcilePlan:
+    """Operations needed to turn the current tunnel set into the desired one"""
+    __slots__ = ("add", "adopt", "restart", "start", "delete", "delete_remote", "unchanged")
+
+    def __init__(self):
+        self.add = {}  # Full domain -> spec of tunnels to register and start
+        self.adopt = {}  # Full domain -> spec of tunnels registered on the server but not opened locally
+        self.restart = {}  # Full domain -> new spec of opened tunnels whose options changed
+        self.start = []  # Opened tunnels which are not running
+        self.delete = []  # Opened tunnels which are not desired anymore
+        self.delete_remote = []  # Full domains of undesired tunnels of this client known only to the server
+        self.unchanged = []  # Full domains of tunnels left untouched
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.add or self.adopt or self.restart or self.start or self.delete or self.delete_remote)
+
+    def __repr__(self):
+        return "ReconcilePlan(add=%d, adopt=%d, restart=%d, start=%d, delete=%d, delete_remote=%d, unchanged=%d)" % (
+            len(self.add), len(self.adopt), len(self.restart), len(self.start), len(self.delete),
+            len(self.delete_remote), len(self.unchanged))
+
+
+class Reconciler:
+    """
+    Keeps the tunnels of a Client equal to a desired set.
+    Every run takes one get_tunnels snapshot, compares it and the opened tunnels with the desired set
+    and applies only the needed operations in parallel. Unchanged tunnels are not touched.
+    """
+
+    def __init__(self, client: Client, prune: bool = True):
+        """
+        :param client: Client whose tunnels are managed
+        :param prune: Delete tunnels of this client which are registered on the server but not desired
+        """
+        self.client = client
+        self.prune = prune
+        self.last_plan = None
+        self.last_error = None
+        self.__lock__ = threading.Lock()
+        self.__watcher__ = None
+        self.__stop_watch__ = threading.Event()
+
+    def __normalize__(self, desired: dict) -> dict:
+        admin_domain = self.client.web_api.admin_domain
+        result = {}
+        for subdomain, spec in desired.items():
+            spec = dict(DEFAULT_TUNNEL_OPTIONS, **spec)
+            spec["client_port"] = int(spec["client_port"])
+            domain = subdomain + '.' + admin_domain if '.' + admin_domain not in subdomain else subdomain
+            result[domain] = spec
+        return result
+
+    def plan(self, desired: dict, snapshot: dict = None) -> ReconcilePlan:
+        """
+        Computes the operations without applying them
+        :param desired: dict subdomain -> open_tunnel parameters, see load_desired_tunnels
+        :param snapshot: get_tunnels(client_name) result. Fetched by default
+        :return: ReconcilePlan object
+        """
+        client = self.client
+        if snapshot is None:
+            snapshot = client.web_api.get_tunnels(client.config.client_name)
+        desired = self.__normalize__(desired)
+        plan = ReconcilePlan()
+        for domain, spec in desired.items():
+            tunnel = client.get_tunnel(domain)
+            if tunnel is None:
+                info = snapshot.get(domain)
+                if info is not None and _matches_server_info(spec, info):
+                    plan.adopt[domain] = spec
+                else:
+                    plan.add[domain] = spec
+            elif _local_spec(spec) != tunnel.options or upstream_spec(spec.get("upstream")) != tunnel.upstream_spec:
+                plan.restart[domain] = spec
+            elif domain not in snapshot:
+                plan.restart[domain] = spec  # Removed from the server behind our back
+            elif not tunnel.is_alive:
+                plan.start.append(tunnel)
+            else:
+                plan.unchanged.append(domain)
+        for tunnel in client.get_all_opened_tunnels():
+            if tunnel.subdomain not in desired:
+                plan.delete.append(tunnel)
+        if self.prune:
+            plan.delete_remote = [domain for domain in snapshot
+                                  if domain not in desired and client.get_tunnel(domain) is None]
+        return plan
+
+    def apply(self, desired, snapshot: dict = None) -> list:
+        """
+        Makes the tunnels of the client equal to the desired set
+        :param desired: dict, list or file path accepted by load_desired_tunnels
+        :param snapshot: get_tunnels(client_name) result. Fetched by default
+        :return: list of TunnelResult objects of every changed tunnel
+        """
+        if not isinstance(desired, dict) or "tunnels" in desired:
+            desired = load_desired_tunnels(desired)
+        with self.__lock__:
+            client = self.client
+            api = client.web_api
+            if snapshot is None:
+                snapshot = api.get_tunnels(client.config.client_name)
+            plan = self.plan(desired, snapshot)
+            self.last_plan = plan
+            # Limits are changed in place, so tunnels which stay up keep their connections
+            specs = self.__normalize__(desired)
+            for tunnel in [client.get_tunnel(domain) for domain in plan.unchanged] + plan.start:
+                tunnel.set_limits(specs[tunnel.subdomain].get("limits", client.config.tunnel_limits))
+            if plan.is_empty:
+                return []
+
+            # Stop phase: undesired tunnels, tunnels to restart and server-side leftovers, all in parallel
+            restarting = [client.get_tunnel(domain) for domain in plan.restart]
+            stale = [domain for domain in plan.add if domain in snapshot]  # Registered with other options
+            removals = [(tunnel.subdomain, tunnel) for tunnel in plan.delete + restarting] + \
+                       [(domain, None) for domain in plan.delete_remote + stale]
+
+            def remove(item):
+                domain, tunnel = item
+                try:
+                    if tunnel is None:
+                        api.delete_tunnel(domain)
+                    else:
+                        client.close_tunnel(tunnel)
+                except Exception as e:
+                    return TunnelResult(domain, None, e)
+                return TunnelResult(domain, tunnel)
+
+            removed = []
+            if removals:
+                with ThreadPoolExecutor(max_workers=max(1, min(client.config.max_workers, len(removals)))) as pool:
+                    removed = list(pool.map(remove, removals))
+            results = [result for result in removed if not result.ok or result.subdomain not in plan.restart]
+            failed = {result.subdomain for result in removed if not result.ok}
+            snapshot = {domain: info for domain, info in snapshot.items()
+                        if domain not in plan.restart and domain not in stale}
+
+            # Open phase: one batch registers everything missing, then all new tunnels start in parallel
+            specs = [dict(spec, subdomain=domain) for domain, spec in
+                     list(plan.add.items()) + list(plan.adopt.items()) + list(plan.restart.items())
+                     if domain not in failed]
+            opened = client.open_tunnels(specs, snapshot=snapshot) if specs else []
+            results += [result for result in opened if not result.ok]
+            to_start = [result.tunnel for result in opened if result.ok] + plan.start
+            results += client.start_all(to_start)
+            return results
+
+    def watch(self, path: str, interval: float = 1.0, on_applied=None):
+        """
+        Applies the file now and again every time its content changes
+        :param path: JSON or YAML file with the desired tunnel set
+        :param interval: How often the file is checked, in seconds
+        :param on_applied: Optional callable(list of TunnelResult) called after every apply
+        :return: self, call stop_watch() to stop
+        """
+        self.stop_watch()
+        self.__stop_watch__.clear()
+
+        def run():
+            last_digest = None
+            while True:
+                try:
+                    with open(path, "rb") as f:
+                        digest = hashlib.sha256(f.read()).digest()
+                    if digest != last_digest:  # mtime alone changes on every save, even without edits
+                        results = self.apply(path)
+                        last_digest = digest
+                        self.last_error = None
+                        if on_applied is not None:
+                            on_applied(results)
+                except Exception as e:
+                    self.last_error = e  # A broken file keeps the current tunnels until it is fixed
+                if self.__stop_watch__.wait(interval):
+                    return
+
+        self.__watcher__ = threading.Thread(target=run, name="bp-reconciler", daemon=True)
+        self.__watcher__.start()
+        return self
+
+    def stop_watch(self):
+        """Stops watching the file"""
+        self.__stop_watch__.set()
+        if self.__watcher__ is not None and self.__watcher__ is not threading.current_thread():
+            self.__watcher__.join()
+        self.__watcher__ = None
+
+
+def _local_spec(spec: dict) -> dict:
+    return {k: v for k, v in spec.items() if k not in LOCAL_TUNNEL_OPTIONS}
+
+
+def _matches_server_info(spec: dict, info: dict) -> bool:
+    """Checks the options the server reports for a registered tunnel against the desired spec"""
+    for option, key in SERVER_INFO_KEYS.items():
+        if key in info and str(info[key]) != str(spec[option]):
+            return False
+    return True
+
+
+__all__ = ["Reconciler", "ReconcilePlan", "TunnelResult", "load_desired_tunnels"]
@@ -0,0 +1,532 @@
+"""Selector-driven relay engine for ssh tunnel channels"""
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+
+from .metrics import TunnelMetrics
+from .ratelimit import RelayLimits
+from .upstream import Upstream
+
+# How long a worker waits before retrying a channel that was not writable
+STALL_RETRY_INTERVAL = 0.01
+# Default size of the per-connection relay buffer
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+_EMPTY = memoryview(b"")
+
+
+class _RelayConnection:
+    """Channel <-> local socket pair handled by a relay worker"""
+    __slots__ = ("chan", "sock", "target", "origin", "upstream", "attempts", "connected", "buffer",
+                 "to_chan", "to_sock", "chan_eof", "sock_eof", "chan_events", "sock_events",
+                 "metrics", "stats", "started", "limits", "throttled")
+
+    def __init__(self, chan, target: Upstream, metrics: TunnelMetrics = None, origin: tuple = None,
+                 limits: RelayLimits = None):
+        self.chan = chan
+        self.sock = None
+        self.target = target  # Upstream or UpstreamGroup of the tunnel
+        self.origin = origin
+        self.upstream = None  # Upstream acquired from the target for the current connect
+        self.attempts = 0
+        self.connected = False
+        self.buffer = None  # Preallocated memoryview filled by sock.recv_into, allocated on connect
+        self.to_chan = _EMPTY  # Data read from the local socket waiting to be sent to the channel
+        self.to_sock = _EMPTY  # Data read from the channel waiting to be sent to the local socket
+        self.chan_eof = False
+        self.sock_eof = False
+        self.chan_events = 0
+        self.sock_events = 0
+        self.metrics = metrics
+        self.stats = None  # Metrics shard of the worker relaying this connection
+        self.started = 0.0  # Start of the connect, then start of the relaying
+        self.limits = (limits,) if limits is not None else ()  # Tunnel limits, after admission all counting it
+        self.throttled = False  # Paused by a byte rate limit at least once
+
+
+class RelayWorker(threading.Thread):
+    """Event loop thread which multiplexes many channel/socket pairs"""
+
+    def __init__(self, index: int, buffer_size: int = DEFAULT_BUFFER_SIZE, limits: RelayLimits = None):
+        super().__init__(name="bp-relay-worker-%d" % index, daemon=True)
+        self.index = index
+        self.buffer_size = buffer_size
+        self.limits = limits  # Global limits shared by the workers of the engine
+        self.total_connections = 0  # Written only by the thread which hands over connections
+        self.closed_connections = 0  # Written only by the worker thread, rejected connections included
+        self.rejected_connections = 0  # Written only by the worker thread
+        self.throttled_connections = 0  # Written only by the worker thread
+        self.__selector__ = selectors.DefaultSelector()
+        self.__pending__ = queue.SimpleQueue()
+        self.__stalled__ = set()
+        self.__connecting__ = {}  # Connection -> connect deadline
+        self.__paused__ = {}  # Connection over a byte rate limit -> time it may read again
+        self.__wakeup_r__, self.__wakeup_w__ = socket.socketpair()
+        self.__wakeup_r__.setblocking(False)
+        self.__wakeup_w__.setblocking(False)
+        self.__selector__.register(self.__wakeup_r__, selectors.EVENT_READ, None)
+        self.__running__ = False
+
+    def add_connection(self, chan, upstream: Upstream, metrics: TunnelMetrics = None, origin: tuple = None,
+                       limits: RelayLimits = None):
+        """
+        Hands over a new channel to this worker. Thread-safe.
+        :param chan: paramiko Channel (or any socket-like object with fileno)
+        :param upstream: Local service (Upstream or UpstreamGroup) to forward the channel to
+        :param metrics: Optional metrics of the tunnel the channel belongs to
+        :param origin: Optional (address, port) of the peer which opened the channel
+        :param limits: Optional limits of the tunnel the channel belongs to
+        """
+        self.total_connections += 1
+        self.__pending__.put(_RelayConnection(chan, upstream, metrics, origin, limits))
+        self.wakeup()
+
+    @property
+    def active_connections(self) -> int:
+        return self.total_connections - self.closed_connections
+
+    def wakeup(self):
+        """Interrupts the selector wait"""
+        try:
+            self.__wakeup_w__.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # The wakeup pipe is already full or closed, the worker will wake anyway
+
+    def stop(self):
+        """Asks the worker loop to exit and close all its connections"""
+        self.__running__ = False
+        self.wakeup()
+
+    def run(self):
+        self.__running__ = True
+        try:
+            while self.__running__:
+                timeout = STALL_RETRY_INTERVAL if self.__stalled__ else None
+                for deadlines in (self.__connecting__, self.__paused__):
+                    if deadlines:
+                        next_deadline = max(0.0, min(deadlines.values()) - time.monotonic())
+                        timeout = next_deadline if timeout is None else min(timeout, next_deadline)
+                for key, events in self.__selector__.select(timeout):
+                    if key.data is None:
+                        self.__drain_wakeup__()
+                        continue
+                    conn, is_chan = key.data
+                    if conn.chan is None:
+                        continue  # Closed while handling a previous event of this batch
+                    if is_chan:
+                        self.__on_chan_event__(conn)
+                    else:
+                        self.__on_sock_event__(conn, events)
+                for conn in list(self.__stalled__):
+                    self.__flush_to_chan__(conn)
+                    self.__update__(conn)
+                if self.__connecting__:
+                    self.__expire_connects__()
+                if self.__paused__:
+                    self.__resume_paused__()
+        finally:
+            for key in list(self.__selector__.get_map().values()):
+                if key.data is not None:
+                    self.__close__(key.data[0])
+            for conn in list(self.__paused__):  # Paused connections may have nothing registered
+                self.__close__(conn)
+            while True:
+                try:
+                    self.__close__(self.__pending__.get_nowait())
+                except queue.Empty:
+                    break
+            self.__selector__.close()
+            self.__wakeup_r__.close()
+            self.__wakeup_w__.close()
+
+    def __drain_wakeup__(self):
+        try:
+            while self.__wakeup_r__.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        while True:
+            try:
+                conn = self.__pending__.get_nowait()
+            except queue.Empty:
+                return
+            self.__connect__(conn)
+
+    def __connect__(self, conn: _RelayConnection):
+        """Starts relaying a new channel"""
+        conn.chan.settimeout(0.0)
+        if conn.metrics is not None:
+            conn.stats = conn.metrics.shard(self.index)
+        if not self.__admit__(conn):
+            self.__reject__(conn)
+            return
+        if conn.stats is not None:
+            conn.stats.connections += 1
+        conn.buffer = memoryview(bytearray(self.buffer_size))
+        self.__open__(conn)
+
+    def __admit__(self, conn: _RelayConnection) -> bool:
+        """
+        Checks the tunnel and the global connection limits
+        :return: False if one of them is exceeded, nothing stays counted then
+        """
+        admitted = []
+        for limits in conn.limits + ((self.limits,) if self.limits is not None else ()):
+            if not limits.admit():
+                for counted in admitted:
+                    counted.release()
+                conn.limits = ()
+                return False
+            admitted.append(limits)
+        conn.limits = tuple(admitted)
+        return True
+
+    def __reject__(self, conn: _RelayConnection):
+        """Closes a channel over the connection limits. It is not counted as a relayed connection"""
+        self.rejected_connections += 1
+        self.closed_connections += 1
+        if conn.stats is not None:
+            conn.stats.rejected_connections += 1
+        try:
+            conn.chan.close()
+        except Exception:
+            pass
+        conn.chan = None
+
+    def __charge__(self, conn: _RelayConnection, size: int):
+        """
+        Charges relayed bytes to the byte rate limits of the connection.
+        Over the limit, the connection stops reading from both sides until the debt is paid off,
+        the wake up is a selector timeout, so nothing is polled meanwhile
+        """
+        delay = 0.0
+        for limits in conn.limits:
+            delay = max(delay, limits.reserve(size))
+        if delay <= 0:
+            return
+        self.__paused__[conn] = time.monotonic() + delay
+        if not conn.throttled:
+            conn.throttled = True
+            self.throttled_connections += 1
+            if conn.stats is not None:
+                conn.stats.throttled_connections += 1
+
+    def __resume_paused__(self):
+        now = time.monotonic()
+        for conn in [conn for conn, resume_at in self.__paused__.items() if resume_at <= now]:
+            del self.__paused__[conn]
+            self.__update__(conn)
+
+    def __open__(self, conn: _RelayConnection):
+        """Starts a non-blocking connect to the next upstream chosen by the target"""
+        conn.started = time.monotonic()
+        conn.attempts += 1
+        conn.upstream = conn.target.acquire(conn.origin)
+        try:
+            conn.sock, connected = conn.upstream.open()
+        except OSError:
+            self.__connect_failed__(conn)
+            return
+        if connected:
+            self.__on_connected__(conn)
+            self.__update__(conn)
+            return
+        if conn.upstream.connect_timeout:
+            self.__connecting__[conn] = conn.started + conn.upstream.connect_timeout
+        self.__register__(conn, conn.sock, selectors.EVENT_WRITE, False)
+
+    def __on_connected__(self, conn: _RelayConnection):
+        now = time.monotonic()
+        if conn.stats is not None:
+            conn.stats.connect_durations.observe(now - conn.started)
+        conn.connected = True
+        conn.started = now
+        self.__connecting__.pop(conn, None)
+        conn.target.report(conn.upstream, True)
+
+    def __expire_connects__(self):
+        """Closes channels whose connect to the local service did not finish in time"""
+        now = time.monotonic()
+        for conn in [conn for conn, deadline in self.__connecting__.items() if deadline <= now]:
+            if conn.stats is not None:
+                conn.stats.connect_timeouts += 1
+            self.__connect_failed__(conn)
+
+    def __on_sock_event__(self, conn: _RelayConnection, events: int):
+        if not conn.connected:
+            if conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self.__connect_failed__(conn)
+                return
+            self.__on_connected__(conn)
+        if events & selectors.EVENT_WRITE and conn.to_sock and not self.__flush_to_sock__(conn):
+            return
+        if events & selectors.EVENT_READ and not conn.to_chan:
+            try:
+                received = conn.sock.recv_into(conn.buffer)
+            except (BlockingIOError, InterruptedError):
+                received = None
+            except OSError:
+                received = 0
+            if received == 0:
+                conn.sock_eof = True
+            elif received:
+                if conn.stats is not None:
+                    conn.stats.bytes_out += received
+                if conn.limits:
+                    self.__charge__(conn, received)
+                conn.to_chan = conn.buffer[:received]
+                self.__flush_to_chan__(conn)
+        self.__update__(conn)
+
+    def __on_chan_event__(self, conn: _RelayConnection):
+        # paramiko channels have no recv_into, so the received bytes object is
+        # relayed as is and only sliced through a memoryview on short writes
+        try:
+            data = conn.chan.recv(self.buffer_size)
+        except (socket.timeout, BlockingIOError):
+            data = None
+        except OSError:
+            data = b""
+        if data == b"":
+            conn.chan_eof = True
+        elif data:
+            if conn.stats is not None:
+                conn.stats.bytes_in += len(data)
+            if conn.limits:
+                self.__charge__(conn, len(data))
+            conn.to_sock = memoryview(data)
+            if not self.__flush_to_sock__(conn):
+                return
+        self.__update__(conn)
+
+    def __flush_to_sock__(self, conn: _RelayConnection) -> bool:
+        """
+        Sends pending data to the local socket until it is sent or the socket is not writable
+        :return: False if the connection was closed
+        """
+        while conn.to_sock:
+            try:
+                sent = conn.sock.send(conn.to_sock)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.__close__(conn)
+                return False
+            conn.to_sock = conn.to_sock[sent:]
+        return True
+
+    def __flush_to_chan__(self, conn: _RelayConnection):
+        """Sends pending data to the channel until it is sent or the channel window is full"""
+        while conn.to_chan:
+            try:
+                sent = conn.chan.send(conn.to_chan)
+            except (socket.timeout, BlockingIOError):
+                break
+            except OSError:
+                sent = 0
+            if sent == 0:  # Channel is closed
+                conn.chan_eof = True
+                conn.to_chan = _EMPTY
+                break
+            conn.to_chan = conn.to_chan[sent:]
+        if conn.to_chan:
+            self.__stalled__.add(conn)
+        else:
+            self.__stalled__.discard(conn)
+
+    def __update__(self, conn: _RelayConnection):
+        """Recomputes selector interest for both sides of the connection"""
+        if conn.sock is None:
+            return
+        if (conn.chan_eof and not conn.to_sock) or (conn.sock_eof and not conn.to_chan):
+            self.__close__(conn)
+            return
+        paused = conn in self.__paused__
+        sock_events = 0
+        if conn.to_sock:
+            sock_events |= selectors.EVENT_WRITE
+        if not conn.to_chan and not conn.sock_eof and not paused:
+            sock_events |= selectors.EVENT_READ
+        chan_events = selectors.EVENT_READ if not conn.to_sock and not conn.chan_eof and not paused else 0
+        self.__register__(conn, conn.sock, sock_events, False)
+        self.__register__(conn, conn.chan, chan_events, True)
+
+    def __register__(self, conn: _RelayConnection, fileobj, events: int, is_chan: bool):
+        current = conn.chan_events if is_chan else conn.sock_events
+        if current == events:
+            return
+        if events == 0:
+            self.__selector__.unregister(fileobj)
+        elif current == 0:
+            self.__selector__.register(fileobj, events, (conn, is_chan))
+        else:
+            self.__selector__.modify(fileobj, events, (conn, is_chan))
+        if is_chan:
+            conn.chan_events = events
+        else:
+            conn.sock_events = events
+
+    def __connect_failed__(self, conn: _RelayConnection):
+        """Reports the failed upstream and retries the channel on the next one, if the target has more"""
+        if conn.stats is not None:
+            conn.stats.connect_failures += 1
+        conn.target.report(conn.upstream, False)
+        if conn.attempts >= conn.target.attempts:
+            self.__close__(conn)
+            return
+        self.__connecting__.pop(conn, None)
+        if conn.sock is not None:
+            if conn.sock_events:
+                self.__selector__.unregister(conn.sock)
+                conn.sock_events = 0
+            conn.sock.close()
+            conn.sock = None
+        conn.target.release(conn.upstream)
+        self.__open__(conn)
+
+    def __close__(self, conn: _RelayConnection):
+        for fileobj, events in ((conn.chan, conn.chan_events), (conn.sock, conn.sock_events)):
+            if fileobj is None:
+                continue
+            if events:
+                try:
+                    self.__selector__.unregister(fileobj)
+                except (KeyError, ValueError):
+                    pass
+            try:
+                fileobj.close()
+            except Exception:
+                pass
+        conn.chan_events = conn.sock_events = 0
+        if conn.chan is not None:
+            self.closed_connections += 1
+            for limits in conn.limits:
+                limits.release()
+            conn.limits = ()
+            if conn.upstream is not None:
+                conn.target.release(conn.upstream)
+            if conn.stats is not None:
+                conn.stats.closed_connections += 1
+                if conn.connected:
+                    conn.stats.durations.observe(time.monotonic() - conn.started)
+        conn.chan = conn.sock = conn.buffer = None
+        conn.to_chan = conn.to_sock = _EMPTY
+        self.__stalled__.discard(conn)
+        self.__connecting__.pop(conn, None)
+        self.__paused__.pop(conn, None)
+
+
+class RelayEngine:
+    """
+    Fixed pool of relay workers shared by all tunnels.
+    Every accepted channel is assigned to the least loaded worker
+    and relayed to the local service by that worker's event loop.
+    """
+
+    def __init__(self, workers: int = 0, buffer_size: int = DEFAULT_BUFFER_SIZE, limits: RelayLimits = None):
+        """
+        :param workers: Number of event loop threads. Defaults to the number of CPUs (at least 2)
+        :param buffer_size: Size of the relay buffer of each connection in bytes
+        :param limits: Optional global limits of all connections relayed by this engine, on top of the tunnel limits
+        """
+        if buffer_size <= 0:
+            raise ValueError("Buffer size must be positive")
+        self.workers_count = workers if workers > 0 else max(2, os.cpu_count() or 1)
+        self.buffer_size = buffer_size
+        self.__limits__ = RelayLimits.from_value(limits)
+        self.__workers__ = []
+        self.__lock__ = threading.Lock()
+
+    @property
+    def is_running(self) -> bool:
+        return len(self.__workers__) > 0
+
+    @property
+    def limits(self) -> RelayLimits:
+        """Global limits of this engine or None"""
+        return self.__limits__
+
+    def set_limits(self, limits):
+        """
+        Changes the global limits. New connections are checked against them at once
+        :param limits: RelayLimits object, dict of its parameters or None to remove the limits.
+        A dict reconfigures the current limits in place, so active connections stay counted
+        """
+        with self.__lock__:
+            if isinstance(limits, dict) and self.__limits__ is not None:
+                self.__limits__.configure(**limits)
+                return
+            self.__limits__ = RelayLimits.from_value(limits)
+            for worker in self.__workers__:
+                worker.limits = self.__limits__
+
+    def start(self):
+        """Starts the relay workers"""
+        with self.__lock__:
+            if self.__workers__:
+                return
+            self.__workers__ = [RelayWorker(i, self.buffer_size, self.__limits__) for i in range(self.workers_count)]
+            for worker in self.__workers__:
+                worker.start()
+
+    def stop(self):
+        """Stops all workers and closes all relayed connections"""
+        with self.__lock__:
+            workers, self.__workers__ = self.__workers__, []
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
+
+    def add_connection(self, chan, upstream: Upstream, metrics: TunnelMetrics = None, origin: tuple = None,
+                       limits: RelayLimits = None):
+        """
+        Relays the channel to the local service
+        :param chan: paramiko Channel accepted from the ssh transport
+        :param upstream: Local service (Upstream or UpstreamGroup) to connect the channel to
+        :param metrics: Optional metrics of the tunnel the channel belongs to
+        :param origin: Optional (address, port) of the peer which opened the channel, used by hash balancing
+        :param limits: Optional limits of the tunnel the channel belongs to. The channel is closed
+        at once if it is over the connection limits of the tunnel or of the engine
+        """
+        if not self.__workers__:
+            self.start()
+        with self.__lock__:
+            worker = min(self.__workers__, key=lambda w: w.active_connections)
+            worker.add_connection(chan, upstream, metrics, origin, limits)
+
+    def stats(self) -> dict:
+        """
+        Returns load counters of the relay
+        :return: dict with active connections count, per-worker load and the global limits
+        """
+        workers = [{"name": w.name,
+                    "active_connections": w.active_connections,
+                    "total_connections": w.total_connections,
+                    "rejected_connections": w.rejected_connections,
+                    "throttled_connections": w.throttled_connections} for w in self.__workers__]
+        return {"workers": workers,
+                "active_connections": sum(w["active_connections"] for w in workers),
+                "total_connections": sum(w["total_connections"] for w in workers),
+                "rejected_connections": sum(w["rejected_connections"] for w in workers),
+                "throttled_connections": sum(w["throttled_connections"] for w in workers),
+                "limits": self.__limits__.stats() if self.__limits__ is not None else None}
+
+
+__default_relay__ = None
+__default_relay_lock__ = threading.Lock()
+
+
+def get_default_relay() -> RelayEngine:
+    """
+    Returns the process-wide relay engine shared by all tunnels
+    :return: RelayEngine object
+    """
+    global __default_relay__
+    with __default_relay_lock__:
+        if __default_relay__ is None:
+            __default_relay__ = RelayEngine()
+        return __default_relay__
@@ -0,0 +1,352 @@
+"""Client which spreads tunnels over several worker processes"""
+import multiprocessing
+import os
+import pickle
+import signal
+import threading
+import warnings
+
+from .api import WebAPI
+from .config import ClientConfig, TunnelResult
+
+# How long close() waits for a worker to exit before it is terminated, in seconds
+SHUTDOWN_TIMEOUT = 30
+
+
+def _picklable_error(error: Exception) -> Exception:
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return Exception(repr(error))
+
+
+def _worker_main(conn, config: ClientConfig):
+    """
+    Worker process loop. Owns a Client with its own ssh transports and relay
+    and serves commands received from the ShardedClient over the pipe.
+    """
+    from .client import Client  # Only workers need paramiko and the relay
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Shutdown is coordinated by the parent process
+    config.metrics_port = 0  # Workers would fight for the port, their metrics are collected by stats()
+    client = Client(config, register_client=False)
+    tunnels = {}
+    try:
+        while True:
+            try:
+                command, payload = conn.recv()
+            except EOFError:
+                break  # The parent process is gone
+            try:
+                if command == "open":
+                    results = client.open_tunnels(payload)
+                    opened = [result.tunnel for result in results if result.ok]
+                    started = {result.subdomain: result.error for result in client.start_all(opened)}
+                    reply = []
+                    for result in results:
+                        error = result.error if not result.ok else started.get(result.subdomain)
+                        if result.ok and error is None:
+                            tunnels[result.subdomain] = result.tunnel
+                        reply.append((result.subdomain, None if error is None else _picklable_error(error)))
+                elif command == "close":
+                    reply = []
+                    for subdomain in payload:
+                        try:
+                            client.close_tunnel(tunnels.pop(subdomain))
+                            reply.append((subdomain, None))
+                        except Exception as e:
+                            reply.append((subdomain, _picklable_error(e)))
+                elif command == "stats":
+                    reply = client.stats()
+                elif command == "shutdown":
+                    reply = [(result.subdomain, None if result.ok else _picklable_error(result.error))
+                             for result in client.close()]
+                    tunnels.clear()
+                    conn.send(("ok", reply))
+                    break
+                else:
+                    raise ValueError("Unknown command: %s" % command)
+                conn.send(("ok", reply))
+            except Exception as e:
+                conn.send(("error", _picklable_error(e)))
+    finally:
+        client.close()  # Drains with config.drain_timeout, does nothing after a shutdown command
+        conn.close()
+
+
+class _Worker:
+    """Parent side of a worker process"""
+    __slots__ = ("index", "process", "conn", "lock", "tunnels", "dead")
+
+    def __init__(self, index: int, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.tunnels = set()
+        self.dead = False  # The pipe is broken or out of step with the commands, no more commands are sent
+
+    def mark_dead(self):
+        """Stops using the worker. Closing the pipe makes a still running worker close its client and exit"""
+        self.dead = True
+        self.conn.close()
+
+
+class ShardedClient:
+    """
+    Client for Boring Proxy Server which spreads tunnels over a pool of worker processes.
+    Every worker owns its ssh transports and relay, so encryption and relaying of
+    different tunnels run on different CPU cores. The parent process only registers
+    the client on the server and sends open/close/stats commands to the workers.
+    The config must be picklable, e.g. on_tunnel_state_change must be a module-level function.
+    """
+
+    def __init__(self, config: ClientConfig, workers: int = 0):
+        """
+        :param config: Client config used by the parent and all workers
+        :param workers: Number of worker processes. Defaults to the number of CPUs
+        """
+        self.__closed__ = True  # Nothing to shut down until the workers are started
+        self.__config__ = config
+        self.__bp_server_api__ = WebAPI(config.admin_domain, config.user, config.token,
+                                        pool_size=1, max_retries=config.max_retries, timeout=config.timeout,
+                                        verify=config.verify, rate_limit=config.rate_limit,
+                                        rate_burst=config.rate_burst)
+        self.__bp_server_api__.add_client(client_name=config.client_name)
+        self.__placement__ = {}  # Full tunnel domain -> _Worker
+        self.__lock__ = threading.Lock()
+        context = multiprocessing.get_context("spawn")  # Forking a process with running paramiko threads is unsafe
+        self.__workers__ = []
+        for index in range(workers if workers > 0 else (os.cpu_count() or 1)):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker_main, args=(child_conn, config),
+                                      name="bp-shard-%d" % index, daemon=True)
+            process.start()
+            child_conn.close()
+            self.__workers__.append(_Worker(index, process, parent_conn))
+        self.__closed__ = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def web_api(self) -> WebAPI:
+        """WebAPI object of the parent process"""
+        return self.__bp_server_api__
+
+    @property
+    def workers_count(self) -> int:
+        return len(self.__workers__)
+
+    def __full_domain__(self, subdomain: str) -> str:
+        admin_domain = self.__bp_server_api__.admin_domain
+        return subdomain + '.' + admin_domain if '.' + admin_domain not in subdomain else subdomain
+
+    def __exchange__(self, commands: dict) -> dict:
+        """
+        Sends commands to workers and waits for all replies. Workers execute them in parallel.
+        The reply of every worker which got its command is read, even if other workers failed,
+        so the next command of a worker never reads the reply of the previous one
+        :param commands: dict _Worker -> (command, payload)
+        :return: dict _Worker -> ("ok", reply) or ("error", exception)
+        """
+        workers = sorted(commands, key=lambda w: w.index)
+        for worker in workers:
+            worker.lock.acquire()
+        replies = {}
+        owed = []  # Workers which got their command and whose reply is not read yet
+        try:
+            for worker in workers:
+                if worker.dead:
+                    replies[worker] = "error", RuntimeError("Worker %d exited" % worker.index)
+                    continue
+                try:
+                    worker.conn.send(commands[worker])
+                except (OSError, EOFError):
+                    worker.mark_dead()
+                    replies[worker] = "error", RuntimeError("Worker %d exited" % worker.index)
+                except Exception as e:  # Pickling failed before anything was written, the pipe is still in step
+                    replies[worker] = "error", e
+                else:
+                    owed.append(worker)
+            while owed:
+                worker = owed[0]
+                try:
+                    replies[worker] = worker.conn.recv()
+                except (OSError, EOFError):
+                    worker.mark_dead()
+                    replies[worker] = "error", RuntimeError("Worker %d exited" % worker.index)
+                except Exception as e:  # Unpickling failed after the whole reply was read
+                    replies[worker] = "error", e
+                owed.pop(0)
+        finally:
+            for worker in owed:  # Interrupted, e.g. by KeyboardInterrupt: these pipes are out of step
+                worker.mark_dead()
+            for worker in workers:
+                worker.lock.release()
+        return replies
+
+    def __call_workers__(self, commands: dict) -> dict:
+        """
+        Sends commands to workers and waits for all replies, see __exchange__
+        :param commands: dict _Worker -> (command, payload)
+        :return: dict _Worker -> reply
+        :raises the error of the first failed worker
+        """
+        replies = {}
+        for worker, (status, reply) in self.__exchange__(commands).items():
+            if status == "error":
+                raise reply
+            replies[worker] = reply
+        return replies
+
+    def open_tunnel(self, subdomain: str, **kwargs) -> str:
+        """
+        Registers and starts a tunnel in one of the workers
+        :param kwargs: Client.open_tunnel parameters. They are sent to the worker, so they must be picklable
+        :return: Full domain of the tunnel
+        :raises the error of the worker if the tunnel could not be opened
+        """
+        result = self.open_tunnels([dict(kwargs, subdomain=subdomain)])[0]
+        if not result.ok:
+            raise result.error
+        return result.subdomain
+
+    def open_tunnels(self, specs: list) -> list:
+        """
+        Registers and starts many tunnels, placing every tunnel on the least loaded worker
+        :param specs: list of dicts with Client.open_tunnel parameters
+        :return: list of TunnelResult objects in the order of specs. Their tunnel attribute is None,
+        as tunnels live in worker processes
+        """
+        batches = {}
+        placed = []  # Subdomains placed by this call, forgotten again if the call is interrupted
+        with self.__lock__:
+            for spec in specs:
+                spec = dict(spec, subdomain=self.__full_domain__(spec["subdomain"]))
+                worker = self.__placement__.get(spec["subdomain"])
+                if worker is None:
+                    live = [worker for worker in self.__workers__ if not worker.dead]
+                    if not live:
+                        for subdomain in placed:
+                            self.__forget__(subdomain)
+                        raise RuntimeError("All workers exited")
+                    worker = min(live, key=lambda w: len(w.tunnels))
+                    worker.tunnels.add(spec["subdomain"])
+                    self.__placement__[spec["subdomain"]] = worker
+                    placed.append(spec["subdomain"])
+                batches.setdefault(worker, []).append(spec)
+        errors = {}
+        try:
+            replies = self.__exchange__({worker: ("open", batch) for worker, batch in batches.items()})
+        except BaseException:
+            with self.__lock__:
+                for subdomain in placed:
+                    self.__forget__(subdomain)
+            raise
+        for worker, (status, reply) in replies.items():
+            if status == "ok":
+                errors.update(reply)
+            else:  # The whole batch failed
+                errors.update((spec["subdomain"], reply) for spec in batches[worker])
+        results = []
+        with self.__lock__:
+            for spec in specs:
+                subdomain = self.__full_domain__(spec["subdomain"])
+                error = errors.get(subdomain)
+                if error is not None:
+                    self.__forget__(subdomain)
+                results.append(TunnelResult(subdomain, None, error))
+        return results
+
+    def __forget__(self, subdomain: str):
+        worker = self.__placement__.pop(subdomain, None)
+        if worker is not None:
+            worker.tunnels.discard(subdomain)
+
+    def close_tunnel(self, subdomain: str):
+        """
+        Closes the tunnel in its worker
+        :param subdomain: Tunnel subdomain or full domain
+        """
+        subdomain = self.__full_domain__(subdomain)
+        with self.__lock__:
+            worker = self.__placement__.get(subdomain)
+        if worker is None:
+            raise KeyError("Tunnel %s is not opened by this client" % subdomain)
+        (_, error), = self.__call_workers__({worker: ("close", [subdomain])})[worker]
+        if error is not None:
+            raise error
+        with self.__lock__:
+            self.__forget__(subdomain)
+        return True
+
+    def close_all_tunnels(self) -> list:
+        """
+        Closes all tunnels, all workers in parallel
+        :return: list of TunnelResult objects
+        """
+        with self.__lock__:
+            batches = {worker: ("close", list(worker.tunnels)) for worker in self.__workers__ if worker.tunnels}
+        results = []
+        for reply in self.__call_workers__(batches).values():
+            for subdomain, error in reply:
+                if error is None:
+                    with self.__lock__:
+                        self.__forget__(subdomain)
+                results.append(TunnelResult(subdomain, None, error))
+        return results
+
+    def stats(self) -> dict:
+        """
+        Returns Client.stats() of every worker
+        :return: dict with a list of per-worker stats and tunnel stats of all workers
+        """
+        replies = self.__call_workers__({worker: ("stats", None) for worker in self.__workers__})
+        workers = [dict(replies[worker], pid=worker.process.pid) for worker in self.__workers__]
+        tunnels = {}
+        for worker_stats in workers:
+            tunnels.update(worker_stats["tunnels"])
+        return {"workers": workers, "tunnels": tunnels}
+
+    def close(self):
+        """
+        Coordinated shutdown: every worker closes its tunnels and exits,
+        then the client is deleted from the server
+        """
+        if self.__closed__:
+            return
+        self.__closed__ = True
+        alive = [worker for worker in self.__workers__ if not worker.dead and worker.process.is_alive()]
+        try:
+            self.__call_workers__({worker: ("shutdown", None) for worker in alive})
+        finally:
+            for worker in self.__workers__:
+                worker.process.join(SHUTDOWN_TIMEOUT)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+                worker.conn.close()
+            self.__placement__.clear()
+            self.__bp_server_api__.delete_client(client_name=self.__config__.client_name)
+            self.__bp_server_api__.close()
+
+    def __del__(self):
+        # Finalizers run at an unpredictable time, so the workers are not asked to drain and the client
+        # stays registered on the server, that is the job of close()
+        if getattr(self, "__closed__", True):
+            return
+        warnings.warn("ShardedClient %r was not closed" % self.__config__.client_name, ResourceWarning, source=self)
+        for worker in self.__workers__:
+            try:
+                worker.process.terminate()
+                worker.conn.close()
+            except Exception:
+                pass
+        try:
+            self.__bp_server_api__.close()
+        except Exception:
+            pass
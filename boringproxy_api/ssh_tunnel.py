@@ -1,43 +1,55 @@
 """Wrappers for SSHTunnel module"""
-import select
-import socket
 import threading
-from io import StringIO
+import time
+import warnings
+import weakref
 
 import paramiko
-from paramiko import RSAKey, PKey
+from paramiko import PKey
 
 from .api import WebAPI
+from .keys import load_private_key
+from .metrics import TunnelMetrics, get_default_registry
+from .ratelimit import RelayLimits
+from .relay import RelayEngine, get_default_relay
+from .supervisor import TunnelState, TunnelSupervisor
+from .transport import FORWARD_BIND_ADDRESS, TransportManager
+from .upstream import Upstream, UpstreamGroup, upstream_spec
 
+# How often draining checks whether the active channels are finished, in seconds
+DRAIN_POLL_INTERVAL = 0.05
 
-def handler(chan, host: int, port: int):
-    sock = socket.socket()
-    try:
-        sock.connect((host, port))
-    except Exception as e:
-        return
-
-    while True:
-        r, w, x = select.select([sock, chan], [], [])
-        if sock in r:
-            data = sock.recv(1024)
-            if len(data) == 0:
-                break
-            chan.send(data)
-        if chan in r:
-            data = chan.recv(1024)
-            if len(data) == 0:
-                break
-            sock.send(data)
-    chan.close()
-    sock.close()
+
+def handler(chan, host: str, port: int):
+    """
+    Relays the channel to the local host:port using the shared relay engine
+    :param chan: paramiko Channel
+    :param host: Local address
+    :param port: Local port
+    """
+    get_default_relay().add_connection(chan, Upstream.from_address(host, port))
 
 
 class SSHReverseTunnelForwarder:
     """SSH -r Tunnel Forwarder"""
 
     def __init__(self, hostname: str, port: int, username: str,
-                 pkey: PKey, server_port: int, remote_host: str, remote_port: int):
+                 pkey: PKey, server_port: int, remote_host: str, remote_port: int, relay: RelayEngine = None,
+                 transport_manager: TransportManager = None, supervisor: TunnelSupervisor = None,
+                 connect_timeout: float = 10, metrics: TunnelMetrics = None, upstream: Upstream = None,
+                 limits: RelayLimits = None):
+        """
+        :param remote_host: Local address channels are forwarded to, unix:/path for a Unix domain socket
+        :param relay: Relay engine for accepted channels. The process-wide engine by default
+        :param transport_manager: If given, the forward is carried by a transport shared with
+        other tunnels using the same server and key instead of a dedicated ssh connection
+        :param supervisor: If given, the dropped ssh connection is reconnected by this supervisor
+        :param connect_timeout: Timeout of the ssh connection in seconds
+        :param metrics: Optional traffic metrics updated by the relay
+        :param upstream: Connection options of the local service, or an UpstreamGroup (or a list of
+        backends) to balance channels over several local services. Built from remote_host:remote_port by default
+        :param limits: Optional bandwidth and connection limits of this tunnel, RelayLimits or a dict of its parameters
+        """
 
         port = int(port) if isinstance(port, str) else port
         server_port = int(server_port) if isinstance(server_port, str) else server_port
@@ -50,51 +62,198 @@ class SSHReverseTunnelForwarder:
         self.server_port = server_port
         self.remote_host = remote_host
         self.remote_port = remote_port
-        self.client = paramiko.SSHClient()
-        self.client.load_system_host_keys()
-        self.client.set_missing_host_key_policy(paramiko.WarningPolicy())
-        self.thread = None
+        self.relay = relay if relay is not None else get_default_relay()
+        self.transport_manager = transport_manager
+        self.supervisor = supervisor
+        self.connect_timeout = connect_timeout
+        self.metrics = metrics
+        if isinstance(upstream, list):
+            upstream = UpstreamGroup(upstream)
+        self.upstream = upstream if upstream is not None else Upstream.from_address(remote_host, remote_port)
+        self.limits = RelayLimits.from_value(limits)
+        self.shared_transport = None
+        self.client = None
         self.is_alive = False
+        self.state = TunnelState.STOPPED
+        self.__draining__ = False
+        self.__channels__ = weakref.WeakSet()  # Accepted channels, closed ones are dropped by the relay
+        self.__channels_lock__ = threading.Lock()
+        self.__connection_lock__ = threading.Lock()
 
-    def __th_reverse_tunnel__(self):
-        server_port = self.server_port
-        remote_host = self.remote_host
-        remote_port = self.remote_port
+    def __on_channel__(self, chan, origin=None):
+        """
+        Hands over an accepted channel to the relay, called by the paramiko transport thread.
+        While draining, channels the server accepted before the forward was cancelled are still relayed
+        """
+        if not self.is_alive:
+            chan.close()
+            return
+        with self.__channels_lock__:
+            self.__channels__.add(chan)
+        self.relay.add_connection(chan, self.upstream, self.metrics, origin, self.limits)
 
-        transport = self.client.get_transport()
-        transport.request_port_forward("127.0.0.1", server_port)
-        while True:
-            if not self.is_alive:
-                return
-            chan = transport.accept(1000)
-            if chan is None:
-                continue
-            thr = threading.Thread(
-                target=handler, args=(chan, remote_host, remote_port)
-            )
-            thr.setDaemon(True)
-            thr.start()
+    def set_limits(self, limits):
+        """
+        Changes the limits of this tunnel. New connections and relayed bytes are checked against them at once
+        :param limits: RelayLimits object, dict of its parameters or None to remove the limits.
+        A dict reconfigures the current limits in place, so active connections stay counted
+        """
+        if isinstance(limits, dict) and self.limits is not None:
+            self.limits.configure(**limits)
+        else:
+            self.limits = RelayLimits.from_value(limits)
 
-    def start(self):
+    @property
+    def active_channels(self) -> int:
+        """Number of accepted channels which are not closed yet"""
+        with self.__channels_lock__:
+            return sum(1 for chan in self.__channels__ if not chan.closed)
+
+    def __on_forwarded_channel__(self, chan, origin, server):
+        self.__on_channel__(chan, origin)
+
+    def __connect__(self):
+        """Opens the ssh connection (or joins a shared one) and requests the port forward"""
+        if self.transport_manager is not None:
+            self.shared_transport = self.transport_manager.open_forward(self.hostname, self.port, self.username,
+                                                                        self.pkey, self.server_port,
+                                                                        self.__on_channel__)
+            return
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        self.client.set_missing_host_key_policy(paramiko.WarningPolicy())
         self.client.connect(
             hostname=self.hostname,
             port=self.port,
             username=self.username,
             pkey=self.pkey,
             look_for_keys=False,
+            timeout=self.connect_timeout,
         )
-        self.thread = threading.Thread(
-            target=self.__th_reverse_tunnel__, args=()
-        )
-        self.thread.setDaemon(True)
-        self.thread.start()
+        # Channels are pushed to the relay by the transport thread as soon as they arrive,
+        # so there is no accept loop to poll and nothing to wait for on stop
+        try:
+            self.client.get_transport().request_port_forward(FORWARD_BIND_ADDRESS, self.server_port,
+                                                             handler=self.__on_forwarded_channel__)
+        except Exception:
+            self.client.close()
+            raise
+
+    def __cancel_forward__(self):
+        """Asks the server to stop forwarding new connections, accepted channels stay open"""
+        if self.shared_transport is not None:
+            self.transport_manager.cancel_forward(self.shared_transport, self.server_port)
+        elif self.client is not None:
+            transport = self.client.get_transport()
+            if transport is not None and transport.is_active():
+                transport.cancel_port_forward(FORWARD_BIND_ADDRESS, self.server_port)
+
+    def __disconnect__(self):
+        if self.shared_transport is not None:
+            shared, self.shared_transport = self.shared_transport, None
+            self.transport_manager.close_forward(shared, self.server_port)
+        elif self.client is not None:
+            self.client.close()
+
+    def get_transport(self):
+        """
+        Returns the paramiko transport carrying this tunnel
+        :return: paramiko.Transport or None if the tunnel is not connected
+        """
+        if self.shared_transport is not None:
+            return self.shared_transport.transport
+        return self.client.get_transport() if self.client is not None else None
+
+    def is_connected(self) -> bool:
+        """Returns True if the ssh transport of this tunnel is active"""
+        transport = self.get_transport()
+        return transport is not None and transport.is_active()
+
+    def reconnect(self):
+        """Reopens the ssh connection with the same key and forwarded port. The API server is not contacted"""
+        with self.__connection_lock__:
+            if not self.is_alive or self.__draining__:
+                return
+            try:
+                self.__disconnect__()
+            except Exception:
+                pass  # The old connection is already dead
+            self.__connect__()
+
+    def start(self):
         self.is_alive = True
+        self.__draining__ = False
+        self.upstream.start()
+        try:
+            with self.__connection_lock__:
+                self.__connect__()
+        except Exception:
+            self.is_alive = False
+            self.upstream.close()
+            raise
+        self.state = TunnelState.UP
+        if self.supervisor is not None:
+            self.supervisor.watch(self)
+
+    def begin_drain(self):
+        """
+        Cancels the port forward on the server, so no new connections are accepted
+        and another process can take the tunnel over. Active channels keep being relayed
+        """
+        if not self.is_alive or self.__draining__:
+            return
+        self.__draining__ = True
+        if self.supervisor is not None:
+            self.supervisor.drain(self)
+        else:
+            self.state = TunnelState.DRAINING
+        with self.__connection_lock__:
+            try:
+                self.__cancel_forward__()
+            except Exception:
+                pass  # A dead transport has no channels left to wait for
+
+    def wait_drained(self, timeout: float) -> bool:
+        """
+        Waits until all active channels are closed
+        :param timeout: Max wait in seconds
+        :return: True if no channel is active anymore, False if the timeout expired
+        """
+        deadline = time.monotonic() + timeout
+        while self.active_channels:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(DRAIN_POLL_INTERVAL, remaining))
+        return True
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Stops accepting new channels and waits for the active ones to finish. Call stop() afterwards
+        :param timeout: Max wait in seconds
+        :return: True if all channels finished in time
+        """
+        self.begin_drain()
+        return self.wait_drained(timeout)
 
-    def stop(self):
+    def stop(self, drain_timeout: float = 0):
+        """
+        Closes the ssh connection
+        :param drain_timeout: If positive, the forward is cancelled first and active channels may finish
+        for up to this many seconds before the connection is closed. Channels still active then are cut off
+        """
         if not self.is_alive:
             raise Exception("Nothing to stop")
+        if drain_timeout > 0:
+            self.drain(drain_timeout)
         self.is_alive = False
-        self.client.close()
+        self.__draining__ = False
+        if self.supervisor is not None:
+            self.supervisor.unwatch(self)
+        self.state = TunnelState.STOPPED
+        with self.__connection_lock__:
+            self.__disconnect__()
+        self.upstream.close()
 
 
 class Tunnel(SSHReverseTunnelForwarder):
@@ -104,7 +263,17 @@ class Tunnel(SSHReverseTunnelForwarder):
 
     def __init__(self, web_api: WebAPI, subdomain: str, ssh_key_id="", client_name="any", client_addr="127.0.0.1",
                  client_port=5555, allow_external_tcp=False, password_protect=False, username="", password="",
-                 tls_termination="server", **kwargs):
+                 tls_termination="server", relay: RelayEngine = None, tunnel_info: dict = None,
+                 transport_manager: TransportManager = None, supervisor: TunnelSupervisor = None,
+                 upstream: Upstream = None, limits: RelayLimits = None, **kwargs):
+        """
+        Registers the tunnel in the boring proxy API server unless tunnel_info is given
+        :param tunnel_info: Already known tunnel info from a get_tunnels snapshot
+        :param upstream: Connection options of the local service, e.g. a connect timeout or a pool
+        of pre-warmed connections, or an UpstreamGroup (or a list of backends) to balance channels
+        over several local services. Built from client_addr:client_port by default
+        :param limits: Optional bandwidth and connection limits of this tunnel, RelayLimits or a dict of its parameters
+        """
         client_port = int(client_port) if isinstance(client_port, str) else client_port
 
         self.__bp_web_api = web_api
@@ -119,21 +288,80 @@ class Tunnel(SSHReverseTunnelForwarder):
         self.__username__ = username
         self.__password__ = password
         self.__tls_termination__ = tls_termination
+        self.__relay__ = relay
+        self.__transport_manager__ = transport_manager
+        self.__supervisor__ = supervisor
+        self.__upstream__ = upstream
+        self.__upstream_spec__ = upstream_spec(upstream)
+        self.__limits__ = RelayLimits.from_value(limits)
+        self.__metrics__ = get_default_registry().tunnel(self.__subdomain__)
         self.__kwargs__ = kwargs
-        tunnel_info = self.__register_tunnel__()
-        ssh_pkey = RSAKey.from_private_key(file_obj=StringIO(tunnel_info["tunnel_private_key"]))
+        self.tunnel_info = None
+        self.__forwarder_info__ = None
+        self.__setup_forwarder__(tunnel_info if tunnel_info is not None else self.__register_tunnel__())
+
+    @property
+    def web_api(self) -> WebAPI:
+        """WebAPI object used by this tunnel"""
+        return self.__bp_web_api
+
+    @property
+    def subdomain(self) -> str:
+        """Full domain of this tunnel"""
+        return self.__subdomain__
+
+    @property
+    def options(self) -> dict:
+        """Registration parameters of this tunnel, as passed to open_tunnel"""
+        return dict(ssh_key_id=self.__ssh_key_id__, client_addr=self.__client_addr__,
+                    client_port=self.__client_port__, allow_external_tcp=self.__allow_external_tcp__,
+                    password_protect=self.__password_protect__, username=self.__username__,
+                    password=self.__password__, tls_termination=self.__tls_termination__, **self.__kwargs__)
+
+    @property
+    def upstream_spec(self):
+        """Configuration of the upstream argument this tunnel was opened with, see upstream.upstream_spec"""
+        return self.__upstream_spec__
+
+    def stats(self) -> dict:
+        """
+        Returns traffic metrics of this tunnel
+        :return: dict with bytes in/out, connection counters and the connection duration histogram
+        """
+        return self.__metrics__.snapshot()
+
+    def __setup_forwarder__(self, tunnel_info: dict):
+        """
+        Initializes the ssh forwarder from the tunnel info returned by the API server.
+        Nothing is done if the forwarder is already set up from the same info.
+        """
+        if tunnel_info == self.__forwarder_info__:
+            self.tunnel_info = tunnel_info
+            return
+        ssh_pkey = load_private_key(tunnel_info["tunnel_private_key"], self.__subdomain__)
         super().__init__(hostname=tunnel_info["server_address"],
                          port=tunnel_info["server_port"],
                          username=tunnel_info["username"],
                          pkey=ssh_pkey,
                          server_port=tunnel_info["tunnel_port"],
-                         remote_host=client_addr,
-                         remote_port=client_port)
+                         remote_host=self.__client_addr__,
+                         remote_port=self.__client_port__,
+                         relay=self.__relay__,
+                         transport_manager=self.__transport_manager__,
+                         supervisor=self.__supervisor__,
+                         metrics=self.__metrics__,
+                         upstream=self.__upstream__,
+                         limits=self.__limits__)
+        self.__upstream__ = self.upstream  # Keep pools and backend health across restarts
+        self.tunnel_info = self.__forwarder_info__ = tunnel_info
 
     def __register_tunnel__(self):
-        """Registers ssh tunnel in the boring proxy API server"""
-        all_tunnels = self.__bp_web_api.get_tunnels(self.__client_name__)
-        if self.__subdomain__ not in all_tunnels.keys():
+        """
+        Registers ssh tunnel in the boring proxy API server.
+        Only this tunnel is looked up, the list of the other tunnels of the client is not kept in memory
+        """
+        tunnel_info = self.__bp_web_api.get_tunnel(self.__subdomain__, self.__client_name__)
+        if tunnel_info is None:
             self.__bp_web_api.add_tunnel(self.__subdomain__,
                                          ssh_key_id=self.__ssh_key_id__, client_name=self.__client_name__,
                                          client_addr=self.__client_addr__,
@@ -142,27 +370,40 @@ class Tunnel(SSHReverseTunnelForwarder):
                                          password_protect=self.__password_protect__, username=self.__username__,
                                          password=self.__password__,
                                          tls_termination=self.__tls_termination__, **self.__kwargs__)
-            all_tunnels = self.__bp_web_api.get_tunnels(self.__client_name__)
-        tunnel_info = all_tunnels[self.__subdomain__]
+            tunnel_info = self.__bp_web_api.get_tunnel(self.__subdomain__, self.__client_name__)
+        if tunnel_info is None:
+            raise KeyError("Tunnel %s is not registered on the server" % self.__subdomain__)
         return tunnel_info
 
-    def start(self):
-        """Registers a tunnel with a boring proxy api and starts an ssh tunnel"""
-        tunnel_info = self.__register_tunnel__()
-        ssh_pkey = RSAKey.from_private_key(StringIO(tunnel_info["tunnel_private_key"]))
-        super().__init__(hostname=tunnel_info["server_address"],
-                         port=tunnel_info["server_port"],
-                         username=tunnel_info["username"],
-                         pkey=ssh_pkey,
-                         server_port=tunnel_info["tunnel_port"],
-                         remote_host=self.__client_addr__,
-                         remote_port=self.__client_port__)
+    def set_limits(self, limits):
+        super().set_limits(limits)
+        self.__limits__ = self.limits  # Kept when the forwarder is set up again on restart
+
+    def start(self, register=None):
+        """
+        Registers a tunnel with a boring proxy api and starts an ssh tunnel
+        :param register: If True, the tunnel info is always fetched from the server again.
+        By default, the known tunnel info is reused and the tunnel is registered
+        only after it was removed from the server by stop()
+        """
+        if register or self.tunnel_info is None:
+            self.__setup_forwarder__(self.__register_tunnel__())
+        else:
+            self.__setup_forwarder__(self.tunnel_info)
         super(Tunnel, self).start()
 
-    def stop(self):
-        """Stops the ssh tunnel and removes the tunnel from boring proxy api server"""
-        super(Tunnel, self).stop()
+    def stop(self, drain_timeout: float = 0):
+        """
+        Stops the ssh tunnel and removes the tunnel from boring proxy api server
+        :param drain_timeout: Seconds active connections may take to finish before they are cut off.
+        The tunnel is removed from the server only after that
+        """
+        super(Tunnel, self).stop(drain_timeout)
+        self.tunnel_info = None
         self.__bp_web_api.delete_tunnel(self.__subdomain__)
 
     def __del__(self):
-        self.stop()
+        # A running tunnel is referenced by its transport and supervisor, so this only catches tunnels
+        # which were never stopped. Finalizers make no network calls, removing the tunnel is the job of stop()
+        if getattr(self, "is_alive", False):
+            warnings.warn("Tunnel %r was not stopped" % self.__subdomain__, ResourceWarning, source=self)
@@ -0,0 +1,187 @@
+"""Reconnect supervisor for ssh tunnels"""
+import random
+import threading
+import time
+
+
+class TunnelState:
+    """States published by TunnelSupervisor"""
+    UP = "up"
+    DOWN = "down"
+    RECONNECTING = "reconnecting"
+    DRAINING = "draining"  # Not accepting new connections, active ones are finishing
+    STOPPED = "stopped"
+
+
+class _Watch:
+    """Supervision record of one forwarder"""
+    __slots__ = ("forwarder", "state", "attempts", "next_attempt", "down_since", "pending")
+
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.state = TunnelState.UP
+        self.attempts = 0
+        self.next_attempt = 0.0
+        self.down_since = 0.0
+        self.pending = False  # A reconnect attempt is running
+
+
+class TunnelSupervisor:
+    """
+    Watches ssh transports of started tunnels and reconnects dropped ones.
+    Liveness is checked with transport.is_active() while keepalives make the
+    transport notice dead connections. Reconnects reuse the parsed key and the
+    forwarded port of the tunnel, so the API server is not contacted.
+    Reconnect attempts run in their own threads, so a slow handshake doesn't delay
+    the checks and reconnects of other tunnels.
+    """
+
+    def __init__(self, check_interval: float = 1.0, keepalive_interval: int = 15,
+                 backoff_base: float = 0.5, backoff_max: float = 30.0, on_state_change=None,
+                 max_concurrent_reconnects: int = 8):
+        """
+        :param check_interval: How often transports are checked in seconds
+        :param keepalive_interval: Ssh keepalive interval set on every watched transport in seconds. 0 disables it
+        :param backoff_base: Delay before the first reconnect attempt in seconds
+        :param backoff_max: Max delay between reconnect attempts in seconds
+        :param on_state_change: Optional callable(forwarder, old_state, new_state)
+        :param max_concurrent_reconnects: Max number of reconnect attempts running at once.
+        Due attempts over the limit start as soon as running ones finish
+        """
+        self.check_interval = check_interval
+        self.keepalive_interval = keepalive_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.on_state_change = on_state_change
+        self.reconnects = 0
+        self.failed_attempts = 0
+        self.__watches__ = {}
+        self.__lock__ = threading.Lock()
+        self.__wakeup__ = threading.Event()
+        self.__thread__ = None
+        self.__stop_event__ = None  # Set to make the current supervision thread exit
+        self.__reconnect_slots__ = threading.BoundedSemaphore(max(1, max_concurrent_reconnects))
+
+    def backoff(self, attempts: int) -> float:
+        """
+        Returns the jittered exponential delay before the next reconnect attempt
+        :param attempts: Number of failed attempts so far
+        """
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempts))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def watch(self, forwarder):
+        """Starts supervising a started forwarder"""
+        self.__set_keepalive__(forwarder)
+        with self.__lock__:
+            self.__watches__[id(forwarder)] = _Watch(forwarder)
+            if self.__thread__ is None:
+                self.__stop_event__ = threading.Event()
+                self.__thread__ = threading.Thread(target=self.__run__, args=(self.__stop_event__,),
+                                                   name="bp-tunnel-supervisor", daemon=True)
+                self.__thread__.start()
+        self.__publish__(forwarder, TunnelState.DOWN, TunnelState.UP)
+
+    def unwatch(self, forwarder):
+        """Stops supervising the forwarder"""
+        with self.__lock__:
+            watch = self.__watches__.pop(id(forwarder), None)
+        if watch is not None:
+            self.__publish__(forwarder, watch.state, TunnelState.STOPPED)
+
+    def drain(self, forwarder):
+        """Marks a watched forwarder as draining. A draining forwarder is not reconnected anymore"""
+        with self.__lock__:
+            watch = self.__watches__.get(id(forwarder))
+            if watch is None:
+                return
+            old_state, watch.state = watch.state, TunnelState.DRAINING
+        self.__publish__(forwarder, old_state, TunnelState.DRAINING)
+
+    def stop(self, timeout: float = None):
+        """
+        Stops the supervision thread. Watching a forwarder afterwards starts a new one
+        :param timeout: Max wait for the thread to exit in seconds, forever by default
+        """
+        with self.__lock__:
+            thread, stop_event, self.__thread__ = self.__thread__, self.__stop_event__, None
+        if thread is None:
+            return
+        stop_event.set()
+        self.__wakeup__.set()
+        if thread is not threading.current_thread():  # Called from on_state_change
+            thread.join(timeout)
+
+    def check_now(self):
+        """Wakes the supervisor up to check all transports immediately"""
+        self.__wakeup__.set()
+
+    def states(self) -> dict:
+        """
+        Returns the current state of every watched forwarder
+        :return: dict forwarder -> state
+        """
+        with self.__lock__:
+            return {watch.forwarder: watch.state for watch in self.__watches__.values()}
+
+    def __set_keepalive__(self, forwarder):
+        transport = forwarder.get_transport()
+        if transport is not None and self.keepalive_interval > 0:
+            transport.set_keepalive(self.keepalive_interval)
+
+    def __publish__(self, forwarder, old_state: str, new_state: str):
+        forwarder.state = new_state
+        if self.on_state_change is not None and old_state != new_state:
+            try:
+                self.on_state_change(forwarder, old_state, new_state)
+            except Exception:
+                pass  # A broken callback must not stop the supervision
+
+    def __run__(self, stop_event: threading.Event):
+        while True:
+            self.__wakeup__.wait(self.check_interval)
+            if stop_event.is_set():
+                return
+            self.__wakeup__.clear()
+            with self.__lock__:
+                watches = list(self.__watches__.values())
+            now = time.monotonic()
+            for watch in watches:
+                forwarder = watch.forwarder
+                if watch.pending or not forwarder.is_alive or watch.state == TunnelState.DRAINING:
+                    continue
+                if watch.state == TunnelState.UP:
+                    if forwarder.is_connected():
+                        continue
+                    watch.state, watch.down_since = TunnelState.DOWN, now
+                    watch.attempts, watch.next_attempt = 0, now + self.backoff(0)
+                    self.__publish__(forwarder, TunnelState.UP, TunnelState.DOWN)
+                if now < watch.next_attempt or not self.__reconnect_slots__.acquire(blocking=False):
+                    continue
+                old_state, watch.state, watch.pending = watch.state, TunnelState.RECONNECTING, True
+                self.__publish__(forwarder, old_state, TunnelState.RECONNECTING)
+                threading.Thread(target=self.__reconnect__, args=(watch,), name="bp-tunnel-reconnect",
+                                 daemon=True).start()
+
+    def __reconnect__(self, watch: _Watch):
+        """Runs one reconnect attempt of the watched forwarder in its own thread"""
+        forwarder = watch.forwarder
+        try:
+            forwarder.reconnect()
+        except Exception:
+            with self.__lock__:
+                self.failed_attempts += 1
+            watch.attempts += 1
+            watch.next_attempt = time.monotonic() + self.backoff(watch.attempts)
+            watch.pending = False
+            return
+        finally:
+            self.__reconnect_slots__.release()
+            self.__wakeup__.set()  # Starts attempts which waited for a free slot
+        with self.__lock__:
+            if self.__watches__.get(id(forwarder)) is not watch:
+                return  # Stopped while reconnecting
+            self.reconnects += 1
+        self.__set_keepalive__(forwarder)
+        watch.state, watch.attempts, watch.pending = TunnelState.UP, 0, False
+        self.__publish__(forwarder, TunnelState.RECONNECTING, TunnelState.UP)
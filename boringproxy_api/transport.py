@@ -0,0 +1,183 @@
+"""Shared ssh transports for reverse tunnels"""
+import threading
+
+import paramiko
+from paramiko import PKey
+
+# Address the boring proxy server binds forwarded ports to
+FORWARD_BIND_ADDRESS = "127.0.0.1"
+
+
+class SharedTransport:
+    """
+    One authenticated ssh connection carrying the port forwards of several tunnels.
+    Incoming channels are dispatched to the tunnel by the forwarded server port.
+    """
+
+    def __init__(self, key: tuple, hostname: str, port: int, username: str, pkey: PKey, timeout: float = None):
+        self.key = key
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        self.client.set_missing_host_key_policy(paramiko.WarningPolicy())
+        self.client.connect(hostname=hostname, port=port, username=username, pkey=pkey, look_for_keys=False,
+                            timeout=timeout)
+        self.transport = self.client.get_transport()
+        self.forwards = {}  # server port -> callable(channel, origin)
+        self.draining = set()  # Cancelled server ports whose accepted channels are still relayed
+        self.lock = threading.Lock()
+
+    def __dispatch__(self, chan, origin, server):
+        """Called by the paramiko transport thread for every forwarded connection"""
+        callback = self.forwards.get(server[1])
+        if callback is None:
+            chan.close()
+            return
+        callback(chan, origin)
+
+    def add_forward(self, server_port: int, callback):
+        """
+        Asks the server to forward server_port over this transport
+        :param server_port: Port on the server
+        :param callback: Called with every accepted channel and its (origin address, origin port)
+        :raises paramiko.SSHException if the server refused the forward
+        """
+        with self.lock:
+            self.forwards[server_port] = callback
+        try:
+            self.transport.request_port_forward(FORWARD_BIND_ADDRESS, server_port, handler=self.__dispatch__)
+        except Exception:
+            with self.lock:
+                self.forwards.pop(server_port, None)
+            raise
+
+    def remove_forward(self, server_port: int, draining: bool = False):
+        """
+        Cancels the forward of server_port. Forwards of other tunnels stay untouched
+        :param draining: The tunnel still relays accepted channels, the transport must stay open until
+        the forward is removed again without this flag
+        """
+        with self.lock:
+            if draining:
+                self.draining.add(server_port)
+            else:
+                self.draining.discard(server_port)
+            if self.forwards.pop(server_port, None) is None:
+                return  # Already cancelled
+        if self.transport.is_active():
+            # Transport.cancel_port_forward also drops the shared channel handler, so the request is sent directly
+            self.transport.global_request("cancel-tcpip-forward", (FORWARD_BIND_ADDRESS, server_port), wait=True)
+
+    @property
+    def forwards_count(self) -> int:
+        return len(self.forwards)
+
+    @property
+    def in_use(self) -> bool:
+        return bool(self.forwards or self.draining)
+
+    def close(self):
+        self.client.close()
+
+
+class TransportManager:
+    """
+    Keeps one ssh transport per (server address, server port, username, key) and
+    multiplexes the port forwards of all tunnels using the same credentials over it.
+    Tunnels registered with the same ssh_key_id share a key and therefore one transport.
+    """
+
+    def __init__(self, connect_timeout: float = 10):
+        """
+        :param connect_timeout: Timeout of new ssh connections in seconds
+        """
+        self.connect_timeout = connect_timeout
+        self.__transports__ = {}
+        self.__key_locks__ = {}  # Handshakes to different servers or with different keys run in parallel
+        self.__lock__ = threading.Lock()
+
+    def __key_lock__(self, key: tuple) -> threading.Lock:
+        with self.__lock__:
+            return self.__key_locks__.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def __make_key__(hostname: str, port: int, username: str, pkey: PKey) -> tuple:
+        return hostname, int(port), username, pkey.get_name(), pkey.get_fingerprint()
+
+    def open_forward(self, hostname: str, port: int, username: str, pkey: PKey, server_port: int,
+                     callback) -> SharedTransport:
+        """
+        Forwards server_port over a shared transport, connecting it if needed
+        :param hostname: Ssh server address
+        :param port: Ssh server port
+        :param username: Ssh user name
+        :param pkey: Private key of the tunnel
+        :param server_port: Port on the server to forward
+        :param callback: Called with every accepted channel and its (origin address, origin port)
+        :return: SharedTransport object to pass to close_forward
+        """
+        key = self.__make_key__(hostname, port, username, pkey)
+        with self.__key_lock__(key):
+            shared = self.__transports__.get(key)
+            if shared is None or not shared.transport.is_active():
+                shared = SharedTransport(key, hostname, port, username, pkey, self.connect_timeout)
+                with self.__lock__:
+                    self.__transports__[key] = shared
+            try:
+                shared.add_forward(server_port, callback)
+            except Exception:
+                self.__release__(shared)
+                raise
+        return shared
+
+    def cancel_forward(self, shared: SharedTransport, server_port: int):
+        """
+        Cancels the forward but keeps the transport, so channels accepted before stay open until close_forward
+        :param shared: SharedTransport returned by open_forward
+        :param server_port: Forwarded server port
+        """
+        with self.__key_lock__(shared.key):
+            shared.remove_forward(server_port, draining=True)
+
+    def close_forward(self, shared: SharedTransport, server_port: int):
+        """
+        Cancels the forward and closes the transport when no tunnel uses it anymore
+        :param shared: SharedTransport returned by open_forward
+        :param server_port: Forwarded server port
+        """
+        with self.__key_lock__(shared.key):
+            try:
+                shared.remove_forward(server_port)
+            finally:
+                self.__release__(shared)
+
+    def __release__(self, shared: SharedTransport):
+        if not shared.in_use:
+            with self.__lock__:
+                if self.__transports__.get(shared.key) is shared:
+                    del self.__transports__[shared.key]
+            shared.close()
+
+    def stats(self) -> dict:
+        """
+        Returns the number of ssh transports and forwards carried by them
+        :return: dict
+        """
+        with self.__lock__:
+            return {"transports": len(self.__transports__),
+                    "forwards": sum(t.forwards_count for t in self.__transports__.values())}
+
+
+__default_transport_manager__ = None
+__default_transport_manager_lock__ = threading.Lock()
+
+
+def get_default_transport_manager() -> TransportManager:
+    """
+    Returns the process-wide transport manager
+    :return: TransportManager object
+    """
+    global __default_transport_manager__
+    with __default_transport_manager_lock__:
+        if __default_transport_manager__ is None:
+            __default_transport_manager__ = TransportManager()
+        return __default_transport_manager__
@@ -0,0 +1,247 @@
+"""Compact tunnel records and incremental parsing of tunnel lists"""
+import codecs
+import json
+import re
+import sys
+
+# Fields of a tunnel in get_tunnels results, kept in slots instead of a dict per tunnel
+TUNNEL_FIELDS = ("domain", "owner", "server_address", "server_port", "server_public_key", "username",
+                 "tunnel_port", "tunnel_private_key", "client_name", "client_address", "client_port",
+                 "allow_external_tcp", "password_protect", "tls_termination")
+# Fields whose values repeat across tunnels, one string object is shared by all records
+INTERNED_FIELDS = frozenset(("owner", "server_address", "server_public_key", "username", "client_name",
+                             "client_address", "tls_termination"))
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DELIMITERS = frozenset(" \t\n\r,:}")
+
+
+class TunnelInfo:
+    """
+    Tunnel description returned by the API server.
+    Fields are attributes, dict-style access (info["tunnel_port"], info.get(...)) works as well.
+    Fields unknown to this version of the library are kept in `extra`.
+    """
+    __slots__ = TUNNEL_FIELDS + ("extra",)
+
+    def __init__(self, **fields):
+        for name in TUNNEL_FIELDS:
+            setattr(self, name, None)
+        self.extra = None
+        for name, value in fields.items():
+            self[name] = value
+
+    @classmethod
+    def from_dict(cls, info: dict, domain: str = None) -> "TunnelInfo":
+        """
+        :param info: Tunnel dict as returned by the API server
+        :param domain: Domain the tunnel is listed under, if the dict doesn't contain it
+        """
+        record = cls.__new__(cls)
+        for name in TUNNEL_FIELDS:
+            value = info.get(name)
+            setattr(record, name, sys.intern(value) if name in INTERNED_FIELDS and type(value) is str else value)
+        record.extra = None
+        if len(info) > sum(1 for name in TUNNEL_FIELDS if name in info):
+            record.extra = {name: value for name, value in info.items() if name not in TUNNEL_FIELDS}
+        if record.domain is None:
+            record.domain = domain
+        return record
+
+    def __setitem__(self, name: str, value):
+        if name in INTERNED_FIELDS and type(value) is str:
+            value = sys.intern(value)
+        if name in TUNNEL_FIELDS:
+            setattr(self, name, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = value
+
+    def __getitem__(self, name: str):
+        if name in TUNNEL_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                return value
+        elif self.extra is not None and name in self.extra:
+            return self.extra[name]
+        raise KeyError(name)
+
+    def __contains__(self, name: str) -> bool:
+        try:
+            self[name]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, name: str, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> dict:
+        """Returns the tunnel as the dict the API server sent"""
+        result = {name: getattr(self, name) for name in TUNNEL_FIELDS if getattr(self, name) is not None}
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+    def __eq__(self, other):
+        if isinstance(other, TunnelInfo):
+            other = other.to_dict()
+        return isinstance(other, dict) and self.to_dict() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "TunnelInfo(%r, tunnel_port=%r, client_name=%r)" % (self.domain, self.tunnel_port, self.client_name)
+
+
+class JSONObjectStream:
+    """
+    Incremental parser of a JSON object. Members are returned as soon as they are complete,
+    so only the member being received is kept in memory, not the whole document.
+    """
+    _START, _FIRST_KEY, _KEY, _COLON, _VALUE, _NEXT, _END = range(7)
+
+    def __init__(self):
+        self.__text_decoder__ = codecs.getincrementaldecoder("utf-8")()
+        self.__json_decoder__ = json.JSONDecoder()
+        self.__buffer__ = ""
+        self.__state__ = self._START
+        self.__key__ = None
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        Parses the next chunk of the document
+        :return: list of (key, value) members completed by this chunk
+        """
+        return self.__parse__(self.__text_decoder__.decode(chunk), False)
+
+    def close(self) -> list:
+        """
+        Finishes parsing
+        :return: list of (key, value) members completed by the rest of the document
+        :raises ValueError if the document is not a complete JSON object
+        """
+        members = self.__parse__(self.__text_decoder__.decode(b"", True), True)
+        if self.__state__ != self._END:
+            raise ValueError("Truncated JSON object")
+        return members
+
+    def __decode__(self, buffer: str, pos: int, final: bool):
+        """
+        Decodes the JSON value starting at pos
+        :return: (value, end) or None if more data is needed
+        """
+        try:
+            value, end = self.__json_decoder__.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return None
+        if not final and (end >= len(buffer) or buffer[end] not in _DELIMITERS):
+            return None  # A number cut by the end of the chunk, e.g. "-1" of "-1.5", continues in the next one
+        return value, end
+
+    def __parse__(self, text: str, final: bool) -> list:
+        buffer = self.__buffer__ + text
+        pos = 0
+        members = []
+        state = self.__state__
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos >= len(buffer):
+                break
+            char = buffer[pos]
+            if state == self._START:
+                if buffer.startswith("null", pos):  # Servers written in Go send null for an empty map
+                    pos, state = pos + 4, self._END
+                elif char == "{":
+                    pos, state = pos + 1, self._FIRST_KEY
+                elif "null".startswith(buffer[pos:]) and not final:
+                    break
+                else:
+                    raise ValueError("Expected a JSON object at position %d" % pos)
+            elif state in (self._FIRST_KEY, self._KEY):
+                if char == "}" and state == self._FIRST_KEY:
+                    pos, state = pos + 1, self._END
+                elif char == '"':
+                    decoded = self.__decode__(buffer, pos, final)
+                    if decoded is None:
+                        break
+                    self.__key__, pos = decoded
+                    state = self._COLON
+                else:
+                    raise ValueError("Expected a key at position %d" % pos)
+            elif state == self._COLON:
+                if char != ":":
+                    raise ValueError("Expected ':' at position %d" % pos)
+                pos, state = pos + 1, self._VALUE
+            elif state == self._VALUE:
+                decoded = self.__decode__(buffer, pos, final)
+                if decoded is None:
+                    break
+                value, pos = decoded
+                members.append((self.__key__, value))
+                state = self._NEXT
+            elif state == self._NEXT:
+                if char == ",":
+                    pos, state = pos + 1, self._KEY
+                elif char == "}":
+                    pos, state = pos + 1, self._END
+                else:
+                    raise ValueError("Expected ',' or '}' at position %d" % pos)
+            else:
+                raise ValueError("Extra data at position %d" % pos)
+        self.__buffer__ = buffer[pos:]
+        self.__state__ = state
+        return members
+
+
+class TunnelListParser:
+    """
+    Incremental parser of the get_tunnels response.
+    Turns the tunnels into TunnelInfo records as they are received, skipping the filtered out ones
+    """
+
+    def __init__(self, domains=None, client_name: str = ""):
+        """
+        :param domains: Set of full domains to keep, all tunnels by default
+        :param client_name: Client name to keep, all clients by default
+        """
+        self.__stream__ = JSONObjectStream()
+        self.__remaining__ = set(domains) if domains is not None else None
+        self.__client_name__ = client_name
+
+    @property
+    def done(self) -> bool:
+        """True when all requested domains are found and the rest of the response may be dropped"""
+        return self.__remaining__ is not None and not self.__remaining__
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        :param chunk: Next chunk of the response body
+        :return: list of TunnelInfo completed by this chunk
+        """
+        return self.__select__(self.__stream__.feed(chunk))
+
+    def close(self) -> list:
+        """
+        :return: list of TunnelInfo completed by the rest of the response
+        :raises ValueError if the response was truncated
+        """
+        return self.__select__(self.__stream__.close())
+
+    def __select__(self, members: list) -> list:
+        records = []
+        for domain, info in members:
+            if self.__remaining__ is not None:
+                if domain not in self.__remaining__:
+                    continue
+                self.__remaining__.discard(domain)
+            if self.__client_name__ and isinstance(info, dict) \
+                    and info.get("client_name", self.__client_name__) != self.__client_name__:
+                continue
+            records.append(TunnelInfo.from_dict(info, domain))
+        return records
@@ -0,0 +1,344 @@
+"""Connections from tunnels to the local service"""
+import collections
+import errno
+import itertools
+import socket
+import threading
+import time
+import zlib
+
+# Prefix of client addresses which name a Unix domain socket, e.g. unix:/run/app.sock
+UNIX_PREFIX = "unix:"
+# Delay before the pool filler retries after a failed connect
+POOL_RETRY_INTERVAL = 1.0
+# Backend selection strategies of UpstreamGroup
+ROUND_ROBIN = "round_robin"
+LEAST_CONNECTIONS = "least_connections"
+HASH = "hash"
+
+
+class Upstream:
+    """
+    Local service a tunnel forwards its channels to.
+    Creates non-blocking sockets for the relay, optionally handing out
+    connections pre-warmed by a background thread.
+    """
+
+    def __init__(self, address, connect_timeout: float = 5.0, nodelay: bool = True, keepalive: bool = False,
+                 pool_size: int = 0):
+        """
+        :param address: (host, port) tuple of a TCP service or a path of a Unix domain socket
+        :param connect_timeout: Channels whose connect takes longer are closed, in seconds. 0 disables it
+        :param nodelay: Disable Nagle's algorithm on TCP connections
+        :param keepalive: Enable TCP keepalive on connections
+        :param pool_size: Number of idle connections kept open in advance. 0 disables the pool
+        """
+        if isinstance(address, str):
+            self.family = socket.AF_UNIX
+            self.address = address[len(UNIX_PREFIX):] if address.startswith(UNIX_PREFIX) else address
+        else:
+            host, port = address
+            self.family = socket.AF_INET6 if ":" in host else socket.AF_INET
+            self.address = (host, int(port))
+        self.connect_timeout = connect_timeout
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.pool_size = pool_size
+        self.attempts = 1  # How many backends the relay tries for one channel
+        self.pool_hits = 0
+        self.pool_misses = 0
+        self.__pool__ = collections.deque()
+        self.__pool_lock__ = threading.Lock()
+        self.__refill__ = threading.Event()
+        self.__filler__ = None
+        self.__closed__ = threading.Event()
+
+    @classmethod
+    def from_address(cls, host: str, port: int, **kwargs) -> "Upstream":
+        """
+        Creates an upstream from the client address and port of a tunnel.
+        Addresses starting with unix: name a Unix domain socket, the port is ignored then.
+        """
+        if host.startswith(UNIX_PREFIX):
+            return cls(host, **kwargs)
+        return cls((host, port), **kwargs)
+
+    def __repr__(self):
+        return "Upstream(%r)" % (self.address,)
+
+    @property
+    def spec(self) -> dict:
+        """Configuration of this upstream as plain data, equal for equally configured upstreams"""
+        return {"address": self.address, "connect_timeout": self.connect_timeout, "nodelay": self.nodelay,
+                "keepalive": self.keepalive, "pool_size": self.pool_size}
+
+    def acquire(self, origin=None) -> "Upstream":
+        """
+        Returns the upstream to connect the next channel to. Called by the relay
+        :param origin: (address, port) of the peer which opened the channel on the ssh server, if known
+        """
+        return self
+
+    def report(self, upstream: "Upstream", ok: bool):
+        """Records the connect outcome of an acquired upstream. Called by the relay"""
+
+    def release(self, upstream: "Upstream"):
+        """Returns an acquired upstream after its connection was closed. Called by the relay"""
+
+    def create_socket(self, timeout: float = 0.0) -> socket.socket:
+        """
+        Creates a socket with the configured options
+        :param timeout: Socket timeout, non-blocking by default, None blocks
+        """
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family != socket.AF_UNIX:
+            if self.nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.keepalive:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.settimeout(timeout)
+        return sock
+
+    def open(self):
+        """
+        Returns a connection to the service, taken from the pool if possible
+        :return: (socket, connected) where connected is False while the connect is in progress
+        :raises OSError if the connect failed immediately
+        """
+        sock = self.__take_pooled__()
+        if sock is not None:
+            return sock, True
+        sock = self.create_socket()
+        try:
+            err = sock.connect_ex(self.address)
+        except OSError:
+            sock.close()
+            raise
+        in_progress = (errno.EINPROGRESS,) if self.family == socket.AF_UNIX else (errno.EINPROGRESS,
+                                                                                   errno.EWOULDBLOCK)
+        if err != 0 and err not in in_progress:
+            sock.close()
+            raise OSError(err, "Connect to %s failed" % (self.address,))
+        return sock, err == 0
+
+    def start(self):
+        """Starts filling the pool of pre-warmed connections, if enabled"""
+        if self.pool_size <= 0:
+            return
+        with self.__pool_lock__:
+            self.__closed__.clear()
+            if self.__filler__ is None or not self.__filler__.is_alive():
+                self.__filler__ = threading.Thread(target=self.__fill__, name="bp-upstream-pool", daemon=True)
+                self.__filler__.start()
+        self.__refill__.set()
+
+    def close(self):
+        """Stops the pool filler and closes idle pooled connections"""
+        with self.__pool_lock__:
+            self.__closed__.set()
+            pooled, self.__pool__ = list(self.__pool__), collections.deque()
+        self.__refill__.set()
+        for sock in pooled:
+            sock.close()
+
+    def stats(self) -> dict:
+        """
+        Returns pool counters
+        :return: dict with idle pooled connections, pool hits and misses
+        """
+        return {"address": self.address, "pooled": len(self.__pool__),
+                "pool_hits": self.pool_hits, "pool_misses": self.pool_misses}
+
+    def __take_pooled__(self):
+        if self.pool_size <= 0:
+            return None
+        while True:
+            try:
+                sock = self.__pool__.popleft()
+            except IndexError:
+                self.pool_misses += 1
+                self.__refill__.set()
+                return None
+            self.__refill__.set()
+            if _is_alive(sock):
+                self.pool_hits += 1
+                return sock
+            sock.close()  # Closed by the service while idle
+
+    def __fill__(self):
+        while True:
+            self.__refill__.wait()
+            self.__refill__.clear()
+            while len(self.__pool__) < self.pool_size and not self.__closed__.is_set():
+                sock = self.create_socket(self.connect_timeout or None)
+                try:
+                    sock.connect(self.address)
+                except OSError:
+                    sock.close()
+                    self.__closed__.wait(POOL_RETRY_INTERVAL)
+                    continue
+                sock.setblocking(False)
+                with self.__pool_lock__:
+                    if self.__closed__.is_set():
+                        sock.close()
+                        break
+                    self.__pool__.append(sock)
+            if self.__closed__.is_set():
+                return
+
+
+class _Backend:
+    """Load and health counters of one backend of UpstreamGroup"""
+    __slots__ = ("upstream", "active", "total", "fails", "down_until")
+
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+        self.active = 0
+        self.total = 0
+        self.fails = 0  # Consecutive failed connects
+        self.down_until = 0.0
+
+
+class UpstreamGroup:
+    """
+    Several local services behind one tunnel.
+    Every channel is connected to a backend chosen by the balancing strategy.
+    Backends whose connects fail max_fails times in a row are skipped for fail_timeout seconds,
+    and a channel whose connect failed is retried on the next backend.
+    """
+
+    def __init__(self, backends: list, balance: str = ROUND_ROBIN, max_fails: int = 1, fail_timeout: float = 10.0,
+                 hash_key=None, **options):
+        """
+        :param backends: List of Upstream objects or addresses accepted by Upstream
+        :param balance: round_robin, least_connections or hash
+        :param max_fails: Consecutive failed connects after which a backend is considered down
+        :param fail_timeout: How long a backend that is down is skipped, in seconds
+        :param hash_key: Callable(origin) returning the str or bytes hashed by the hash strategy, required by it.
+        The origin is the (address, port) the ssh server reports for the channel. For HTTP tunnels the boringproxy
+        server connects to the tunnel itself, so the origin is a loopback address which carries no client identity.
+        Only raw TCP tunnels (allow_external_tcp) see the address of the real peer,
+        e.g. hash_key=lambda origin: origin[0] keeps every peer on one backend
+        :param options: Upstream options (connect_timeout, pool_size...) for backends given as addresses
+        """
+        if not backends:
+            raise ValueError("At least one backend is required")
+        if balance not in (ROUND_ROBIN, LEAST_CONNECTIONS, HASH):
+            raise ValueError("Unknown balancing strategy: %s" % balance)
+        if balance == HASH and hash_key is None:
+            raise ValueError("The hash strategy requires hash_key")
+        self.balance = balance
+        self.max_fails = max_fails
+        self.fail_timeout = fail_timeout
+        self.hash_key = hash_key
+        self.__backends__ = [_Backend(backend if isinstance(backend, Upstream) else Upstream(backend, **options))
+                             for backend in backends]
+        self.__by_upstream__ = {id(backend.upstream): backend for backend in self.__backends__}
+        self.__counter__ = itertools.count()
+        self.__lock__ = threading.Lock()
+        self.attempts = len(self.__backends__)
+
+    def __repr__(self):
+        return "UpstreamGroup(%r, %r)" % ([backend.upstream.address for backend in self.__backends__], self.balance)
+
+    @property
+    def backends(self) -> list:
+        """Upstream objects of all backends"""
+        return [backend.upstream for backend in self.__backends__]
+
+    @property
+    def spec(self) -> dict:
+        """Configuration of this group and its backends as plain data, see Upstream.spec"""
+        return {"balance": self.balance, "max_fails": self.max_fails, "fail_timeout": self.fail_timeout,
+                "hash_key": self.hash_key, "backends": [backend.upstream.spec for backend in self.__backends__]}
+
+    def acquire(self, origin=None) -> Upstream:
+        """
+        Chooses the backend for the next channel, skipping backends that are down.
+        If all backends are down, the one which went down first is tried.
+        :param origin: (address, port) of the peer which opened the channel on the ssh server, if known
+        """
+        now = time.monotonic()
+        backends = self.__backends__
+        with self.__lock__:
+            healthy = [backend for backend in backends if backend.down_until <= now]
+            if not healthy:
+                backend = min(backends, key=lambda b: b.down_until)
+            elif self.balance == LEAST_CONNECTIONS:
+                backend = min(healthy, key=lambda b: b.active)
+            elif self.balance == HASH and origin is not None:
+                key = self.hash_key(origin)
+                key = key.encode() if isinstance(key, str) else key
+                # Index into all backends, so a failed backend only moves its own share of clients
+                backend = backends[zlib.crc32(key) % len(backends)]
+                if backend.down_until > now:
+                    backend = healthy[zlib.crc32(key) % len(healthy)]
+            else:
+                backend = healthy[next(self.__counter__) % len(healthy)]
+            backend.active += 1
+            backend.total += 1
+        return backend.upstream
+
+    def report(self, upstream: Upstream, ok: bool):
+        """Records the connect outcome, marking the backend down after max_fails failures in a row"""
+        backend = self.__by_upstream__[id(upstream)]
+        with self.__lock__:
+            if ok:
+                backend.fails = 0
+                backend.down_until = 0.0
+                return
+            backend.fails += 1
+            if backend.fails >= self.max_fails:
+                backend.down_until = time.monotonic() + self.fail_timeout
+
+    def release(self, upstream: Upstream):
+        """Decrements the active connections of the backend"""
+        backend = self.__by_upstream__[id(upstream)]
+        with self.__lock__:
+            backend.active -= 1
+
+    def start(self):
+        """Starts connection pools of all backends"""
+        for backend in self.__backends__:
+            backend.upstream.start()
+
+    def close(self):
+        """Closes connection pools of all backends"""
+        for backend in self.__backends__:
+            backend.upstream.close()
+
+    def stats(self) -> dict:
+        """
+        Returns load and health of every backend
+        :return: dict with the strategy and a list of per-backend counters
+        """
+        now = time.monotonic()
+        with self.__lock__:
+            backends = [dict(backend.upstream.stats(), active=backend.active, total=backend.total,
+                             fails=backend.fails, healthy=backend.down_until <= now)
+                        for backend in self.__backends__]
+        return {"balance": self.balance, "backends": backends}
+
+
+def upstream_spec(upstream):
+    """
+    Returns the configuration of an upstream argument of a tunnel as plain data,
+    so a desired tunnel can be compared with an opened one
+    :param upstream: Upstream, UpstreamGroup, list of backends or None for the default upstream
+    :return: dict or None
+    """
+    if upstream is None:
+        return None
+    if isinstance(upstream, list):
+        upstream = UpstreamGroup(upstream)  # Nothing is connected before start()
+    return upstream.spec
+
+
+def _is_alive(sock: socket.socket) -> bool:
+    """Checks an idle non-blocking connection without consuming data"""
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b""
+    except (BlockingIOError, InterruptedError):
+        return True
+    except OSError:
+        return False
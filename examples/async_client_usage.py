@@ -0,0 +1,24 @@
+# You can partially check it out on this demo instance:https://bpdemo.brng.pro
+# First of all, register a demo account here: https://boringproxy.io/
+import asyncio
+
+from boringproxy_api import AsyncClient, ClientConfig
+
+client_config = ClientConfig()
+
+client_config.user = "admin"
+client_config.token = "dwaudawiudhauwihdiuaw21312"
+client_config.admin_domain = "tunnels.example.com"
+
+
+async def main():
+    async with AsyncClient(client_config) as bp_client:  # Register client in bp server
+        tunnels = await asyncio.gather(*[bp_client.open_tunnel("test%d.tunnels.example.com" % i,
+                                                               client_addr="127.0.0.1",
+                                                               client_port=8080) for i in range(10)])
+        await asyncio.gather(*[tunnel.start() for tunnel in tunnels])  # Open ssh tunnels
+        await bp_client.close_tunnel(tunnels[0])  # Close one tunnel
+    # All tunnels are closed and the client is unregistered on exit
+
+
+asyncio.run(main())
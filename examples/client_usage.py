@@ -21,7 +21,18 @@ tunnel2.start()
 
 all_tunnels = bp_client.get_all_opened_tunnels()  # Get list of all opened tunnels by this client
 
-bp_client.close_tunnel(tunnel)  # Close one tunnel
+bp_client.close_tunnel(tunnel, drain_timeout=10)  # Close one tunnel, letting active connections finish first
 bp_client.close_all_tunnels()  # Close all tunnels opened by this client
 
-del bp_client  # Unregister client in bp server
+bp_client.close()  # Unregister client in bp server
+
+# Or let the client clean up by itself: on leaving the block, or on SIGTERM/SIGINT,
+# the tunnels stop accepting connections, active ones get up to drain_timeout seconds to finish,
+# then the tunnels and the client are removed from the bp server
+client_config.drain_timeout = 10
+with Client(client_config) as bp_client:
+    bp_client.install_signal_handlers()
+    # Relay at most 10 MiB/s and 100 connections at once for this tunnel, extra connections are rejected
+    bp_client.open_tunnel("test", client_port=8080,
+                          limits={"bytes_per_second": 10 * 2 ** 20, "max_connections": 100}).start()
+    bp_client.wait_closed()  # Serve until a signal arrives